@@ -1,89 +1,85 @@
 """
     This script reads a sorted training dataset and builds a vocabulary of terms of given size
-    Output: txt file with vocab words
+    Output: txt file with vocab words, and a csv with the document and token frequency of each word kept
     Drops any token not appearing in at least vocab_min notes
 
-    This script could probably be replaced by using sklearn's CountVectorizer to build a vocab
+    Only per-term counts are kept, so memory grows with the vocabulary rather than the corpus. The file is counted in
+    record-aligned byte ranges by worker processes, and their partial counts are merged in file order.
 """
-import csv
-import numpy as np
-import operator
-
-from collections import defaultdict
-from scipy.sparse import csr_matrix
+from collections import Counter
+from multiprocessing import Pool
+import os
+import time
 
 from constants import DATA_DIR, MIMIC_3_DIR
+from dataproc import csv_chunks
+
+def count_range(job):
+    """
+        Document frequency and token frequency of each term in one byte range of the data file.
+        Counters keep terms in order of first occurrence.
+    """
+    infile, start, end = job
+    doc_freq, term_freq = Counter(), Counter()
+    num_docs = 0
+    for row in csv_chunks.read_records(infile, start, end):
+        tokens = row[3].split()
+        term_freq.update(tokens)
+        #each distinct term once, in order of first occurrence
+        doc_freq.update(dict.fromkeys(tokens).keys())
+        num_docs += 1
+    return doc_freq, term_freq, num_docs
 
-def build_vocab(vocab_min, infile, vocab_filename):
+def build_vocab(vocab_min, infile, vocab_filename, max_vocab=None, workers=None, stats_file=None):
     """
         INPUTS:
             vocab_min: how many documents a word must appear in to be kept
             infile: (training) data file to build vocabulary from
             vocab_filename: name for the file to output
+            max_vocab: optionally keep only this many of the qualifying words, those in the most documents
+            workers: processes to count with (default: all cpus)
+            stats_file: where to write the frequencies of the kept words (default: vocab file name with a _stats.csv suffix)
     """
-    with open(infile, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        #header
-        next(reader)
-
-        #0. read in data
-        print("reading in data...")
-        #holds number of terms in each document
-        note_numwords = []
-        #indices where notes start
-        note_inds = [0]
-        #indices of discovered words
-        indices = []
-        #holds a bunch of ones
-        data = []
-        #keep track of discovered words
-        vocab = {}
-        #build lookup table for terms
-        num2term = {}
-        #preallocate array to hold number of notes each term appears in
-        note_occur = np.zeros(400000, dtype=int)
-        i = 0
-        for row in reader:
-            text = row[3]
-            numwords = 0
-            for term in text.split():
-                #put term in vocab if it's not there. else, get the index
-                index = vocab.setdefault(term, len(vocab))
-                indices.append(index)
-                num2term[index] = term
-                data.append(1)
-                numwords += 1
-            #record where the next note starts
-            note_inds.append(len(indices))
-            indset = set(indices[note_inds[-2]:note_inds[-1]])
-            #go thru all the word indices you just added, and add to the note occurrence count for each of them
-            for ind in indset:
-                note_occur[ind] += 1
-            note_numwords.append(numwords)
-            i += 1
-        #clip trailing zeros
-        note_occur = note_occur[note_occur>0]
-
-        #turn vocab into a list so indexing doesn't get fd up when we drop rows
-        vocab_list = np.array([word for word,ind in sorted(vocab.items(), key=operator.itemgetter(1))])
+    if workers is None:
+        workers = os.cpu_count()
+    start = time.time()
+    print("reading in data...")
+    jobs = [(infile, s, e) for s, e in csv_chunks.record_ranges(infile, csv_chunks.num_chunks(infile, workers))]
+    doc_freq, term_freq = Counter(), Counter()
+    num_docs = 0
+    pool = Pool(workers) if workers > 1 else None
+    #merging in file order keeps the vocab in order of first occurrence
+    for part_df, part_tf, part_docs in (pool.imap(count_range, jobs) if pool is not None else map(count_range, jobs)):
+        doc_freq.update(part_df)
+        term_freq.update(part_tf)
+        num_docs += part_docs
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        #1. create sparse document matrix
-        C = csr_matrix((data, indices, note_inds), dtype=int).transpose()
-        #also need the numwords array to be a sparse matrix
-        note_numwords = csr_matrix(1. / np.array(note_numwords))
-        
-        #2. remove rows with less than 3 total occurrences
-        print("removing rare terms")
-        #inds holds indices of rows corresponding to terms that occur in < 3 documents
-        inds = np.nonzero(note_occur >= vocab_min)[0]
-        print(str(len(inds)) + " terms qualify out of " + str(C.shape[0]) + " total")
-        #drop those rows
-        C = C[inds,:]
-        note_occur = note_occur[inds]
-        vocab_list = vocab_list[inds]
+    print("removing rare terms")
+    vocab_list = [term for term, df in doc_freq.items() if df >= vocab_min]
+    print(str(len(vocab_list)) + " terms qualify out of " + str(len(doc_freq)) + " total")
+    if max_vocab is not None and len(vocab_list) > max_vocab:
+        #stable sort, so ties go to the earlier term
+        keep = set(sorted(vocab_list, key=lambda term: -doc_freq[term])[:max_vocab])
+        vocab_list = [term for term in vocab_list if term in keep]
+        print("keeping the %d terms in the most documents (in at least %d)" % (max_vocab, min(doc_freq[term] for term in keep)))
 
-        print("writing output")
-        with open(vocab_filename, 'w') as vocab_file:
-            for word in vocab_list:
-                vocab_file.write(word + "\n")
+    print("writing output")
+    with open(vocab_filename, 'w') as vocab_file:
+        for word in vocab_list:
+            vocab_file.write(word + "\n")
+    if stats_file is None:
+        stats_file = os.path.splitext(vocab_filename)[0] + '_stats.csv'
+    with open(stats_file, 'w') as f:
+        f.write("WORD,DOC_FREQ,TERM_FREQ\n")
+        for word in sorted(vocab_list, key=lambda term: -doc_freq[term]):
+            f.write("%s,%d,%d\n" % (word, doc_freq[word], term_freq[word]))
 
+    num_tokens = sum(term_freq.values())
+    kept_tokens = sum(term_freq[term] for term in vocab_list)
+    print("%d documents, %d tokens, %d distinct terms. vocab of %d terms covers %.2f%% of tokens. took %.1fs" % (num_docs,
+          num_tokens, len(doc_freq), len(vocab_list), 100. * kept_tokens / max(num_tokens, 1), time.time() - start))
+    print("wrote frequency statistics to %s" % stats_file)
+    return vocab_filename
@@ -1,9 +1,12 @@
 """
     Concatenate the labels with the notes data and split using the saved splits
 """
+from collections import Counter, defaultdict
 import csv
 from datetime import datetime
+import os
 import random
+import sys
 
 from constants import DATA_DIR
 from constants import MIMIC_3_DIR
@@ -90,6 +93,132 @@ def split_data(labeledfile, base_name):
         test_file.close()
     return train_name, dev_name, test_name
     
+def hadm_key(hadm_id):
+    #hadm ids as written by pandas can be floats ("100001.0") when some are missing
+    return str(int(float(hadm_id))) if hadm_id != '' else ''
+
+def load_split_ids(name):
+    """
+        hadm id -> split for the saved train/dev/test splits of a label set ('full' or '50'), or None if not there
+    """
+    split_of = {}
+    for splt in ['train', 'dev', 'test']:
+        fname = '%s/%s_%s_hadm_ids.csv' % (MIMIC_3_DIR, splt, name)
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'r') as f:
+            for line in f:
+                if line.strip() != '':
+                    split_of[hadm_key(line.strip())] = splt
+    return split_of
+
+def label_and_split(codes_file, notes_file, base_name, labeled_file=None, Y=50):
+    """
+        Label the notes with their codes and write the train/dev/test splits (and the top-Y code splits) in one pass
+        over the notes, without sorting either file.
+        INPUTS:
+            codes_file: codes file with HADM_ID and ICD9_CODE columns (e.g. ALL_CODES.csv), in any order
+            notes_file: tokenized discharge summaries from get_discharge_summaries, in any order. A discharge summary and
+                its addenda (same hadm id) are concatenated in file order, as next_notes does for sorted notes.
+                A cheap first pass counts each admission's notes, so an admission is written as soon as its last note
+                is read and only admissions with addenda still to come are held in memory.
+            base_name: prefix of the split files, <base_name>_{train,dev,test}_split.csv
+            labeled_file: all labeled notes (default: notes_labeled.csv in MIMIC_3_DIR)
+            Y: size of the top code set, written to TOP_<Y>_CODES.csv with splits <base_name>_{train,dev,test}_<Y>_split.csv
+               (skipped if Y is None or there are no saved <Y> splits)
+        Sort the splits by length (length_sort) to get the files training reads.
+    """
+    if labeled_file is None:
+        labeled_file = '%s/notes_labeled.csv' % MIMIC_3_DIR
+    header = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS']
+
+    print("INDEXING CODES")
+    codes = defaultdict(list)
+    with open(codes_file, 'r') as f:
+        r = csv.reader(f)
+        cols = next(r)
+        hadm_col, code_col = cols.index('HADM_ID'), cols.index('ICD9_CODE')
+        for row in r:
+            if row[code_col] != '':
+                codes[hadm_key(row[hadm_col])].append(row[code_col])
+
+    #count each admission's notes, so an admission can be written as soon as its last note is read
+    csv.field_size_limit(sys.maxsize)
+    with open(notes_file, 'r') as f:
+        r = csv.reader(f)
+        next(r)
+        note_counts = Counter(hadm_key(row[2]) for row in r)
+    labeled = [hadm for hadm in note_counts if hadm in codes]
+    print("%d admissions with notes, %d of them with codes" % (len(note_counts), len(labeled)))
+
+    split_full = load_split_ids('full')
+    if split_full is None:
+        print("no saved train/dev/test splits, only writing %s" % labeled_file)
+    top_codes, split_top = None, None
+    if Y is not None:
+        split_top = load_split_ids(str(Y))
+        if split_top is None:
+            print("no saved splits for the top %s codes, skipping them" % str(Y))
+        else:
+            code_counts = Counter(code for hadm in labeled for code in codes[hadm])
+            top_codes = [code for code, _ in code_counts.most_common(int(Y))]
+            with open('%s/TOP_%s_CODES.csv' % (MIMIC_3_DIR, str(Y)), 'w') as of:
+                w = csv.writer(of)
+                for code in top_codes:
+                    w.writerow([code])
+            top_codes = set(top_codes)
+
+    print("LABELING AND SPLITTING")
+    names = {splt: '%s_%s_split.csv' % (base_name, splt) for splt in ['train', 'dev', 'test']}
+    files = []
+    def writer(fname):
+        files.append(open(fname, 'w'))
+        w = csv.writer(files[-1])
+        w.writerow(header)
+        return w
+    labeled_writer = writer(labeled_file)
+    full_writers = {splt: writer(names[splt]) for splt in ['train', 'dev', 'test']}
+    if top_codes is not None:
+        top_writers = {splt: writer('%s_%s_%s_split.csv' % (base_name, splt, str(Y))) for splt in ['train', 'dev', 'test']}
+
+    #admissions with notes still to come: hadm id -> [row id, subject id, texts, notes seen]
+    pending = {}
+    num_written = Counter()
+    with open(notes_file, 'r') as f:
+        r = csv.reader(f)
+        next(r)
+        for i, row in enumerate(r):
+            if i % 10000 == 0:
+                print(str(i) + " read")
+            hadm_id = hadm_key(row[2])
+            if hadm_id not in codes:
+                continue
+            note = pending.setdefault(hadm_id, [row[0], row[1], [], 0])
+            note[2].append(row[4])
+            note[3] += 1
+            if note[3] < note_counts[hadm_id]:
+                continue
+            #that was the admission's last note
+            del pending[hadm_id]
+            labels = codes[hadm_id]
+            out = [note[0], note[1], hadm_id, ' '.join(note[2]), ';'.join(labels)]
+            labeled_writer.writerow(out)
+            num_written['labeled'] += 1
+            splt = split_full.get(hadm_id) if split_full is not None else None
+            if splt is not None:
+                full_writers[splt].writerow(out)
+                num_written[splt] += 1
+            splt = split_top.get(hadm_id) if top_codes is not None else None
+            if splt is not None:
+                top_labels = [code for code in labels if code in top_codes]
+                if len(top_labels) > 0:
+                    top_writers[splt].writerow(out[:4] + [';'.join(top_labels)])
+                    num_written['%s_%s' % (splt, str(Y))] += 1
+    for f in files:
+        f.close()
+    print("wrote " + ", ".join("%d %s" % (n, name) for name, n in sorted(num_written.items())))
+    return names['train'], names['dev'], names['test']
+
 def next_labels(labelsfile):
     """
         Generator for label sets from the label file
@@ -0,0 +1,61 @@
+"""
+    Split large csv files into byte ranges that start and end on record boundaries, so the ranges can be parsed
+    independently (e.g. by worker processes), even when quoted fields span several lines
+"""
+import csv
+import io
+import os
+
+#bytes of a file per range a worker reads
+CHUNK_BYTES = 1<<26
+
+def num_chunks(path, workers):
+    #several ranges per worker to balance the load, and ranges small enough to hold in memory
+    return max(workers * 4, os.path.getsize(path) // CHUNK_BYTES)
+
+def record_ranges(path, num_chunks, skip_header=True, block_size=1<<24):
+    """
+        Byte ranges (start, end) covering the records of a csv file, in file order, about num_chunks of them.
+        A newline ends a record when the number of quotes before it is even (quotes inside quoted fields are doubled),
+        so each boundary is found by counting quotes up to the split point, then scanning forward line by line.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = len(f.readline()) if skip_header else 0
+        if num_chunks <= 1:
+            return [(start, size)] if size > start else []
+        step = max(1, (size - start) // num_chunks)
+        boundaries = [start]
+        quotes, pos = 0, start
+        f.seek(start)
+        for target in range(start + step, size, step):
+            if target <= boundaries[-1]:
+                continue
+            #quotes between the current position and the split point
+            while pos < target:
+                block = f.read(min(block_size, target - pos))
+                quotes += block.count(b'"')
+                pos += len(block)
+            #finish the line the split point falls in, then keep going until a line ends outside quotes
+            while True:
+                line = f.readline()
+                if line == b'':
+                    break
+                quotes += line.count(b'"')
+                pos += len(line)
+                if quotes % 2 == 0:
+                    break
+            if pos >= size:
+                break
+            boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def read_records(path, start, end):
+    """
+        Parse the csv records in a byte range from record_ranges
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return csv.reader(io.StringIO(data.decode('utf-8'), newline=''))
@@ -1,9 +1,10 @@
 """
     Use the vocabulary to load a matrix of pre-trained word vectors
 """
+import argparse
 import csv
 import os
-import gensim.models
+import time
 from tqdm import tqdm
 
 from constants import *
@@ -11,7 +12,9 @@ import datasets
 
 import numpy as np
 
-def gensim_to_embeddings(wv_file, vocab_file, Y, outfile=None):
+def gensim_to_embeddings(wv_file, vocab_file, Y, outfile=None, oov_init='random'):
+    #imported here so loading embeddings doesn't pull in gensim
+    import gensim.models
     model = gensim.models.Word2Vec.load(wv_file)
     wv = model.wv
     #free up memory
@@ -25,52 +28,137 @@ def gensim_to_embeddings(wv_file, vocab_file, Y, outfile=None):
                 vocab.add(line)
     ind2w = {i+1:w for i,w in enumerate(sorted(vocab))}
 
-    W, words = build_matrix(ind2w, wv)
+    W, words = build_matrix(ind2w, wv, oov_init)
 
     if outfile is None:
         outfile = wv_file.replace('.w2v', '.embed')
 
     #smash that save button
-    save_embeddings(W, words, outfile)
+    save_binary_embeddings(W, words, binary_file(outfile))
 
-def build_matrix(ind2w, wv):
+def build_matrix(ind2w, wv, oov_init='random', seed=1337):
     """
-        Go through vocab in order. Find vocab word in wv.index2word, then call wv.word_vec(wv.index2word[i]).
-        Put results into one big matrix.
+        Gather the vectors of the vocab words (in vocab order) from gensim word vectors into one float32 matrix.
         Note: ind2w starts at 1 (saving 0 for the pad character), but gensim word vectors starts at 0
+        Vocab words without a vector (e.g. when word2vec was trained with a higher min_count) are initialized with
+        oov_init: 'zero', 'mean' (the mean vector), or 'random' (gaussian with the per-dimension std of the vectors,
+        from a fixed seed)
     """
-    W = np.zeros((len(ind2w)+1, len(wv.word_vec(wv.index2word[0])) ))
-    words = [PAD_CHAR]
-    W[0][:] = np.zeros(len(wv.word_vec(wv.index2word[0])))
-    for idx, word in tqdm(ind2w.items()):
-        if idx >= W.shape[0]:
-            break    
-        W[idx][:] = wv.word_vec(word)
-        words.append(word)
+    #gensim 4 renamed the word index
+    key_to_index = wv.key_to_index if hasattr(wv, 'key_to_index') else {w: i for i, w in enumerate(wv.index2word)}
+    vectors = wv.vectors
+    idxs = np.array(list(ind2w.keys()), dtype=np.int64)
+    words = [PAD_CHAR] + list(ind2w.values())
+    rows = np.array([key_to_index.get(word, -1) for word in words[1:]], dtype=np.int64)
+    found = rows >= 0
+
+    W = np.zeros((len(ind2w)+1, vectors.shape[1]), dtype=np.float32)
+    W[idxs[found]] = vectors[rows[found]]
+    missing = [word for word, f in zip(words[1:], found) if not f]
+    if len(missing) > 0:
+        if oov_init == 'mean':
+            W[idxs[~found]] = vectors.mean(axis=0)
+        elif oov_init == 'random':
+            W[idxs[~found]] = np.random.RandomState(seed).randn(len(missing), vectors.shape[1]) * vectors.std(axis=0)
+    print("%d of %d vocab words have no word vector (%s initialized)%s" % (len(missing), len(ind2w), oov_init,
+          ", e.g. %s" % ' '.join(missing[:10]) if len(missing) > 0 else ""))
     return W, words
 
-def save_embeddings(W, words, outfile):
-    with open(outfile, 'w') as o:
-        #pad token already included
-        for i in range(len(words)):
-            line = [words[i]]
-            line.extend([str(d) for d in W[i]])
-            o.write(" ".join(line) + "\n")
+def binary_file(embed_file):
+    """
+        Binary embedding store for an embedding file name: the float32 matrix in <name>.npy, next to its words
+    """
+    return embed_file if embed_file.endswith('.npy') else embed_file + '.npy'
 
-def load_embeddings(embed_file):
-    #also normalizes the embeddings
-    W = []
+def words_file(npy_file):
+    return npy_file[:-len('.npy')] + '.words'
+
+def save_binary_embeddings(W, words, npy_file):
+    """
+        Save the matrix as float32 in .npy format (so it can be memory mapped) and the words, one per line, in the
+        same order
+    """
+    np.save(npy_file, np.asarray(W, dtype=np.float32))
+    with open(words_file(npy_file), 'w') as o:
+        for word in words:
+            o.write(word + "\n")
+
+def text_shape(embed_file):
+    #number of rows and the vector size of a text embedding file (one word and its vector per line)
+    num_rows, dim = 0, 0
     with open(embed_file) as ef:
         for line in ef:
-            line = line.rstrip().split()
-            vec = np.array(line[1:]).astype(np.float)
-            vec = vec / float(np.linalg.norm(vec) + 1e-6)
-            W.append(vec)
-        #UNK embedding, gaussian randomly initialized 
-        print("adding unk embedding")
-        vec = np.random.randn(len(W[-1]))
-        vec = vec / float(np.linalg.norm(vec) + 1e-6)
-        W.append(vec)
-    W = np.array(W)
+            if num_rows == 0:
+                dim = len(line.split()) - 1
+            num_rows += 1
+    return num_rows, dim
+
+def read_text(embed_file, W, words_out=None):
+    """
+        Parse a text embedding file line by line into the preallocated matrix W (e.g. memory mapped), so the text is
+        never held in memory. Writes the words, one per line, to words_out if given.
+    """
+    with open(embed_file) as ef:
+        for i, line in enumerate(tqdm(ef, total=W.shape[0])):
+            line = line.split()
+            W[i] = np.array(line[1:], dtype=np.float32)
+            if words_out is not None:
+                words_out.write(line[0] + "\n")
     return W
 
+def text_to_binary(embed_file, npy_file=None):
+    """
+        Convert a text embedding file to the binary store, row by row into a memory-mapped output
+    """
+    if npy_file is None:
+        npy_file = binary_file(embed_file)
+    W = np.lib.format.open_memmap(npy_file, mode='w+', dtype=np.float32, shape=text_shape(embed_file))
+    with open(words_file(npy_file), 'w') as wf:
+        read_text(embed_file, W, wf)
+    W.flush()
+    del W
+    return npy_file
+
+def normalize_rows(W, out, chunk_size=65536):
+    #unit-length rows, a chunk at a time so the only full-size array is the output
+    for start in range(0, W.shape[0], chunk_size):
+        rows = np.asarray(W[start:start+chunk_size], dtype=np.float32)
+        norms = np.sqrt(np.einsum('ij,ij->i', rows, rows))
+        np.divide(rows, (norms + 1e-6)[:, None], out=out[start:start+chunk_size])
+    return out
+
+def load_embeddings(embed_file):
+    """
+        Load an embedding matrix as float32, with each row normalized to unit length and a random unit-length UNK row
+        appended. Reads the binary store (memory mapped) if there is one for embed_file and it isn't older than the
+        text file, and parses the text file otherwise.
+        The UNK row is drawn from a fixed seed, so loading the same file always gives the same matrix.
+    """
+    npy_file = binary_file(embed_file)
+    if os.path.exists(npy_file) and (npy_file == embed_file or not os.path.exists(embed_file)
+                                     or os.path.getmtime(npy_file) >= os.path.getmtime(embed_file)):
+        W = np.load(npy_file, mmap_mode='r')
+        out = np.empty((W.shape[0] + 1, W.shape[1]), dtype=np.float32)
+        normalize_rows(W, out[:-1])
+    else:
+        print("parsing text embedding file %s (convert it with extract_wvs.py to load faster)" % embed_file)
+        num_rows, dim = text_shape(embed_file)
+        #parse straight into the output and normalize in place, so the output is the only full-size array
+        out = np.empty((num_rows + 1, dim), dtype=np.float32)
+        read_text(embed_file, out[:-1])
+        normalize_rows(out[:-1], out[:-1])
+    #UNK embedding, gaussian randomly initialized 
+    print("adding unk embedding")
+    vec = np.random.RandomState(1337).randn(out.shape[1])
+    out[-1] = vec / float(np.linalg.norm(vec) + 1e-6)
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert a text embedding file to a binary float32 matrix and word list for fast loading")
+    parser.add_argument("embed_file", type=str, help="text embedding file, one word and its vector per line")
+    parser.add_argument("--out", type=str, required=False, dest="out",
+                        help="output .npy file (default: the embedding file name with .npy appended). the words go next to it with a .words extension")
+    args = parser.parse_args()
+    start = time.time()
+    npy_file = text_to_binary(args.embed_file, args.out)
+    print("wrote %s and %s in %.1fs" % (npy_file, words_file(npy_file), time.time() - start))
@@ -1,36 +1,67 @@
 """
     Reads NOTEEVENTS file, finds the discharge summaries, preprocesses them and writes out the filtered dataset.
 """
-import csv
-
-from nltk.tokenize import RegexpTokenizer
+from multiprocessing import Pool
+import os
+import re
+import time
 
 from tqdm import tqdm
 
 from constants import MIMIC_3_DIR
+from dataproc import csv_chunks
+
+#retain only alphanumeric (same as nltk's RegexpTokenizer(r'\w+'), compiled once)
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(note):
+    #tokenize, lowercase and remove numerics
+    if note.isascii():
+        #lowercasing ascii text can't change where tokens split, so do it in one call
+        return [t for t in TOKEN_RE.findall(note.lower()) if not t.isnumeric()]
+    return [t.lower() for t in TOKEN_RE.findall(note) if not t.isnumeric()]
 
-#retain only alphanumeric
-tokenizer = RegexpTokenizer(r'\w+')
+def process_range(job):
+    """
+        Tokenize the discharge summaries in one byte range of the notes file.
+        Returns the output rows as one string, the number of notes read and the number of discharge summaries kept.
+    """
+    notes_file, start, end = job
+    out = []
+    num_notes = 0
+    for line in csv_chunks.read_records(notes_file, start, end):
+        num_notes += 1
+        #check the category before doing any work on the text
+        if line[6] == "Discharge summary":
+            text = '"' + ' '.join(tokenize(line[10])) + '"'
+            out.append(','.join([line[0], line[1], line[2], line[4], text]) + '\n')
+    return ''.join(out), num_notes, len(out)
 
-def write_discharge_summaries(out_file):
+def write_discharge_summaries(out_file, workers=None):
+    """
+        Split the notes file into record-aligned byte ranges and tokenize them in worker processes (all cpus unless
+        workers is given, or in this process with workers=1). Rows are written in the order of the notes file.
+    """
     notes_file = '%s/NOTEEVENTS.csv' % (MIMIC_3_DIR)
+    if workers is None:
+        workers = os.cpu_count()
     print("processing notes file")
-    with open(notes_file, 'r') as csvfile:
-        with open(out_file, 'w') as outfile:
-            print("writing to %s" % (out_file))
-            outfile.write(','.join(['ROW_ID','SUBJECT_ID', 'HADM_ID', 'CHARTTIME', 'TEXT']) + '\n')
-            notereader = csv.reader(csvfile)
-            #header
-            next(notereader)
-            i = 0
-            for line in tqdm(notereader):
-                subj = int(line[1])
-                category = line[6]
-                if category == "Discharge summary":
-                    note = line[10]
-                    #tokenize, lowercase and remove numerics
-                    tokens = [t.lower() for t in tokenizer.tokenize(note) if not t.isnumeric()]
-                    text = '"' + ' '.join(tokens) + '"'
-                    outfile.write(','.join([line[0], line[1], line[2], line[4], text]) + '\n')
-                i += 1
+    start = time.time()
+    jobs = [(notes_file, s, e) for s, e in csv_chunks.record_ranges(notes_file, csv_chunks.num_chunks(notes_file, workers))]
+    num_notes, num_summaries = 0, 0
+    with open(out_file, 'w') as outfile:
+        print("writing to %s" % (out_file))
+        outfile.write(','.join(['ROW_ID','SUBJECT_ID', 'HADM_ID', 'CHARTTIME', 'TEXT']) + '\n')
+        pool = Pool(workers) if workers > 1 else None
+        results = pool.imap(process_range, jobs) if pool is not None else map(process_range, jobs)
+        for text, chunk_notes, chunk_summaries in tqdm(results, total=len(jobs)):
+            outfile.write(text)
+            num_notes += chunk_notes
+            num_summaries += chunk_summaries
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    print("read %d notes and wrote %d discharge summaries in %.1fs (%.0f notes/sec)" % (num_notes, num_summaries, elapsed,
+          num_notes / elapsed if elapsed > 0 else 0.))
     return out_file
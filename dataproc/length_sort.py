@@ -0,0 +1,84 @@
+"""
+    Sort a data split by note length (in tokens) with bounded memory, adding the length column that
+    datasets.data_generator reads. Rows are read in runs up to a memory budget, each run is sorted and spilled to a
+    temporary file, and the runs are merged.
+"""
+import csv
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+def write_run(rows, tmp_dir, num):
+    #stable sort on the length, which is the first field of each buffered row
+    rows.sort(key=lambda row: row[0])
+    fname = os.path.join(tmp_dir, 'run_%d.csv' % num)
+    with open(fname, 'w') as f:
+        csv.writer(f).writerows(rows)
+    return fname
+
+def read_run(fname):
+    with open(fname, 'r') as f:
+        for row in csv.reader(f):
+            row[0] = int(row[0])
+            yield row
+
+def sort_by_length(infile, outfile=None, columns=None, max_bytes=1<<28, tmp_dir=None):
+    """
+        INPUTS:
+            infile: csv with a header and a TEXT column of tokenized text
+            outfile: where to write the sorted split (default: overwrite infile)
+            columns: columns to keep, in order (default: all of infile's). the length column is added last
+            max_bytes: roughly how much row data to hold in memory at once
+            tmp_dir: where to spill sorted runs (default: next to outfile)
+        Rows with the same length keep their input order.
+    """
+    if outfile is None:
+        outfile = infile
+    start = time.time()
+    csv.field_size_limit(sys.maxsize)
+    tmp_dir = tempfile.mkdtemp(prefix='length_sort_', dir=tmp_dir if tmp_dir is not None else os.path.dirname(os.path.abspath(outfile)))
+    try:
+        runs = []
+        with open(infile, 'r') as f:
+            r = csv.reader(f)
+            header = next(r)
+            if columns is None:
+                columns = header
+            inds = [header.index(col) for col in columns]
+            text_ind = header.index('TEXT')
+            rows, size = [], 0
+            for row in r:
+                #count tokens as the row is read, and keep the length in front for sorting
+                rows.append([len(row[text_ind].split())] + [row[i] for i in inds])
+                size += sum(len(field) for field in row)
+                if size >= max_bytes:
+                    runs.append(write_run(rows, tmp_dir, len(runs)))
+                    rows, size = [], 0
+
+        #write to a temporary file first, since the output may replace the input
+        tmp_out = os.path.join(tmp_dir, 'sorted.csv')
+        with open(tmp_out, 'w') as f:
+            w = csv.writer(f)
+            w.writerow(columns + ['length'])
+            if len(runs) == 0:
+                #everything fit in memory
+                rows.sort(key=lambda row: row[0])
+                merged = rows
+            else:
+                if len(rows) > 0:
+                    runs.append(write_run(rows, tmp_dir, len(runs)))
+                rows = None
+                #merging runs in input order keeps the sort stable
+                merged = heapq.merge(*[read_run(run) for run in runs], key=lambda row: row[0])
+            num_rows = 0
+            for row in merged:
+                w.writerow(row[1:] + [row[0]])
+                num_rows += 1
+        shutil.move(tmp_out, outfile)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print("sorted %d rows of %s by length in %.1fs (%d runs)" % (num_rows, infile, time.time() - start, max(len(runs), 1)))
+    return outfile
@@ -0,0 +1,276 @@
+"""
+    Runs the MIMIC-III data preparation of notebooks/dataproc_mimic_III as a pipeline of stages with declared inputs
+    and outputs. A stage is skipped when the content of its inputs and its parameters haven't changed since it last
+    ran, and stages that don't depend on each other run in parallel. A manifest in MIMIC_3_DIR records the hashes,
+    timings and output sizes.
+
+    Run from the repository root: python -m dataproc.pipeline
+"""
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from constants import DATA_DIR, MIMIC_3_DIR
+import datasets
+from dataproc import build_vocab
+from dataproc import concat_and_split
+from dataproc import extract_wvs
+from dataproc import get_discharge_summaries
+from dataproc import length_sort
+from dataproc import vocab_index_descriptions
+
+SPLITS = ['train', 'dev', 'test']
+
+class Stage:
+    """
+        One step of the pipeline: fn(inputs, outputs, **params, **options), with inputs and outputs as dicts of file
+        paths. params change the outputs, so they are part of the stage's hash; options (e.g. process counts) don't.
+    """
+    def __init__(self, name, fn, inputs, outputs, params=None, options=None):
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params if params is not None else {}
+        self.options = options if options is not None else {}
+
+    def run(self):
+        self.fn(self.inputs, self.outputs, **dict(self.params, **self.options))
+
+###########
+# STAGES
+###########
+
+def all_codes(inputs, outputs):
+    #read as the notebooks do (so purely numeric procedure codes lose their leading zeros), to keep the same label set
+    dfproc = pd.read_csv(inputs['procedures'])
+    dfdiag = pd.read_csv(inputs['diagnoses'])
+    dfdiag['absolute_code'] = datasets.reformat_codes(dfdiag['ICD9_CODE'].astype(str), True)
+    dfproc['absolute_code'] = datasets.reformat_codes(dfproc['ICD9_CODE'].astype(str), False)
+    dfcodes = pd.concat([dfdiag, dfproc])
+    dfcodes.to_csv(outputs['codes'], index=False,
+                   columns=['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'absolute_code'],
+                   header=['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE'])
+
+def discharge_summaries(inputs, outputs, workers=None):
+    get_discharge_summaries.write_discharge_summaries(outputs['summaries'], workers)
+
+def label_and_split(inputs, outputs, Y, base_name):
+    concat_and_split.label_and_split(inputs['codes'], inputs['summaries'], base_name, outputs['labeled'], Y)
+
+def vocab(inputs, outputs, vocab_min, max_vocab=None, workers=None):
+    build_vocab.build_vocab(vocab_min, inputs['train'], outputs['vocab'], max_vocab, workers, outputs['stats'])
+
+def sort_splits(inputs, outputs):
+    for name, infile in inputs.items():
+        #the columns datasets.data_generator reads
+        length_sort.sort_by_length(infile, outputs[name], columns=['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS'])
+
+def word2vec(inputs, outputs, embedding_size, min_count, n_iter):
+    from dataproc import word_embeddings
+    out_file = word_embeddings.word_embeddings('full', inputs['summaries'], embedding_size, min_count, n_iter)
+    if os.path.abspath(out_file) != os.path.abspath(outputs['w2v']):
+        os.replace(out_file, outputs['w2v'])
+
+def embeddings(inputs, outputs, oov_init):
+    extract_wvs.gensim_to_embeddings(inputs['w2v'], inputs['vocab'], 'full', outputs['embed'], oov_init)
+
+def descriptions(inputs, outputs):
+    vocab_index_descriptions.vocab_index_descriptions(inputs['vocab'], outputs['vectors'])
+
+def make_stages(args):
+    d = MIMIC_3_DIR
+    #prefix of the split files, a param of the split stage so renaming them re-runs it
+    base_name = '%s/disch' % d
+    split_ids = {'%s_%s_ids' % (splt, name): '%s/%s_%s_hadm_ids.csv' % (d, splt, name) for splt in SPLITS for name in ['full', str(args.Y)]}
+    split_outputs = {'labeled': '%s/notes_labeled.csv' % d, 'top_codes': '%s/TOP_%s_CODES.csv' % (d, str(args.Y))}
+    sort_inputs, sort_outputs = {}, {}
+    for splt in SPLITS:
+        for name, unsorted, sorted_file in [('full', '%s_%s_split' % (base_name, splt), '%s_full' % splt),
+                                            (str(args.Y), '%s_%s_%s_split' % (base_name, splt, str(args.Y)), '%s_%s' % (splt, str(args.Y)))]:
+            split_outputs['%s_%s' % (splt, name)] = sort_inputs['%s_%s' % (splt, name)] = '%s.csv' % unsorted
+            sort_outputs['%s_%s' % (splt, name)] = '%s/%s.csv' % (d, sorted_file)
+    descriptions_inputs = {'vocab': '%s/vocab.csv' % d, 'icd_diagnoses': '%s/D_ICD_DIAGNOSES.csv' % DATA_DIR,
+                           'icd_procedures': '%s/D_ICD_PROCEDURES.csv' % DATA_DIR, 'icd9_descriptions': '%s/ICD9_descriptions' % DATA_DIR}
+    stages = [
+        Stage('codes', all_codes, {'diagnoses': '%s/DIAGNOSES_ICD.csv' % d, 'procedures': '%s/PROCEDURES_ICD.csv' % d},
+              {'codes': '%s/ALL_CODES.csv' % d}),
+        Stage('notes', discharge_summaries, {'notes': '%s/NOTEEVENTS.csv' % d}, {'summaries': '%s/disch_full.csv' % d},
+              options={'workers': args.workers}),
+        Stage('split', label_and_split, dict({'codes': '%s/ALL_CODES.csv' % d, 'summaries': '%s/disch_full.csv' % d}, **split_ids),
+              split_outputs, {'Y': args.Y, 'base_name': base_name}),
+        Stage('vocab', vocab, {'train': '%s_train_split.csv' % base_name}, {'vocab': '%s/vocab.csv' % d, 'stats': '%s/vocab_stats.csv' % d},
+              {'vocab_min': args.vocab_min, 'max_vocab': args.max_vocab}, {'workers': args.workers}),
+        Stage('sort', sort_splits, sort_inputs, sort_outputs),
+        Stage('word2vec', word2vec, {'summaries': '%s/disch_full.csv' % d}, {'w2v': '%s/processed_full.w2v' % d},
+              {'embedding_size': args.embedding_size, 'min_count': args.w2v_min_count, 'n_iter': args.w2v_iter}),
+        Stage('embeddings', embeddings, {'w2v': '%s/processed_full.w2v' % d, 'vocab': '%s/vocab.csv' % d},
+              {'embed': '%s/processed_full.embed.npy' % d, 'words': '%s/processed_full.embed.words' % d}, {'oov_init': args.oov_init}),
+        Stage('descriptions', descriptions, descriptions_inputs, {'vectors': '%s/description_vectors.vocab' % d}),
+    ]
+    return stages
+
+###########
+# RUNNER
+###########
+
+def file_hash(path, cache, block_size=1<<24):
+    """
+        sha1 of a file's content, reused from the manifest while the file's size and modification time are unchanged
+    """
+    stat = os.stat(path)
+    rec = cache.get(path)
+    if rec is not None and rec['size'] == stat.st_size and rec['mtime'] == stat.st_mtime:
+        return rec['sha1']
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    cache[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': h.hexdigest()}
+    return cache[path]['sha1']
+
+def stage_key(stage, cache):
+    #what the stage's outputs depend on: its function, parameters and the content of its inputs
+    h = hashlib.sha1()
+    h.update(json.dumps({'stage': stage.name, 'fn': stage.fn.__name__, 'params': stage.params}, sort_keys=True).encode('utf-8'))
+    for name in sorted(stage.inputs):
+        h.update(('%s:%s' % (name, file_hash(stage.inputs[name], cache))).encode('utf-8'))
+    return h.hexdigest()
+
+def up_to_date(stage, key, manifest):
+    rec = manifest['stages'].get(stage.name)
+    if rec is None or rec['key'] != key:
+        return False
+    #outputs deleted or changed since the stage wrote them
+    return all(os.path.exists(path) and os.path.getsize(path) == rec['output_bytes'].get(name)
+               for name, path in stage.outputs.items())
+
+def run_stage(stage):
+    start = time.time()
+    stage.run()
+    return time.time() - start
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {'files': {}, 'stages': {}}
+
+def save_manifest(manifest, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def run(stages, manifest_file, force=(), jobs=2, dry_run=False):
+    """
+        Run the stages in dependency order, up to jobs at a time, skipping those that are up to date.
+        A stage depends on the stages that write its inputs.
+        Returns a summary of what ran, with timings and output sizes.
+    """
+    manifest = load_manifest(manifest_file)
+    writer = {path: stage.name for stage in stages for path in stage.outputs.values()}
+    deps = {stage.name: set(writer[path] for path in stage.inputs.values() if path in writer) for stage in stages}
+    missing = [path for stage in stages for path in stage.inputs.values() if path not in writer and not os.path.exists(path)]
+    if len(missing) > 0:
+        raise FileNotFoundError("pipeline inputs not found: %s" % ', '.join(sorted(set(missing))))
+
+    summary = {}
+    #stale: stages a dry run would run, so their outputs can't be hashed yet
+    done, stale, running = set(), set(), {}
+    todo = [stage for stage in stages]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while len(todo) > 0 or len(running) > 0:
+            for stage in [stage for stage in todo if deps[stage.name] <= done]:
+                todo.remove(stage)
+                if dry_run and len(deps[stage.name] & stale) > 0:
+                    print("[%s] would run" % stage.name)
+                    summary[stage.name] = {'status': 'would run'}
+                    done.add(stage.name)
+                    stale.add(stage.name)
+                    continue
+                key = stage_key(stage, manifest['files'])
+                if stage.name not in force and up_to_date(stage, key, manifest):
+                    print("[%s] up to date, skipping" % stage.name)
+                    summary[stage.name] = dict(manifest['stages'][stage.name], status='skipped')
+                    done.add(stage.name)
+                elif dry_run:
+                    print("[%s] would run" % stage.name)
+                    summary[stage.name] = {'status': 'would run'}
+                    done.add(stage.name)
+                    stale.add(stage.name)
+                else:
+                    print("[%s] running" % stage.name)
+                    running[executor.submit(run_stage, stage)] = (stage, key)
+            if len(running) == 0:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                seconds = future.result()
+                outputs = stage.outputs
+                rec = {'key': key, 'seconds': round(seconds, 1), 'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'output_bytes': {name: os.path.getsize(path) for name, path in outputs.items()}}
+                manifest['stages'][stage.name] = rec
+                save_manifest(manifest, manifest_file)
+                summary[stage.name] = dict(rec, status='ran')
+                print("[%s] done in %.1fs" % (stage.name, seconds))
+                done.add(stage.name)
+    return summary
+
+def print_summary(summary, stages):
+    print("%-14s %-10s %10s %12s" % ('stage', 'status', 'seconds', 'output MB'))
+    for stage in stages:
+        rec = summary.get(stage.name)
+        if rec is not None:
+            size = sum(rec.get('output_bytes', {}).values()) / (1024. * 1024.)
+            print("%-14s %-10s %10s %12.1f" % (stage.name, rec['status'], rec.get('seconds', ''), size))
+
+def main(args):
+    stages = make_stages(args)
+    if args.stages is not None:
+        names = args.stages.split(',')
+        unknown = [name for name in names if name not in [stage.name for stage in stages]]
+        if len(unknown) > 0:
+            raise ValueError("unknown stages: %s" % ', '.join(unknown))
+        stages = [stage for stage in stages if stage.name in names]
+    force = [stage.name for stage in stages] if args.force else []
+    start = time.time()
+    summary = run(stages, args.manifest, force, args.jobs, args.dry_run)
+    print_summary(summary, stages)
+    print("pipeline finished in %.1fs" % (time.time() - start))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prepare the MIMIC-III data, re-running only the stages whose inputs or parameters changed")
+    parser.add_argument("--stages", type=str, required=False, dest="stages",
+                        help="comma-separated stages to run (default: all). stages: codes, notes, split, vocab, sort, word2vec, embeddings, descriptions")
+    parser.add_argument("--force", dest="force", action="store_const", required=False, const=True,
+                        help="optional flag to re-run the selected stages even if they are up to date")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_const", required=False, const=True,
+                        help="optional flag to only print which stages would run")
+    parser.add_argument("--jobs", type=int, required=False, dest="jobs", default=2,
+                        help="stages to run at once when they don't depend on each other (default: 2)")
+    parser.add_argument("--workers", type=int, required=False, dest="workers",
+                        help="processes for tokenizing notes and counting the vocab (default: all cpus)")
+    parser.add_argument("--manifest", type=str, required=False, dest="manifest", default='%s/pipeline_manifest.json' % MIMIC_3_DIR,
+                        help="file recording input hashes, timings and output sizes (default: pipeline_manifest.json in MIMIC_3_DIR)")
+    parser.add_argument("--Y", type=int, required=False, dest="Y", default=50,
+                        help="size of the top code label set (default: 50)")
+    parser.add_argument("--vocab-min", type=int, required=False, dest="vocab_min", default=3,
+                        help="discard tokens appearing in fewer than this many training documents (default: 3)")
+    parser.add_argument("--max-vocab", type=int, required=False, dest="max_vocab",
+                        help="optionally cap the vocab at the words in the most documents")
+    parser.add_argument("--embedding-size", type=int, required=False, dest="embedding_size", default=100,
+                        help="word2vec embedding size (default: 100)")
+    parser.add_argument("--w2v-min-count", type=int, required=False, dest="w2v_min_count", default=0,
+                        help="word2vec min_count (default: 0)")
+    parser.add_argument("--w2v-iter", type=int, required=False, dest="w2v_iter", default=5,
+                        help="word2vec training epochs (default: 5)")
+    parser.add_argument("--oov-init", type=str, choices=['zero', 'mean', 'random'], required=False, dest="oov_init", default='random',
+                        help="initialization of vocab words without a word2vec vector (default: random)")
+    args = parser.parse_args()
+    main(args)
@@ -17,6 +17,7 @@ class Batch:
         self.docs = []
         self.labels = []
         self.hadm_ids = []
+        self.lengths = []
         self.code_set = set()
         self.length = 0
         self.max_length = MAX_LENGTH
@@ -62,6 +63,7 @@ class Batch:
         self.docs.append(text)
         self.labels.append(labels_idx)
         self.hadm_ids.append(hadm_id)
+        self.lengths.append(len(text))
         self.code_set = self.code_set.union(cur_code_set)
         if self.desc_embed:
             self.descs.append(pad_desc_vecs(desc_vecs))
@@ -79,7 +81,7 @@ class Batch:
 
     def to_ret(self):
         return np.array(self.docs), np.array(self.labels), np.array(self.hadm_ids), self.code_set,\
-               np.array(self.descs)
+               np.array(self.descs), np.array(self.lengths)
 
 def pad_desc_vecs(desc_vecs):
     #pad all description vectors in a batch to have the same length
@@ -101,7 +103,8 @@ def data_generator(filename, dicts, batch_size, num_labels, desc_embed=False, ve
             desc_embed: true if using DR-CAML (lambda > 0)
             version: which (MIMIC) dataset
         Yields:
-            np arrays with data for training loop.
+            np arrays with data for training loop: padded docs, labels, hadm ids, code set, descriptions and
+            the unpadded length of each doc.
     """
     ind2w, w2ind, ind2c, c2ind, dv_dict = dicts['ind2w'], dicts['w2ind'], dicts['ind2c'], dicts['c2ind'], dicts['dv']
     with open(filename, 'r') as infile:
@@ -271,6 +274,32 @@ def reformat(code, is_diag):
         code = code[:2] + '.' + code[2:]
     return code
 
+def reformat_codes(codes, is_diag):
+    """
+        reformat for a whole array or column (e.g. a pandas Series) of codes at once.
+        is_diag is one flag for all the codes, or an array of flags with one per code.
+        Returns a numpy array of the reformatted codes.
+    """
+    codes = np.atleast_1d(np.asarray(codes, dtype=str))
+    if len(codes) == 0:
+        return codes
+    codes = np.char.replace(codes, '.', '')
+    is_diag = np.broadcast_to(np.asarray(is_diag, dtype=bool), codes.shape)
+    lengths = np.char.str_len(codes)
+    width = codes.dtype.itemsize // 4
+    #where each code's period goes, past the end of the code when it gets none
+    diag_pos = np.where(np.char.startswith(codes, 'E'), 4, 3)
+    pos = np.where(is_diag, np.where(lengths > diag_pos, diag_pos, width + 1), np.minimum(lengths, 2))
+
+    #one column per character (numpy pads each string with zeros to the array's width), plus one for the period.
+    #characters after the period shift right by one
+    chars = np.zeros((len(codes), width + 1), dtype=np.uint32)
+    chars[:, :width] = np.ascontiguousarray(codes).view(np.uint32).reshape(len(codes), width)
+    cols = np.arange(width + 1)
+    out = np.take_along_axis(chars, np.where(cols < pos[:, None], cols, cols - 1), axis=1)
+    out[cols == pos[:, None]] = ord('.')
+    return out.view(np.dtype((np.str_, width + 1))).ravel()
+
 def load_code_descriptions(version='mimic3'):
     #load description lookup from the appropriate data files
     desc_dict = defaultdict(str)
@@ -286,19 +315,14 @@ def load_code_descriptions(version='mimic3'):
             r = csv.reader(descfile)
             #header
             next(r)
-            for row in r:
-                code = row[1]
-                desc = row[-1]
-                desc_dict[reformat(code, True)] = desc
+            rows = [(row[1], row[-1]) for row in r]
+        desc_dict.update(zip(reformat_codes([code for code, _ in rows], True).tolist(), [desc for _, desc in rows]))
         with open("%s/D_ICD_PROCEDURES.csv" % (DATA_DIR), 'r') as descfile:
             r = csv.reader(descfile)
             #header
             next(r)
-            for row in r:
-                code = row[1]
-                desc = row[-1]
-                if code not in desc_dict.keys():
-                    desc_dict[reformat(code, False)] = desc
+            rows = [(row[1], row[-1]) for row in r if row[1] not in desc_dict.keys()]
+        desc_dict.update(zip(reformat_codes([code for code, _ in rows], False).tolist(), [desc for _, desc in rows]))
         with open('%s/ICD9_descriptions' % DATA_DIR, 'r') as labelfile:
             for i,row in enumerate(labelfile):
                 row = row.rstrip().split()
@@ -9,7 +9,6 @@ import numpy as np
 import os
 import sys
 
-from sklearn.metrics import roc_curve, auc
 from tqdm import tqdm
 
 from constants import *
@@ -169,6 +168,8 @@ def micro_f1(yhatmic, ymic):
 def auc_metrics(yhat_raw, y, ymic):
     if yhat_raw.shape[0] <= 1:
         return
+    #sklearn takes a while to import, and only the AUC metrics need it
+    from sklearn.metrics import roc_curve, auc
     fpr = {}
     tpr = {}
     roc_auc = {}
@@ -0,0 +1,105 @@
+"""
+    Micro-benchmarks for model components
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from learn import models
+
+def time_it(fn, n_iter, gpu):
+    #one warmup call, then average over n_iter calls
+    fn()
+    if gpu:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_iter):
+        fn()
+    if gpu:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_iter
+
+def bench_multi_conv(filter_sizes, num_filter_maps, embed_size, batch_size, seq_len, n_iter, gpu=False, backward=True):
+    """
+        Compare the fused, kernel-padded convolution used by MultiConvAttnPool with one nn.Conv1d per filter width.
+        Checks both give the same outputs before timing them.
+    """
+    dicts = {'ind2w': {i+1: str(i) for i in range(10)}}
+    model = models.MultiConvAttnPool(1, None, filter_sizes, num_filter_maps, 0, gpu, dicts, embed_size=embed_size)
+    #separate convs holding the same weights as the fused one
+    convs = nn.ModuleList()
+    for i, size in enumerate(filter_sizes):
+        conv = nn.Conv1d(embed_size, num_filter_maps, kernel_size=size, padding=size // 2)
+        offset = max(filter_sizes) // 2 - size // 2
+        conv.weight.data = model.conv.weight.data[i*num_filter_maps:(i+1)*num_filter_maps, :, offset:offset+size].clone()
+        conv.bias.data = model.conv.bias.data[i*num_filter_maps:(i+1)*num_filter_maps].clone()
+        convs.append(conv)
+    x = torch.randn(batch_size, embed_size, seq_len, requires_grad=backward)
+    if gpu:
+        model.cuda()
+        convs.cuda()
+        x = x.cuda()
+
+    def fused():
+        out = F.conv1d(x, model.conv.weight * model.conv_mask, model.conv.bias, padding=model.conv.padding)
+        if backward:
+            out.sum().backward()
+        return out
+
+    def separate():
+        #outputs can differ in length by one for even widths, so trim to the shortest before concatenating
+        outs = [conv(x) for conv in convs]
+        min_len = min(out.size()[2] for out in outs)
+        out = torch.cat([out[:, :, :min_len] for out in outs], dim=1)
+        if backward:
+            out.sum().backward()
+        return out
+
+    with torch.no_grad():
+        f = F.conv1d(x, model.conv.weight * model.conv_mask, model.conv.bias, padding=model.conv.padding)
+        outs = [conv(x) for conv in convs]
+        min_len = min(out.size()[2] for out in outs)
+        s = torch.cat([out[:, :, :min_len] for out in outs], dim=1)
+        max_diff = (f[:, :, :min_len] - s).abs().max().item()
+
+    t_fused = time_it(fused, n_iter, gpu)
+    t_separate = time_it(separate, n_iter, gpu)
+    print("filter sizes %s, %d filter maps each, batch %d x %d tokens" % (','.join(str(s) for s in filter_sizes), num_filter_maps,
+                                                                          batch_size, seq_len))
+    print("max abs difference between fused and separate outputs: %g" % max_diff)
+    print("fused conv:     %.2f ms/iter" % (t_fused * 1000))
+    print("separate convs: %.2f ms/iter" % (t_separate * 1000))
+    print("speedup: %.2fx" % (t_separate / t_fused))
+    return t_fused, t_separate, max_diff
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark model components")
+    subparsers = parser.add_subparsers(dest="bench")
+    mc = subparsers.add_parser("multi_conv", help="fused multi-width convolution vs separate nn.Conv1d per width")
+    mc.add_argument("--filter-size", type=str, dest="filter_size", default="3,5,9",
+                    help="comma separated filter widths (default: 3,5,9)")
+    mc.add_argument("--num-filter-maps", type=int, dest="num_filter_maps", default=50,
+                    help="filter maps per width (default: 50)")
+    mc.add_argument("--embed-size", type=int, dest="embed_size", default=100, help="embedding dimension (default: 100)")
+    mc.add_argument("--batch-size", type=int, dest="batch_size", default=16, help="batch size (default: 16)")
+    mc.add_argument("--seq-len", type=int, dest="seq_len", default=2500, help="document length (default: 2500)")
+    mc.add_argument("--n-iter", type=int, dest="n_iter", default=20, help="timed iterations (default: 20)")
+    mc.add_argument("--forward-only", dest="forward_only", action="store_const", const=True,
+                    help="optional flag to time the forward pass only")
+    mc.add_argument("--gpu", dest="gpu", action="store_const", const=True, help="optional flag to use GPU")
+    args = parser.parse_args()
+    if args.bench == "multi_conv":
+        filter_sizes = [int(size) for size in args.filter_size.split(',')]
+        bench_multi_conv(filter_sizes, args.num_filter_maps, args.embed_size, args.batch_size, args.seq_len, args.n_iter,
+                         gpu=args.gpu, backward=not args.forward_only)
+    else:
+        parser.print_help()
@@ -0,0 +1,125 @@
+"""
+    Knowledge distillation: soft label scores from a frozen teacher model, cached on disk, and the loss that matches them
+"""
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+import datasets
+import learn.export as export
+
+def file_sha1(path, block_size=1<<24):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(teacher_path, data_path):
+    """
+        What the cached teacher scores depend on: the content of the teacher checkpoint, its params.json and the data file
+    """
+    params_file = os.path.join(os.path.dirname(os.path.abspath(teacher_path)), 'params.json')
+    return {'teacher': file_sha1(teacher_path), 'params': file_sha1(params_file) if os.path.exists(params_file) else None,
+            'data': file_sha1(data_path)}
+
+def load_cache_key(key_file):
+    if not os.path.exists(key_file):
+        return None
+    with open(key_file, 'r') as f:
+        return json.load(f)
+
+def read_hadm_ids(data_path):
+    #hadm ids of a data file, in the column data_generator reads them from
+    csv.field_size_limit(sys.maxsize)
+    with open(data_path, 'r') as f:
+        r = csv.reader(f)
+        next(r)
+        return [int(row[1]) for row in r]
+
+class TeacherScores:
+    """
+        Teacher logits for every document of a training file, looked up by hadm id.
+        The teacher runs over the file once, and its logits are cached as float16 next to the teacher checkpoint, so
+        all epochs (and later runs on the same file) reuse them. The cache is used only while the teacher checkpoint,
+        its params and the data file have the same content as when it was written.
+    """
+    def __init__(self, teacher_path, data_path, dicts, gpu=False, batch_size=16, version='mimic3'):
+        self.teacher_path = teacher_path
+        cache_base = '%s_teacher_%s' % (os.path.splitext(teacher_path)[0], os.path.splitext(os.path.basename(data_path))[0])
+        logits_file, hadm_file, codes_file = cache_base + '_logits.npy', cache_base + '_hadm.npy', cache_base + '_codes.npy'
+        key_file = cache_base + '_key.json'
+        key = cache_key(teacher_path, data_path)
+        if load_cache_key(key_file) == key and all(os.path.exists(f) for f in [logits_file, hadm_file, codes_file]):
+            print("loading cached teacher scores from %s" % logits_file)
+            logits, hadm_ids, codes = np.load(logits_file), np.load(hadm_file), np.load(codes_file)
+        else:
+            logits, hadm_ids, codes = self.score(data_path, gpu, batch_size, version)
+            np.save(logits_file, logits)
+            np.save(hadm_file, hadm_ids)
+            np.save(codes_file, codes)
+            #written last, so an interrupted run doesn't leave a key for partial scores
+            with open(key_file, 'w') as f:
+                json.dump(key, f, indent=1)
+            print("cached teacher scores to %s" % logits_file)
+
+        #put the teacher's label columns in the student's label order
+        t_c2ind = {c: i for i, c in enumerate(codes)}
+        missing = [c for c in dicts['c2ind'] if c not in t_c2ind]
+        if len(missing) > 0:
+            raise ValueError("teacher model has no output for %d of the student's codes, e.g. %s" % (len(missing), missing[0]))
+        cols = [t_c2ind[dicts['ind2c'][i]] for i in range(len(dicts['ind2c']))]
+        self.logits = logits[:, cols]
+        self.hadm2row = {int(hadm_id): i for i, hadm_id in enumerate(hadm_ids)}
+        #every training document needs teacher scores, so check before training starts rather than partway through an epoch
+        unscored = [hadm_id for hadm_id in read_hadm_ids(data_path) if hadm_id not in self.hadm2row]
+        if len(unscored) > 0:
+            raise ValueError("teacher scores in %s are missing %d documents of %s, e.g. hadm id %d. delete %s_* to re-score"
+                             % (logits_file, len(unscored), data_path, unscored[0], cache_base))
+
+    def score(self, data_path, gpu, batch_size, version):
+        """
+            Run the teacher over the training file, in its own vocab and label space
+        """
+        print("scoring %s with teacher model %s" % (data_path, self.teacher_path))
+        start = time.time()
+        model, t_dicts, _ = export.load_model(self.teacher_path)
+        if gpu:
+            model.cuda()
+        num_labels = len(t_dicts['ind2c'])
+        logits, hadm_ids = [], []
+        gen = datasets.data_generator(data_path, t_dicts, batch_size, num_labels, version=version)
+        with torch.no_grad():
+            for data, _, batch_hadm_ids, _, _, lengths in tqdm(gen):
+                data = torch.LongTensor(data)
+                if gpu:
+                    data = data.cuda()
+                output, _, _ = model(data, None, get_attention=False, lengths=lengths)
+                logits.append(output.float().cpu().numpy().astype(np.float16))
+                hadm_ids.extend(batch_hadm_ids)
+        print("teacher scored %d documents in %.1fs" % (len(hadm_ids), time.time() - start))
+        codes = np.array([t_dicts['ind2c'][i] for i in range(num_labels)])
+        return np.concatenate(logits, axis=0), np.array(hadm_ids, dtype=np.int64), codes
+
+    def soft_targets(self, hadm_ids, temp, gpu=False):
+        """
+            Teacher label probabilities at temperature temp for a batch
+        """
+        rows = [self.hadm2row[int(hadm_id)] for hadm_id in hadm_ids]
+        soft = torch.sigmoid(torch.from_numpy(self.logits[rows].astype(np.float32)) / temp)
+        return soft.cuda() if gpu else soft
+
+def distill_loss(output, soft, temp):
+    """
+        BCE between the student's and the teacher's label probabilities at temperature temp, scaled by temp^2 so its
+        gradients keep the same magnitude as the gold loss when the temperature changes
+    """
+    return F.binary_cross_entropy_with_logits(output.float() / temp, soft) * temp * temp
@@ -0,0 +1,160 @@
+"""
+    Export a trained model to a self-contained TorchScript or ONNX graph mapping token ids to label scores,
+    with the vocab and label map bundled, for inference processes that only need torch (or an ONNX runtime)
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from constants import *
+import datasets
+import learn.tools as tools
+
+class ScoringModule(nn.Module):
+    """
+        Inference wrapper: padded token ids (batch_size, seq_len) in, sigmoid label scores (batch_size, Y) out.
+        No loss, no attention and no description module.
+    """
+    def __init__(self, model):
+        super(ScoringModule, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        yhat, _, _ = self.model(x, None, get_attention=False)
+        return torch.sigmoid(yhat)
+
+def load_model(model_path, params_file=None, model_name=None):
+    """
+        Rebuild a trained model on the cpu from its saved state dict and the params.json next to it.
+        Returns the model in eval mode, the lookups and the params.
+    """
+    csv.field_size_limit(sys.maxsize)
+    if params_file is None:
+        params_file = os.path.join(os.path.dirname(os.path.abspath(model_path)), 'params.json')
+    params = tools.load_params(params_file)
+    #older params files don't record the model type
+    overrides = {'test_model': model_path, 'gpu': None}
+    if model_name is not None:
+        overrides['model'] = model_name
+    args = tools.args_from_params(params, **overrides)
+    if getattr(args, 'model', None) is None:
+        raise ValueError("%s doesn't record the model type, pass it with --model" % params_file)
+    dicts = datasets.load_lookups(args)
+    model = tools.pick_model(args, dicts)
+    model.eval()
+    return model, dicts, params
+
+def bundle(dicts, params):
+    """
+        The lookups an inference process needs, as json strings keyed by file name
+    """
+    codes = [dicts['ind2c'][i] for i in range(len(dicts['ind2c']))]
+    return {'vocab.json': json.dumps(dicts['w2ind']),
+            'labels.json': json.dumps(codes),
+            'params.json': json.dumps(params)}
+
+def example_input(dicts, batch_size=2, seq_len=100):
+    #random in-vocab ids, with the second document padded so tracing sees padding
+    x = torch.randint(1, len(dicts['ind2w']) + 1, (batch_size, seq_len))
+    if batch_size > 1:
+        x[1:, seq_len // 2:] = 0
+    return x
+
+def export_torchscript(scorer, dicts, params, out_file):
+    """
+        Trace the scoring module and save it with the vocab, label list and params as extra files
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(scorer, example_input(dicts), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, out_file, _extra_files=bundle(dicts, params))
+    return traced
+
+def export_onnx(scorer, dicts, params, out_file, opset=17):
+    """
+        Export the scoring module to ONNX with dynamic batch and length axes, storing the vocab, label list and params
+        as metadata properties of the graph
+    """
+    import onnx
+    with torch.no_grad():
+        torch.onnx.export(scorer, (example_input(dicts),), out_file, input_names=['ids'], output_names=['scores'],
+                          dynamic_axes={'ids': {0: 'batch_size', 1: 'seq_len'}, 'scores': {0: 'batch_size'}},
+                          opset_version=opset, dynamo=False)
+    graph = onnx.load(out_file)
+    for key, val in bundle(dicts, params).items():
+        prop = graph.metadata_props.add()
+        prop.key = key
+        prop.value = val
+    onnx.save(graph, out_file)
+
+def load_scripted(path):
+    """
+        Load an exported TorchScript model and its bundled lookups. Only needs torch.
+        Returns the module, the word->index map, the label list (index -> code) and the training params.
+    """
+    files = {'vocab.json': '', 'labels.json': '', 'params.json': ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=files)
+    w2ind = json.loads(files['vocab.json'])
+    codes = json.loads(files['labels.json'])
+    params = json.loads(files['params.json'])
+    return module, w2ind, codes, params
+
+def check_export(scorer, exported, dicts, batch_size=3, seq_len=157):
+    """
+        Compare exported and eager scores on a batch with a different shape than the one used for tracing
+    """
+    x = example_input(dicts, batch_size, seq_len)
+    with torch.no_grad():
+        ref = scorer(x)
+        out = exported(x)
+    return (ref - out).abs().max().item()
+
+def main(args):
+    start = time.time()
+    model, dicts, params = load_model(args.model_path, args.params, args.model)
+    if hasattr(model, 'init_hidden'):
+        #the rnn's initial state buffer is sized when traced, so size it for the largest batch up front
+        model.init_hidden(args.max_batch_size)
+    scorer = ScoringModule(model).eval()
+
+    ext = '.pt' if args.format == 'torchscript' else '.onnx'
+    out_file = args.out
+    if out_file is None:
+        out_file = os.path.splitext(args.model_path)[0] + ext
+
+    if args.format == 'torchscript':
+        export_torchscript(scorer, dicts, params, out_file)
+        exported, _, _, _ = load_scripted(out_file)
+        print("max abs difference from the eager model on an unseen input shape: %g" % check_export(scorer, exported, dicts))
+    else:
+        export_onnx(scorer, dicts, params, out_file, args.opset)
+    print("exported %s model to %s (%.1f MB) in %.1fs" % (args.format, out_file, os.path.getsize(out_file) / (1024. * 1024.),
+                                                          time.time() - start))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export a trained model to a standalone TorchScript or ONNX scoring graph")
+    parser.add_argument("model_path", type=str, help="path to a saved model_best_*.pth")
+    parser.add_argument("--params", type=str, required=False, dest="params",
+                        help="path to the params.json the model was trained with (default: the one next to the model)")
+    parser.add_argument("--model", type=str, choices=["cnn_vanilla", "rnn", "conv_attn", "multi_conv_attn", "logreg"], required=False,
+                        dest="model", help="model type, for params files that don't record it")
+    parser.add_argument("--format", type=str, choices=["torchscript", "onnx"], default="torchscript", dest="format",
+                        help="export format (default: torchscript)")
+    parser.add_argument("--out", type=str, required=False, dest="out",
+                        help="output file (default: the model path with a .pt or .onnx extension)")
+    parser.add_argument("--max-batch-size", type=int, required=False, dest="max_batch_size", default=64,
+                        help="largest batch the exported rnn model accepts (rnn only, default: 64)")
+    parser.add_argument("--opset", type=int, required=False, dest="opset", default=17,
+                        help="ONNX opset version (default: 17)")
+    args = parser.parse_args()
+    main(args)
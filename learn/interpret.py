@@ -9,7 +9,7 @@ import numpy as np
 
 import learn.models as models
 
-def save_samples(data, output, target_data, s, filter_size, tp_file, fp_file, dicts=None):
+def save_samples(data, output, target_data, s, filter_size, tp_file, fp_file, dicts=None, stride=1):
     """
         save important spans of text from attention
         INPUTS:
@@ -21,6 +21,7 @@ def save_samples(data, output, target_data, s, filter_size, tp_file, fp_file, di
             tp_file: opened file to write true positive results
             fp_file: opened file to write false positive results
             dicts: hold info for reporting results in human-readable form
+            stride: how many conv windows each attention position covers, if the model downsamples before attention
     """
     tgt_codes = np.where(target_data[0] == 1)[0]
     true_str = "Y_true: " + str(tgt_codes)
@@ -29,10 +30,13 @@ def save_samples(data, output, target_data, s, filter_size, tp_file, fp_file, di
     pred_str = "Y_pred: " + str(pred_codes)
     if dicts is not None:
         if s is not None and len(pred_codes) > 0:
-            important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, tp_file, fps=False)
-            important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, fp_file, fps=True)
+            important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, tp_file, fps=False,
+                            stride=stride)
+            important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, fp_file, fps=True,
+                            stride=stride)
 
-def important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, spans_file, fps=False):
+def important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size, true_str, pred_str, spans_file, fps=False,
+                    stride=1):
     """
         looks only at the first instance in the batch
     """
@@ -57,7 +61,7 @@ def important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size,
             attn = s[0][p_code].data.cpu().numpy()
             #merge overlapping intervals
             imps = attn.argsort()[-10:][::-1]
-            windows = make_windows(imps, filter_size, attn)
+            windows = make_windows(imps, filter_size, attn, stride)
             kgram_strs = []
             i = 0
             while len(kgram_strs) < 3 and i < len(windows):
@@ -73,8 +77,14 @@ def important_spans(data, output, tgt_codes, pred_codes, s, dicts, filter_size,
                     spans_file.write(kgram_str + "\n")
             spans_file.write('\n')
 
-def make_windows(starts, filter_size, attn):
-    starts = sorted(starts)
+def make_windows(starts, filter_size, attn, stride=1):
+    """
+        Merge the token spans of the most important attention positions into windows, sorted by decreasing importance.
+        With a downsampling stride, attention position i covers tokens i*stride to i*stride + stride + filter_size - 1.
+    """
+    positions = {start * stride: start for start in starts}
+    starts = sorted(positions.keys())
+    filter_size = filter_size + stride - 1
     windows = []
     overlaps_w_next = [starts[i+1] < starts[i] + filter_size for i in range(len(starts)-1)]
     overlaps_w_next.append(False)
@@ -90,6 +100,6 @@ def make_windows(starts, filter_size, attn):
         get_new_start = not overlaps
         i += 1
     #return windows sorted by decreasing importance
-    window_scores = {(start,end): attn[start] for (start,end) in windows}
+    window_scores = {(start,end): attn[positions[start]] for (start,end) in windows}
     window_scores = sorted(window_scores.items(), key=operator.itemgetter(1), reverse=True)
     return window_scores
@@ -0,0 +1,76 @@
+"""
+    Load generator for learn/serve.py: sends notes from a file to a running service from concurrent clients, then
+    reports client-side throughput and latency percentiles along with the service's own /stats
+"""
+import argparse
+from itertools import cycle, islice
+import json
+import os
+import sys
+import threading
+import time
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from learn.predict import read_notes
+
+def post(url, body):
+    request = Request(url, data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def client(url, notes, latencies, errors):
+    for note_id, text in notes:
+        start = time.time()
+        try:
+            post(url + '/predict', {'id': note_id, 'text': text})
+        except Exception as e:
+            errors.append(repr(e))
+            continue
+        latencies.append(time.time() - start)
+
+def main(args):
+    url = args.url.rstrip('/')
+    notes = list(islice(cycle(read_notes(args.notes, args.text_field, args.id_field)), args.num_requests))
+    #each client sends every concurrency-th note, one request at a time
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(url, notes[i::args.concurrency], latencies, errors))
+               for i in range(args.concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print("%d requests from %d clients in %.1fs: %.1f requests/sec, %d errors" % (len(latencies), args.concurrency, elapsed,
+          len(latencies) / elapsed if elapsed > 0 else 0., len(errors)))
+    if len(errors) > 0:
+        print("first error: %s" % errors[0])
+    if len(latencies) > 0:
+        latencies = np.array(latencies) * 1000.
+        print("client latency (ms): " + ", ".join("p%d %.1f" % (p, np.percentile(latencies, p)) for p in [50, 90, 95, 99]))
+    with urlopen(url + '/stats') as response:
+        print("service stats:")
+        print(json.dumps(json.loads(response.read().decode('utf-8')), indent=1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="send concurrent requests to a running learn/serve.py and report latency and throughput")
+    parser.add_argument("notes", type=str, help="CSV (with a header) or JSONL file of notes to send, cycled if there are fewer than --num-requests")
+    parser.add_argument("--url", type=str, required=False, dest="url", default="http://127.0.0.1:8000",
+                        help="address of the service (default: http://127.0.0.1:8000)")
+    parser.add_argument("--concurrency", type=int, required=False, dest="concurrency", default=16,
+                        help="number of clients sending requests at once (default: 16)")
+    parser.add_argument("--num-requests", type=int, required=False, dest="num_requests", default=1000,
+                        help="total number of single-note requests to send (default: 1000)")
+    parser.add_argument("--text-field", type=str, required=False, dest="text_field", default="TEXT",
+                        help="column or key holding the note text (default: TEXT)")
+    parser.add_argument("--id-field", type=str, required=False, dest="id_field", default="HADM_ID",
+                        help="column or key holding the note id (default: HADM_ID)")
+    args = parser.parse_args()
+    main(args)
@@ -1,13 +1,12 @@
 """
     Holds PyTorch models
 """
-from gensim.models import KeyedVectors
-from gensim.models import Word2Vec
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.init import xavier_uniform
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence
 
 import numpy as np
 
@@ -35,7 +34,7 @@ class BaseModel(nn.Module):
         #make embedding layer
         if embed_file:
             print("loading pretrained embeddings...")
-            W = torch.Tensor(extract_wvs.load_embeddings(embed_file))
+            W = torch.from_numpy(extract_wvs.load_embeddings(embed_file))
 
             self.embed = nn.Embedding(W.size()[0], W.size()[1], padding_idx=0)
             self.embed.weight.data = W.clone()
@@ -46,8 +45,11 @@ class BaseModel(nn.Module):
             
 
     def _get_loss(self, yhat, target, diffs=None, sim_reg=None, sub_reg=None):
-        #calculate the BCE
-        loss = F.binary_cross_entropy_with_logits(yhat, target)
+        #no loss when scoring unlabeled documents (e.g. exported inference graphs)
+        if target is None:
+            return None
+        #calculate the BCE, always in float32 even when the forward pass ran in bfloat16
+        loss = F.binary_cross_entropy_with_logits(yhat.float(), target)
         # torch.nn.BCEWithLogitsLoss(weight=None, size_average=True)https://pytorch.org/docs/0.3.1/nn.html?highlight=binary_cross_entropy_with_logits#torch.nn.BCEWithLogitsLoss
         
         #add description regularization loss if relevant
@@ -101,28 +103,50 @@ class BaseModel(nn.Module):
             diffs.append(self.lmbda*diff*bi.size()[0])
         return diffs
     
+    def position_mask(self, lengths, num_positions, conv, stride=1, device=None):
+        """
+            Mask (batch_size, num_positions) of the conv output positions each document has when it's scored on its
+            own, so positions past the end of a shorter document in a padded batch can be left out and its scores
+            don't depend on what it's batched with. stride is any downsampling applied after the conv.
+        """
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
+        num_valid = lengths + 2 * conv.padding[0] - conv.kernel_size[0] + 1
+        #downsampling keeps the last partial window. every document keeps at least one position
+        num_valid = ((num_valid + stride - 1) // stride).clamp(min=1)
+        positions = torch.arange(num_positions, device=lengths.device)
+        return positions.unsqueeze(0) < num_valid.unsqueeze(1)
+
     #todo: add semantic-based loss regularization [soon]
     def _calcultate_semantic_based_lossreg(self,):
         return "" 
         
 class BOWPool(BaseModel):
     """
-        Logistic regression model over average or max-pooled word vector input
+        Logistic regression model over sum, average or max-pooled word vector input.
+        Pooling is done by an embedding bag over a flat buffer of each document's real tokens with offsets,
+        so padding is never embedded or pooled.
     """
 
-    def __init__(self, Y, embed_file, lmbda, gpu, dicts, pool='max', embed_size=100, dropout=0.5, code_emb=None):
+    def __init__(self, Y, embed_file, lmbda, gpu, dicts, pool='avg', embed_size=100, dropout=0.5, code_emb=None):
         super(BOWPool, self).__init__(Y, embed_file, dicts, lmbda, dropout=dropout, gpu=gpu, embed_size=embed_size)
-        self.final = nn.Linear(embed_size, Y)
+        #swap the embedding layer for an embedding bag holding the same vectors
+        self.pool = 'mean' if pool in [None, 'avg'] else pool
+        W = self.embed.weight.data
+        self.embed = nn.EmbeddingBag(W.size()[0], W.size()[1], mode=self.pool)
+        self.embed.weight.data = W.clone()
+
+        self.final = nn.Linear(self.embed.weight.size()[1], Y)
         #for nn.Linear see https://pytorch.org/docs/0.3.1/nn.html?highlight=nn%20linear#torch.nn.Linear
         #the embed_size and Y define the weight matrix size.
         if code_emb:
             self._code_emb_init(code_emb, dicts)
         else:
             xavier_uniform(self.final.weight)
-        self.pool = pool
     
     #initialisation of the weight size as the code embeddings. -HD
     def _code_emb_init(self, code_emb, dicts):
+        #gensim is only needed to train with code embeddings, so it's imported here rather than at module load
+        from gensim.models import KeyedVectors
         code_embs = KeyedVectors.load_word2vec_format(code_emb)
         #classmethod load_word2vec_format(fname, fvocab=None, binary=False, encoding='utf8', unicode_errors='strict', limit=None, datatype=<class 'numpy.float32'>) 
         #Load the input-hidden weight matrix from the original C word2vec-tool format.
@@ -132,29 +156,27 @@ class BOWPool(BaseModel):
             weights[i] = code_embs[code]
         self.final.weight.data = torch.Tensor(weights).clone() # set weight as the code embeddings.
 
-    def forward(self, x, target, desc_data=None, get_attention=False):
-        #get embeddings and apply dropout
-        x = self.embed(x)
+    def forward(self, x, target, desc_data=None, get_attention=False, lengths=None):
+        if lengths is None:
+            #count non-pad tokens if the loader didn't supply lengths
+            lengths = (x != 0).sum(dim=1)
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=x.device)
+        #flatten the real tokens of the batch into one buffer, with offsets marking where each document starts
+        mask = torch.arange(x.size()[1], device=x.device).unsqueeze(0) < lengths.unsqueeze(1)
+        flat = x[mask]
+        offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(0)[:-1]])
+        #sum, mean or max of each document's word vectors, without materializing the padded batch of embeddings
+        x = self.embed(flat, offsets)
         #x = self.embed_drop(x) #also applying dropout here for logistic regression. -HD
-        #print('x', x) # to check the type of x. -HD
-        #x = x.transpose(0, 2)
-        #print('x-transposed', x) # to check x. -HD
-        if self.pool == 'max':
-            import pdb; pdb.set_trace() # this is for debugging -HD
-            x = F.max_pool1d(x)
-        else:
-            #x = F.avg_pool1d(x) # TypeError: avg_pool1d() missing 1 required positional argument: 'kernel_size'
-            #x = F.avg_pool1d(x, kernel_size=x.size()[2])
-            x = torch.mean(x,1)
-            #print('x-avg_pool1d',x)
-        logits = F.sigmoid(self.final(x)) # only using the pooled, document embedding for logistic regression. In this case, it is also possible to apply SVM for the task. -HD
-        #loss = self._get_loss(logits, target, diffs)
+        #logits go straight to the with-logits loss; the sigmoid is applied at prediction time
+        logits = self.final(x) # only using the pooled, document embedding for logistic regression. In this case, it is also possible to apply SVM for the task. -HD
         loss = self._get_loss(logits, target, diffs=desc_data)
         return logits, loss, None
 
 class ConvAttnPool(BaseModel):
 
-    def __init__(self, Y, embed_file, kernel_size, num_filter_maps, lmbda, gpu, dicts, embed_size=100, dropout=0.5, code_emb=None):
+    def __init__(self, Y, embed_file, kernel_size, num_filter_maps, lmbda, gpu, dicts, embed_size=100, dropout=0.5, code_emb=None,
+                 downsample=1, downsample_mode='max'):
         super(ConvAttnPool, self).__init__(Y, embed_file, dicts, lmbda, dropout=dropout, gpu=gpu, embed_size=embed_size)
 
         #initialize conv layer as in 2.1
@@ -193,6 +215,14 @@ class ConvAttnPool(BaseModel):
             self.label_fc1 = nn.Linear(num_filter_maps, num_filter_maps)
             xavier_uniform(self.label_fc1.weight)
 
+        #optional downsampling of the conv features by a stride, so label attention runs over seq_len/downsample positions
+        #either local max-pooling, or a learned strided conv
+        self.downsample = downsample
+        self.downsample_mode = downsample_mode
+        if downsample > 1 and downsample_mode == 'conv':
+            self.down_conv = nn.Conv1d(num_filter_maps, num_filter_maps, kernel_size=downsample, stride=downsample)
+            xavier_uniform(self.down_conv.weight)
+
     # def _code_emb_init(self, code_emb, dicts):
         # #code_embs = KeyedVectors.load_word2vec_format(code_emb)
         # code_embs = Word2Vec.load(code_emb)
@@ -203,6 +233,7 @@ class ConvAttnPool(BaseModel):
         # self.U.weight.data = torch.Tensor(weights).clone()
         # self.final.weight.data = torch.Tensor(weights).clone()
     def _code_emb_init(self, code_emb, dicts):
+        from gensim.models import Word2Vec
         #code_embs = KeyedVectors.load_word2vec_format(code_emb)
         code_embs = Word2Vec.load(code_emb)
         print(self.Y, code_embs.vector_size)
@@ -226,7 +257,11 @@ class ConvAttnPool(BaseModel):
         self.final.weight.data = torch.Tensor(weights).clone() # we want that similar labels have similar output values in the prediction.
         print("final layer and attention layer: code embedding initialized")
         
-    def forward(self, x, target, desc_data=None, get_attention=True, sim_data=None, sub_data=None):
+    def encode(self, x, lengths=None):
+        """
+            Embed and convolve a batch of token ids: (batch_size, seq_len) -> (batch_size, seq_len, num_filter_maps)
+            With lengths, padding past each document doesn't reach the downsampled features.
+        """
         #get embeddings and apply dropout
         x = self.embed(x)
         x = self.embed_drop(x)
@@ -237,10 +272,49 @@ class ConvAttnPool(BaseModel):
         #apply convolution and nonlinearity (tanh)
         x = F.tanh(self.conv(x).transpose(1,2))
         #print('x-conv-transposed-nonlinearity',x.shape)
-        
+
+        if self.downsample > 1:
+            if lengths is not None:
+                #features past the end of the document: zeros as the strided conv pads, and the tanh minimum for max
+                #pooling, so partial windows pool as they would without the batch's padding
+                fill = 0. if self.downsample_mode == 'conv' else -1.
+                x = x.masked_fill(~self.position_mask(lengths, x.size()[1], self.conv, device=x.device).unsqueeze(2), fill)
+            #position i now covers conv windows i*downsample to (i+1)*downsample-1. keep the last partial window
+            x = x.transpose(1, 2)
+            if self.downsample_mode == 'conv':
+                x = F.tanh(self.down_conv(F.pad(x, (0, (-x.size()[2]) % self.downsample))))
+            else:
+                x = F.max_pool1d(x, kernel_size=self.downsample, stride=self.downsample, ceil_mode=True)
+            x = x.transpose(1, 2)
+        return x
+
+    def attention_mask(self, lengths, num_positions, device=None):
+        #encoded positions within each document
+        return self.position_mask(lengths, num_positions, self.conv, self.downsample, device)
+
+    def attend(self, x, label_inds=None, mask=None):
+        """
+            Per-label attention and classification over encoded documents, for all labels or only those in label_inds.
+            label_inds is either a 1-d index shared by the batch, or a (batch_size, K) index per document.
+            mask (batch_size, seq_len), from attention_mask, marks the positions that can be attended to.
+            Returns the logits and attention, with one row per label scored.
+        """
+        final_weight, final_bias = self.final.weight, self.final.bias
+        if label_inds is not None:
+            final_weight, final_bias = final_weight[label_inds], final_bias[label_inds]
+            scores = self.U.weight[label_inds].matmul(x.transpose(1,2))
+        else:
+            #U's bias is the same at every position, so the softmax doesn't see it. calling the layer lets an int8
+            #U (see quantize.py) run its own kernel
+            scores = self.U(x).transpose(1,2)
         #apply attention
         #print('self.U.weight',self.U.weight.shape)
-        alpha = F.softmax(self.U.weight.matmul(x.transpose(1,2)), dim=2)
+        #softmax normalization in float32 for stability under bfloat16 autocast
+        scores = scores.float()
+        if mask is not None:
+            #no attention on padding
+            scores = scores.masked_fill(~mask.unsqueeze(1), float('-inf'))
+        alpha = F.softmax(scores, dim=2)
         #print('alpha',alpha.shape) #[torch.cuda.FloatTensor of size 16x8921x118 (GPU 0)] #this is really a large size of alpha! -HD
         #document representations are weighted sums using the attention. Can compute all at once as a matmul
         m = alpha.matmul(x)
@@ -248,8 +322,16 @@ class ConvAttnPool(BaseModel):
         
         #print('self.final.weight',self.final.weight.shape)
         #final layer classification
-        y = self.final.weight.mul(m).sum(dim=2).add(self.final.bias)
+        y = final_weight.mul(m).sum(dim=2).add(final_bias)
         #print('y',y) #[torch.cuda.FloatTensor of size 16x8921 (GPU 0)]
+        return y, alpha
+
+    def forward(self, x, target, desc_data=None, get_attention=True, sim_data=None, sub_data=None, lengths=None):
+        if lengths is None:
+            #count non-pad tokens if the loader didn't supply lengths
+            lengths = (x != 0).sum(dim=1)
+        x = self.encode(x, lengths)
+        y, alpha = self.attend(x, mask=self.attention_mask(lengths, x.size()[1], x.device))
 
         #an example here
         #x torch.Size([16, 117, 100])
@@ -283,6 +365,110 @@ class ConvAttnPool(BaseModel):
         return yhat, loss, alpha
 
 
+class MultiConvAttnPool(BaseModel):
+    """
+        Convolutional attention over several filter widths. All widths are computed in one fused convolution over the
+        shared embedding, with each width's kernels zero-padded (centered) to the widest filter.
+        Label attention is then done per width and max-pooled across widths, or, with stack_filters, done once over
+        the concatenated filter outputs.
+    """
+
+    def __init__(self, Y, embed_file, filter_sizes, num_filter_maps, lmbda, gpu, dicts, embed_size=100, dropout=0.5,
+                 stack_filters=False):
+        super(MultiConvAttnPool, self).__init__(Y, embed_file, dicts, lmbda, dropout=dropout, gpu=gpu, embed_size=embed_size)
+        self.filter_sizes = filter_sizes
+        self.num_filter_maps = num_filter_maps
+        self.stack_filters = stack_filters
+        num_sizes = len(filter_sizes)
+        max_size = max(filter_sizes)
+
+        #one conv layer holding the filters of every width, padded to the widest
+        self.conv = nn.Conv1d(self.embed_size, num_filter_maps*num_sizes, kernel_size=max_size, padding=int(floor(max_size/2)))
+        xavier_uniform(self.conv.weight)
+        #mask zeroing the taps outside each width, placed so each width sees the same window it would with its own
+        #conv padded by floor(size/2)
+        mask = torch.zeros(num_filter_maps*num_sizes, 1, max_size)
+        for i, size in enumerate(filter_sizes):
+            offset = int(floor(max_size/2)) - int(floor(size/2))
+            mask[i*num_filter_maps:(i+1)*num_filter_maps, :, offset:offset+size] = 1
+        self.register_buffer('conv_mask', mask)
+        self.conv.weight.data.mul_(mask)
+
+        if stack_filters:
+            #attention over the concatenated outputs of all widths
+            final_dim = num_filter_maps*num_sizes
+            self.U = nn.Linear(final_dim, Y)
+        else:
+            #separate attention context vectors for each width
+            final_dim = num_filter_maps
+            self.U = nn.Linear(num_filter_maps, Y*num_sizes)
+        self.final = nn.Linear(final_dim, Y)
+        xavier_uniform(self.U.weight)
+        xavier_uniform(self.final.weight)
+
+        #conv for label descriptions as in ConvAttnPool
+        if lmbda > 0:
+            W = self.embed.weight.data
+            self.desc_embedding = nn.Embedding(W.size()[0], W.size()[1], padding_idx=0)
+            self.desc_embedding.weight.data = W.clone()
+
+            self.label_conv = nn.Conv1d(self.embed_size, final_dim, kernel_size=max_size, padding=int(floor(max_size/2)))
+            xavier_uniform(self.label_conv.weight)
+
+            self.label_fc1 = nn.Linear(final_dim, final_dim)
+            xavier_uniform(self.label_fc1.weight)
+
+    def forward(self, x, target, desc_data=None, get_attention=True, lengths=None):
+        if lengths is None:
+            #count non-pad tokens if the loader didn't supply lengths
+            lengths = (x != 0).sum(dim=1)
+        #get embeddings and apply dropout
+        x = self.embed(x)
+        x = self.embed_drop(x)
+        x = x.transpose(1, 2)
+
+        #all filter widths in one pass, then nonlinearity. (batch_size, seq_len, num_filter_maps*num_sizes)
+        if self.conv_mask is not None:
+            x = F.conv1d(x, self.conv.weight * self.conv_mask, self.conv.bias, padding=self.conv.padding)
+        else:
+            #mask already folded into the weights (int8 models from quantize.py)
+            x = self.conv(x)
+        x = F.tanh(x.transpose(1,2))
+        #no attention on padding
+        pad = ~self.position_mask(lengths, x.size()[1], self.conv, device=x.device)
+
+        if self.stack_filters:
+            #U's bias is the same at every position, so the softmax doesn't see it
+            alpha = F.softmax(self.U(x).transpose(1,2).float().masked_fill(pad.unsqueeze(1), float('-inf')), dim=2)
+            m = alpha.matmul(x)
+        else:
+            #split out the widths: (batch_size, num_sizes, seq_len, num_filter_maps)
+            num_sizes = len(self.filter_sizes)
+            x = x.view(x.size()[0], x.size()[1], num_sizes, self.num_filter_maps).transpose(1, 2)
+            #attention for every width at once: (batch_size, num_sizes, Y, seq_len)
+            U = self.U.weight.view(num_sizes, self.Y, self.num_filter_maps)
+            alpha = F.softmax(U.matmul(x.transpose(2,3)).float().masked_fill(pad.unsqueeze(1).unsqueeze(1), float('-inf')), dim=3)
+            #max-pool the attended document representations across widths: (batch_size, Y, num_filter_maps)
+            m = alpha.matmul(x).max(dim=1)[0]
+            #strongest attention over the widths, for interpretation
+            alpha = alpha.max(dim=1)[0]
+
+        #final layer classification
+        y = self.final.weight.mul(m).sum(dim=2).add(self.final.bias)
+
+        if desc_data is not None:
+            #run descriptions through description module
+            b_batch = self.embed_descriptions(desc_data, self.gpu)
+            #get l2 similarity loss
+            diffs = self._compare_label_embeddings(target, b_batch, desc_data)
+        else:
+            diffs = None
+
+        yhat = y
+        loss = self._get_loss(yhat, target, diffs)
+        return yhat, loss, alpha
+
+
 class VanillaConv(BaseModel):
 
     def __init__(self, Y, embed_file, kernel_size, num_filter_maps, gpu=True, dicts=None, embed_size=100, dropout=0.5, code_emb=None):
@@ -309,6 +495,7 @@ class VanillaConv(BaseModel):
             #print("final layer: xavier uniform initialized")
     
     def _code_emb_init(self, code_emb, dicts):
+        from gensim.models import Word2Vec
         #code_embs = KeyedVectors.load_word2vec_format(code_emb)
         code_embs = Word2Vec.load(code_emb)
         print(self.Y, code_embs.vector_size)
@@ -330,7 +517,10 @@ class VanillaConv(BaseModel):
         self.fc.weight.data = torch.Tensor(weights).clone()
         print("final layer: code embedding initialized")
         
-    def forward(self, x, target, desc_data=None, get_attention=False):
+    def forward(self, x, target, desc_data=None, get_attention=False, lengths=None):
+        if lengths is None:
+            #count non-pad tokens if the loader didn't supply lengths
+            lengths = (x != 0).sum(dim=1)
         #print('calling the forward function now')
         #embed
         x = self.embed(x)
@@ -341,12 +531,15 @@ class VanillaConv(BaseModel):
         #conv/max-pooling
         c = self.conv(x)
         #print('c',c.shape) # (batch_size,num_filter_maps,(doc_length-kernel_size+1)/stride)
+        #windows past the end of the document don't take part in the max
+        c = F.tanh(c).masked_fill(~self.position_mask(lengths, c.size()[2], self.conv, device=c.device).unsqueeze(1), float('-inf'))
         if get_attention:
             #get argmax vector too
-            x, argmax = F.max_pool1d(F.tanh(c), kernel_size=c.size()[2], return_indices=True)
+            x, argmax = F.max_pool1d(c, kernel_size=c.size()[2], return_indices=True)
             attn = self.construct_attention(argmax, c.size()[2]) # 'fake' attention from the vanilla CNN for explanation -HD
         else:
-            x = F.max_pool1d(F.tanh(c), kernel_size=c.size()[2])
+            #max over the time dimension directly, so traced graphs don't fix the pooling kernel to one length
+            x = c.max(dim=2, keepdim=True)[0]
             #print('x-pooled',x.shape)
             attn = None
         x = x.squeeze(dim=2)
@@ -369,32 +562,24 @@ class VanillaConv(BaseModel):
         return yhat, loss, attn
 
     def construct_attention(self, argmax, num_windows):
-        attn_batches = []
-        for argmax_i in argmax:
-            attns = []
-            for i in range(num_windows):
-                #generate mask to select indices of conv features where max was i
-                mask = (argmax_i == i).repeat(1,self.Y).t()
-                #apply mask to every label's weight vector and take the sum to get the 'attention' score
-                weights = self.fc.weight[mask].view(-1,self.Y)
-                if len(weights.size()) > 0:
-                    window_attns = weights.sum(dim=0)
-                    attns.append(window_attns)
-                else:
-                    #this window was never a max
-                    attns.append(Variable(torch.zeros(self.Y)).cuda())
-            #combine
-            attn = torch.stack(attns)
-            attn_batches.append(attn)
-        attn_full = torch.stack(attn_batches)
-        #put it in the right form for passing to interpret
-        attn_full = attn_full.transpose(1,2)
-        return attn_full
+        """
+            'Attention' for the vanilla CNN: the score of window i for a label is the sum of that label's final layer
+            weights over the filters whose max was at window i.
+            Done for the whole batch at once by scattering the max indices into a one-hot and reducing with a matmul.
+        """
+        #one-hot of where each filter hit its max: (batch_size, num_filter_maps, num_windows)
+        argmax = argmax.view(argmax.size(0), -1, 1)
+        onehot = torch.zeros(argmax.size(0), argmax.size(1), num_windows, dtype=self.fc.weight.dtype, device=argmax.device)
+        onehot.scatter_(2, argmax, 1)
+        #sum each label's weights over the filters that hit their max at each window: (batch_size, Y, num_windows)
+        return self.fc.weight.matmul(onehot)
 
 
 class VanillaRNN(BaseModel):
     """
-        General RNN - can be LSTM or GRU, uni/bi-directional
+        General RNN - can be LSTM or GRU, uni/bi-directional, any number of layers.
+        Runs over packed variable-length sequences, so no compute is spent on padding and the final hidden state
+        is read at each document's last real token.
     """
 
     def __init__(self, Y, embed_file, dicts, rnn_dim, cell_type, num_layers, gpu, embed_size=100, bidirectional=False):
@@ -404,54 +589,47 @@ class VanillaRNN(BaseModel):
         self.cell_type = cell_type
         self.num_layers = num_layers
         self.num_directions = 2 if bidirectional else 1
+        hidden_dim = floor(self.rnn_dim/self.num_directions)
 
         #recurrent unit
         if self.cell_type == 'lstm':
-            self.rnn = nn.LSTM(self.embed_size, floor(self.rnn_dim/self.num_directions), self.num_layers, bidirectional=bidirectional)
+            self.rnn = nn.LSTM(self.embed_size, hidden_dim, self.num_layers, bidirectional=bool(bidirectional))
         else:
-            self.rnn = nn.GRU(self.embed_size, floor(self.rnn_dim/self.num_directions), self.num_layers, bidirectional=bidirectional)
+            self.rnn = nn.GRU(self.embed_size, hidden_dim, self.num_layers, bidirectional=bool(bidirectional))
         #linear output
-        self.final = nn.Linear(self.rnn_dim, Y)
+        self.final = nn.Linear(hidden_dim*self.num_directions, Y)
 
-        #arbitrary initialization
-        self.batch_size = 16
-        self.hidden = self.init_hidden()
+        #zero initial hidden state, kept as a buffer that grows with the batch size instead of being reallocated
+        #for every batch. not saved with the model
+        self.register_buffer('h0', torch.zeros(self.num_directions*self.num_layers, 16, hidden_dim), persistent=False)
 
-    def forward(self, x, target, desc_data=None, get_attention=False):
-        #clear hidden state, reset batch size at the start of each batch
-        self.refresh(x.size()[0])
+    def forward(self, x, target, desc_data=None, get_attention=False, lengths=None):
+        batch_size = x.size()[0]
+        if lengths is None:
+            #count non-pad tokens if the loader didn't supply lengths
+            lengths = (x != 0).sum(dim=1)
+        #packing needs lengths on the cpu, and at least one step per document
+        lengths = torch.as_tensor(lengths, dtype=torch.long).cpu().clamp(min=1)
 
-        #embed
+        #embed and pack
         embeds = self.embed(x).transpose(0,1)
+        packed = pack_padded_sequence(embeds, lengths, enforce_sorted=False)
         #apply RNN
-        out, self.hidden = self.rnn(embeds, self.hidden)
+        _, hidden = self.rnn(packed, self.init_hidden(batch_size))
 
-        #get final hidden state in the appropriate way
-        last_hidden = self.hidden[0] if self.cell_type == 'lstm' else self.hidden
-        last_hidden = last_hidden[-1] if self.num_directions == 1 else last_hidden[-2:].transpose(0,1).contiguous().view(self.batch_size, -1)
+        #get final hidden state of the last layer in the appropriate way. it comes back in the original batch order
+        last_hidden = hidden[0] if self.cell_type == 'lstm' else hidden
+        last_hidden = last_hidden[-1] if self.num_directions == 1 else last_hidden[-2:].transpose(0,1).contiguous().view(batch_size, -1)
         #apply linear layer and sigmoid to get predictions
         yhat = self.final(last_hidden)
         loss = self._get_loss(yhat, target)
         return yhat, loss, None
 
-    def init_hidden(self):
-        if self.gpu:
-            h_0 = Variable(torch.cuda.FloatTensor(self.num_directions*self.num_layers, self.batch_size,
-                                                  floor(self.rnn_dim/self.num_directions)).zero_())
-            if self.cell_type == 'lstm':
-                c_0 = Variable(torch.cuda.FloatTensor(self.num_directions*self.num_layers, self.batch_size,
-                                                      floor(self.rnn_dim/self.num_directions)).zero_())
-                return (h_0, c_0)
-            else:
-                return h_0
+    def init_hidden(self, batch_size):
+        if self.h0.size()[1] < batch_size:
+            self.h0 = self.h0.new_zeros(self.h0.size()[0], batch_size, self.h0.size()[2])
+        h_0 = self.h0[:, :batch_size]
+        if self.cell_type == 'lstm':
+            return (h_0, h_0)
         else:
-            h_0 = Variable(torch.zeros(self.num_directions*self.num_layers, self.batch_size, floor(self.rnn_dim/self.num_directions)))
-            if self.cell_type == 'lstm':
-                c_0 = Variable(torch.zeros(self.num_directions*self.num_layers, self.batch_size, floor(self.rnn_dim/self.num_directions)))
-                return (h_0, c_0)
-            else:
-                return h_0
-
-    def refresh(self, batch_size):
-        self.batch_size = batch_size
-        self.hidden = self.init_hidden()
+            return h_0
@@ -0,0 +1,186 @@
+"""
+    Score unlabeled notes with a trained model: tokenize raw (or pre-tokenized) notes from a CSV or JSONL file,
+    encode them with the saved vocab, and stream the top-k codes with scores for each note to a JSONL file
+"""
+import argparse
+import csv
+import itertools
+import json
+from multiprocessing import Pool
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from constants import *
+from dataproc import get_discharge_summaries
+import learn.export as export
+
+def read_notes(path, text_field, id_field):
+    """
+        Yield (note id, text) from a CSV file with a header, or a JSONL file with one object per line.
+        Notes without an id field are numbered by position.
+    """
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        with open(path, 'r') as f:
+            for i, line in enumerate(f):
+                if line.strip() != '':
+                    rec = json.loads(line)
+                    yield rec.get(id_field, i), rec[text_field]
+    else:
+        csv.field_size_limit(sys.maxsize)
+        with open(path, 'r') as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                yield row.get(id_field, i), row[text_field]
+
+#vocab for the worker processes, set once per worker by init_worker
+_w2ind = None
+_tokenized = False
+
+def init_worker(w2ind, tokenized):
+    global _w2ind, _tokenized
+    _w2ind = w2ind
+    _tokenized = tokenized
+
+def encode(text, w2ind, tokenized=False):
+    """
+        Tokenize a note as get_discharge_summaries does (unless it already is) and map it to vocab indices as
+        datasets.data_generator does: OOV words get index len(vocab)+1 and notes are truncated to MAX_LENGTH
+    """
+    tokens = text.split() if tokenized else get_discharge_summaries.tokenize(text)
+    unk = len(w2ind) + 1
+    return [int(w2ind.get(w, unk)) for w in tokens[:MAX_LENGTH]]
+
+def encode_note(note):
+    note_id, text = note
+    return note_id, encode(text, _w2ind, _tokenized)
+
+class Scorer:
+    """
+        Scores batches of encoded notes with either a saved model (model_best_*.pth with its params.json) or a
+        TorchScript export from learn/export.py
+    """
+    def __init__(self, model_path, params_file=None, gpu=False):
+        self.gpu = gpu
+        if model_path.endswith('.pt'):
+            self.model, self.w2ind, self.codes, params = export.load_scripted(model_path)
+            self.scripted = True
+        else:
+            self.model, dicts, params = export.load_model(model_path, params_file)
+            self.w2ind = dicts['w2ind']
+            self.codes = [dicts['ind2c'][i] for i in range(len(dicts['ind2c']))]
+            self.scripted = False
+        if gpu:
+            self.model.cuda()
+        #convolutions without padding need at least a filter's width of input
+        self.min_length = max([int(size) for size in str(params.get('filter_size', 1)).split(',')])
+
+    def score(self, docs):
+        """
+            Label scores (num_docs, Y) for a list of encoded notes, padded to the longest one
+        """
+        lengths = np.array([len(doc) for doc in docs])
+        x = np.zeros((len(docs), max(lengths.max(), self.min_length)), dtype=np.int64)
+        for i, doc in enumerate(docs):
+            x[i, :len(doc)] = doc
+        x = torch.from_numpy(x)
+        if self.gpu:
+            x = x.cuda()
+        with torch.no_grad():
+            if self.scripted:
+                scores = self.model(x)
+            else:
+                yhat, _, _ = self.model(x, None, get_attention=False, lengths=lengths)
+                scores = torch.sigmoid(yhat.float())
+        return scores.cpu().numpy()
+
+def top_k(scores, codes, k):
+    inds = np.argsort(-scores)[:k]
+    return [{'code': codes[i], 'score': round(float(scores[i]), 6)} for i in inds]
+
+def score_window(scorer, window, batch_size, k):
+    """
+        Score a window of (note id, encoded note) in length-sorted batches to keep padding low, and return the
+        results in the window's original order
+    """
+    order = sorted(range(len(window)), key=lambda i: len(window[i][1]))
+    results = [None] * len(window)
+    for start in range(0, len(order), batch_size):
+        inds = order[start:start+batch_size]
+        scores = scorer.score([window[i][1] for i in inds])
+        for i, s in zip(inds, scores):
+            results[i] = {'id': window[i][0], 'codes': top_k(s, scorer.codes, k)}
+    return results
+
+def encode_windows(pool, notes, window_size, workers):
+    """
+        Encode notes in the worker pool a window at a time, yielding each window of (note id, encoded note) in order.
+        Only the next window is read and encoded ahead while the caller scores the current one, so memory stays
+        bounded however large the input is.
+    """
+    chunksize = max(1, window_size // (4 * workers))
+    pending = None
+    for raw in iter(lambda: list(itertools.islice(notes, window_size)), []):
+        job = pool.map_async(encode_note, raw, chunksize=chunksize)
+        if pending is not None:
+            yield pending.get()
+        pending = job
+    if pending is not None:
+        yield pending.get()
+
+def main(args):
+    start = time.time()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    scorer = Scorer(args.model_path, args.params, args.gpu)
+    print("loaded model in %.1fs" % (time.time() - start))
+
+    start = time.time()
+    num_notes = 0
+    window_size = args.batch_size * args.sort_window
+    notes = read_notes(args.notes, args.text_field, args.id_field)
+    with Pool(args.workers, initializer=init_worker, initargs=(scorer.w2ind, args.tokenized)) as pool, \
+         open(args.out, 'w') as outfile:
+        #tokenizing and encoding runs in the workers while this process scores
+        for window in encode_windows(pool, notes, window_size, args.workers):
+            for result in score_window(scorer, window, args.batch_size, args.top_k):
+                outfile.write(json.dumps(result) + '\n')
+            num_notes += len(window)
+            print("%d notes, %.1f notes/sec" % (num_notes, num_notes / (time.time() - start)))
+    elapsed = time.time() - start
+    print("scored %d notes in %.1fs: %.1f notes/sec. wrote predictions to %s" % (num_notes, elapsed,
+          num_notes / elapsed if elapsed > 0 else 0., args.out))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="score unlabeled notes with a trained model")
+    parser.add_argument("model_path", type=str, help="path to a saved model_best_*.pth, or a TorchScript .pt from learn/export.py")
+    parser.add_argument("notes", type=str, help="CSV (with a header) or JSONL file of notes")
+    parser.add_argument("out", type=str, help="JSONL file to write the top-k codes and scores for each note to")
+    parser.add_argument("--params", type=str, required=False, dest="params",
+                        help="path to the params.json the model was trained with (default: the one next to the model)")
+    parser.add_argument("--text-field", type=str, required=False, dest="text_field", default="TEXT",
+                        help="column or key holding the note text (default: TEXT)")
+    parser.add_argument("--id-field", type=str, required=False, dest="id_field", default="HADM_ID",
+                        help="column or key holding the note id, numbered by position if missing (default: HADM_ID)")
+    parser.add_argument("--tokenized", dest="tokenized", action="store_const", required=False, const=True,
+                        help="optional flag for notes already tokenized as by get_discharge_summaries (just split on whitespace)")
+    parser.add_argument("--top-k", type=int, required=False, dest="top_k", default=10,
+                        help="number of codes to output per note (default: 10)")
+    parser.add_argument("--batch-size", type=int, required=False, dest="batch_size", default=64,
+                        help="notes per forward pass (default: 64)")
+    parser.add_argument("--sort-window", type=int, required=False, dest="sort_window", default=16,
+                        help="number of batches to read ahead and sort by length before scoring (default: 16)")
+    parser.add_argument("--workers", type=int, required=False, dest="workers", default=max(1, os.cpu_count() // 2),
+                        help="processes for tokenizing and encoding notes (default: half the cpus)")
+    parser.add_argument("--threads", type=int, required=False, dest="threads",
+                        help="torch threads for scoring (default: torch's own default)")
+    parser.add_argument("--gpu", dest="gpu", action="store_const", required=False, const=True,
+                        help="optional flag to use GPU if available")
+    args = parser.parse_args()
+    main(args)
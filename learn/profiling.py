@@ -0,0 +1,224 @@
+"""
+    Per-phase timing and throughput telemetry for the training and testing loops
+"""
+from collections import OrderedDict
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+class StepProfiler:
+    """
+        Accumulates wall time per phase (data loading, tensor conversion, forward, backward, optimizer step, metrics,
+        persistence) along with document/token counts for one pass over a file, then appends a summary line to a
+        JSONL file in the model directory.
+        Memory is reported per record: the peak resident set size sampled at every phase boundary and batch (so
+        short-lived spikes inside a phase can be missed), and on gpu the peak allocated cuda memory. The peak RSS of
+        the whole process so far is reported separately.
+        Optionally records a torch profiler trace for a window of training steps.
+    """
+    def __init__(self, out_file=None, trace_steps=None, trace_dir=None, gpu=False):
+        self.out_file = out_file
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.gpu = gpu
+        self.trace_done = False
+        self._trace = None
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()
+        self.num_docs = 0
+        self.num_tokens = 0
+        self.num_positions = 0
+        self.num_batches = 0
+        self.peak_rss = None
+        if self.gpu:
+            torch.cuda.reset_peak_memory_stats()
+        self.start_time = time.time()
+        self.sample_memory()
+
+    def start(self, epoch, mode):
+        """
+            Begin a new record, e.g. mode='train' for a training epoch or mode='dev' for evaluation
+        """
+        self.epoch = epoch
+        self.mode = mode
+        self.reset()
+
+    def phase(self, name):
+        return _PhaseTimer(self, name)
+
+    def add_time(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.) + elapsed
+
+    def sample_memory(self):
+        rss = current_rss_mb()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def timed_iter(self, gen, name='data'):
+        """
+            Wrap a batch generator so the time spent producing each batch (CSV parsing, lookups, padding) is recorded
+        """
+        it = iter(gen)
+        while True:
+            t = time.time()
+            try:
+                tup = next(it)
+            except StopIteration:
+                self.add_time(name, time.time() - t)
+                return
+            self.add_time(name, time.time() - t)
+            self.sample_memory()
+            yield tup
+
+    def count_batch(self, data, lengths=None):
+        """
+            Record docs, real (non-pad) tokens and total padded positions of a batch of token ids
+        """
+        self.num_batches += 1
+        self.num_docs += data.shape[0]
+        self.num_positions += data.shape[0] * data.shape[1] if len(data.shape) > 1 else 0
+        if lengths is not None:
+            self.num_tokens += int(np.sum(lengths))
+        else:
+            self.num_tokens += int(np.count_nonzero(data))
+
+    def step(self, batch_idx):
+        """
+            Start or stop the torch profiler trace when the training loop reaches the chosen step window.
+            The trace is only recorded once per run.
+        """
+        if self.trace_steps is None or self.trace_done:
+            return
+        start, end = self.trace_steps
+        if batch_idx == start and self._trace is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.gpu:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._trace.__enter__()
+        elif batch_idx == end and self._trace is not None:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self._trace is None:
+            return
+        self._trace.__exit__(None, None, None)
+        trace_file = os.path.join(self.trace_dir, 'trace_%s_%d.json' % (self.mode, self.epoch))
+        self._trace.export_chrome_trace(trace_file)
+        print("wrote profiler trace to %s" % trace_file)
+        self._trace = None
+        self.trace_done = True
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        rec = OrderedDict()
+        rec['epoch'] = self.epoch
+        rec['mode'] = self.mode
+        rec['wall_time'] = elapsed
+        rec['phases'] = OrderedDict((name, t) for name, t in self.phases.items())
+        rec['batches'] = self.num_batches
+        rec['docs'] = self.num_docs
+        rec['tokens'] = self.num_tokens
+        rec['docs_per_sec'] = self.num_docs / elapsed if elapsed > 0 else 0.
+        rec['tokens_per_sec'] = self.num_tokens / elapsed if elapsed > 0 else 0.
+        rec['padding_ratio'] = 1. - self.num_tokens / float(self.num_positions) if self.num_positions > 0 else 0.
+        self.sample_memory()
+        rec['peak_rss_mb'] = self.peak_rss
+        rec['process_peak_rss_mb'] = peak_rss_mb()
+        if self.gpu:
+            rec['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / (1024. * 1024.)
+        return rec
+
+    def finish(self):
+        """
+            Write the current record to the JSONL file (if any) and return it
+        """
+        #make sure a trace window that ran past the end of an epoch still gets written
+        self.stop_trace()
+        rec = self.summary()
+        if self.out_file is not None:
+            with open(self.out_file, 'a') as f:
+                f.write(json.dumps(rec) + "\n")
+        if rec['docs'] > 0:
+            print("[PROFILE] %s epoch %d: %.1f docs/sec, %.1f tokens/sec, padding ratio %.3f" %
+                  (rec['mode'], rec['epoch'], rec['docs_per_sec'], rec['tokens_per_sec'], rec['padding_ratio']))
+        memory = []
+        if rec['peak_rss_mb'] is not None:
+            memory.append("peak rss %.1f MB" % rec['peak_rss_mb'])
+        if 'peak_cuda_mb' in rec:
+            memory.append("peak cuda %.1f MB" % rec['peak_cuda_mb'])
+        memory.append("process lifetime peak rss %.1f MB" % rec['process_peak_rss_mb'])
+        print("[PROFILE] " + ", ".join(memory))
+        print("[PROFILE] " + ", ".join(["%s: %.2fs" % (name, t) for name, t in rec['phases'].items()]))
+        return rec
+
+class _PhaseTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.gpu:
+            #cuda kernels are asynchronous, so wait for them to get honest per-phase times
+            torch.cuda.synchronize()
+        self.t = time.time()
+
+    def __exit__(self, *exc):
+        if self.profiler.gpu:
+            torch.cuda.synchronize()
+        self.profiler.add_time(self.name, time.time() - self.t)
+        self.profiler.sample_memory()
+        return False
+
+class NullProfiler:
+    """
+        Drop-in profiler that records nothing, so the loops don't need to check whether profiling is on
+    """
+    def start(self, epoch, mode):
+        pass
+
+    def phase(self, name):
+        return _NullPhase()
+
+    def timed_iter(self, gen, name='data'):
+        return gen
+
+    def count_batch(self, data, lengths=None):
+        pass
+
+    def step(self, batch_idx):
+        pass
+
+    def finish(self):
+        return None
+
+class _NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+def current_rss_mb():
+    #current resident set size from /proc (linux only), None where that isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / (1024. * 1024.)
+
+def peak_rss_mb():
+    #peak resident set size over the whole life of the process, not just the current record.
+    #ru_maxrss is in kilobytes on linux and bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / (1024. * 1024.)
+    return rss / 1024.
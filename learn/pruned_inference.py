@@ -0,0 +1,305 @@
+"""
+    Pruned inference for ConvAttnPool, which runs label attention only for a subset of codes per document:
+        hierarchy: score the coarse ICD-9 code categories first, and keep the codes under categories that pass a threshold
+        shortlist: keep the top K codes of a cheap max-pooled pass (conv features dotted with the final layer)
+    Reports what each setting costs in recall against full scoring.
+"""
+import argparse
+from collections import OrderedDict
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from constants import *
+import datasets
+import evaluation
+import learn.export as export
+import learn.models as models
+import learn.tools as tools
+
+def code_category(code):
+    """
+        ICD-9 category of a code formatted by datasets.reformat, marked 'd' for diagnoses and 'p' for procedures.
+        Diagnosis codes have the dot after three characters (four for E codes) and procedure codes after two.
+    """
+    pos = code.find('.')
+    base = code if pos < 0 else code[:pos]
+    return ('p' if pos == 2 else 'd') + base
+
+def build_hierarchy(ind2c):
+    """
+        Group the label space by category.
+        Returns the category names, the label indices under each category and the category index of every label.
+    """
+    Y = len(ind2c)
+    categories = sorted(set(code_category(ind2c[i]) for i in range(Y)))
+    cat2ind = {cat: i for i, cat in enumerate(categories)}
+    code2cat = np.array([cat2ind[code_category(ind2c[i])] for i in range(Y)])
+    members = [np.where(code2cat == i)[0] for i in range(len(categories))]
+    return categories, members, code2cat
+
+class CategoryHeads(nn.Module):
+    """
+        Label attention heads for code categories, over the features of a trained ConvAttnPool's encoder.
+        Each head starts from the mean attention and output vectors of the codes in its category.
+    """
+    def __init__(self, model, members):
+        super(CategoryHeads, self).__init__()
+        self.U = nn.Parameter(torch.stack([model.U.weight.data[inds].mean(0) for inds in members]))
+        self.final_weight = nn.Parameter(torch.stack([model.final.weight.data[inds].mean(0) for inds in members]))
+        self.final_bias = nn.Parameter(torch.stack([model.final.bias.data[inds].mean() for inds in members]))
+
+    def forward(self, x, mask=None):
+        """
+            Category logits for encoded documents. mask (batch_size, seq_len), from the model's attention_mask, marks
+            the positions that can be attended to.
+        """
+        scores = self.U.matmul(x.transpose(1,2)).float()
+        if mask is not None:
+            #no attention on padding
+            scores = scores.masked_fill(~mask.unsqueeze(1), float('-inf'))
+        alpha = F.softmax(scores, dim=2)
+        m = alpha.matmul(x)
+        return self.final_weight.mul(m).sum(dim=2).add(self.final_bias)
+
+def fit_heads(model, heads, code2cat, data_path, dicts, n_epochs, batch_size, lr, gpu, version):
+    """
+        Train the category heads on the training set with the model's encoder frozen.
+        A category is positive for a document if any of its codes is.
+    """
+    membership = torch.zeros(len(code2cat), len(heads.final_bias))
+    membership[torch.arange(len(code2cat)), torch.from_numpy(code2cat)] = 1
+    if gpu:
+        membership = membership.cuda()
+    optimizer = torch.optim.Adam(heads.parameters(), lr=lr)
+    model.eval()
+    heads.train()
+    for epoch in range(n_epochs):
+        losses = []
+        gen = datasets.data_generator(data_path, dicts, batch_size, len(dicts['ind2c']), version=version)
+        for data, target, _, _, _, lengths in tqdm(gen):
+            data, target = torch.LongTensor(data), torch.FloatTensor(target)
+            if gpu:
+                data, target = data.cuda(), target.cuda()
+            with torch.no_grad():
+                x = model.encode(data, lengths)
+                mask = model.attention_mask(lengths, x.size()[1], x.device)
+            cat_target = (target.matmul(membership) > 0).float()
+            optimizer.zero_grad()
+            loss = F.binary_cross_entropy_with_logits(heads(x, mask), cat_target)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        print("category heads epoch %d loss: %.6f" % (epoch, np.mean(losses)))
+    heads.eval()
+
+def score_pruned(model, heads, code2cat, x, threshold, mask=None):
+    """
+        Score encoded documents with label attention only for the codes whose category score passes threshold.
+        Codes that aren't evaluated get a score of 0. Returns the scores and the mask of evaluated codes.
+    """
+    cat_scores = torch.sigmoid(heads(x, mask))
+    code2cat = torch.from_numpy(code2cat).to(x.device)
+    scores = torch.zeros(x.size()[0], len(code2cat), device=x.device)
+    evaluated = (cat_scores > threshold)[:, code2cat]
+    num_evaluated = int(evaluated.sum(dim=1).max())
+    if num_evaluated == 0:
+        return scores, evaluated
+    #each document's evaluated codes first, padded to the longest list with codes that aren't evaluated
+    label_inds = evaluated.int().sort(dim=1, descending=True, stable=True)[1][:, :num_evaluated]
+    y, _ = model.attend(x, label_inds, mask)
+    #the padding codes are written back as 0
+    scores.scatter_(1, label_inds, torch.sigmoid(y.float()) * evaluated.gather(1, label_inds))
+    return scores, evaluated
+
+def shortlist_scores(model, x, mask=None):
+    """
+        Cheap label scores for encoded documents: the max-pooled conv features dotted with the final layer, as in
+        VanillaConv. Costs O(Y*D) per document instead of label attention's O(Y*L*D).
+    """
+    if mask is not None:
+        #padding doesn't take part in the max
+        x = x.masked_fill(~mask.unsqueeze(2), float('-inf'))
+    return model.final(x.max(dim=1)[0])
+
+def score_shortlist(model, x, k, mask=None):
+    """
+        Score encoded documents with label attention only for the top k codes of the cheap pass.
+        Codes that aren't evaluated get a score of 0. Returns the scores and the mask of evaluated codes.
+    """
+    k = min(k, model.Y)
+    label_inds = shortlist_scores(model, x, mask).topk(k, dim=1)[1]
+    #exact attention for each document's own shortlist, all at once
+    y, _ = model.attend(x, label_inds, mask)
+    scores = torch.zeros(x.size()[0], model.Y, device=x.device)
+    scores.scatter_(1, label_inds, torch.sigmoid(y.float()))
+    evaluated = torch.zeros(x.size()[0], model.Y, dtype=torch.bool, device=x.device)
+    evaluated.scatter_(1, label_inds, True)
+    return scores, evaluated
+
+def compare(model, scorers, data_path, fold, dicts, gpu, version):
+    """
+        Score a fold with full label attention and with each pruned scorer, and collect metrics, recall lost against
+        full scoring, the share of codes evaluated and timings.
+        scorers is a list of (settings dict, function mapping encoded documents and their attention mask to scores and
+        a mask of evaluated codes).
+        Documents are scored one at a time as in training.test, so the timings are comparable.
+    """
+    num_labels = len(dicts['ind2c'])
+    k = 5 if num_labels == 50 else [8,15]
+    filename = data_path.replace('train', fold)
+    y, full = [], []
+    pruned, evaluated = [[] for _ in scorers], [[] for _ in scorers]
+    times = {'encode': 0., 'full': 0.}
+    times.update({i: 0. for i in range(len(scorers))})
+    model.eval()
+    gen = datasets.data_generator(filename, dicts, 1, num_labels, version=version)
+    with torch.no_grad():
+        for data, target, _, _, _, lengths in tqdm(gen):
+            data = torch.LongTensor(data)
+            if gpu:
+                data = data.cuda()
+            start = time.time()
+            x = model.encode(data, lengths)
+            attn_mask = model.attention_mask(lengths, x.size()[1], x.device)
+            times['encode'] += time.time() - start
+            start = time.time()
+            full.append(torch.sigmoid(model.attend(x, mask=attn_mask)[0].float()).cpu().numpy())
+            times['full'] += time.time() - start
+            for i, (_, scorer) in enumerate(scorers):
+                start = time.time()
+                scores, mask = scorer(x, attn_mask)
+                times[i] += time.time() - start
+                pruned[i].append(scores.cpu().numpy())
+                evaluated[i].append(mask.cpu().numpy())
+            y.append(target)
+
+    y = np.concatenate(y, axis=0)
+    full = np.concatenate(full, axis=0)
+    metrics_full = evaluation.all_metrics(np.round(full), y, k=k, yhat_raw=full, calc_auc=False)
+    #true positives of full scoring, which pruning can only lose
+    full_tp = (np.round(full) == 1) & (y == 1)
+    report = OrderedDict()
+    report['fold'] = fold
+    report['full'] = OrderedDict([('f1_micro', metrics_full['f1_micro']), ('f1_macro', metrics_full['f1_macro']),
+                                  ('seconds', times['encode'] + times['full'])])
+    for name in metrics_full:
+        if name.startswith('prec_at'):
+            report['full'][name] = metrics_full[name]
+    report['pruned'] = []
+    for i, (settings, _) in enumerate(scorers):
+        scores = np.concatenate(pruned[i], axis=0)
+        mask = np.concatenate(evaluated[i], axis=0)
+        metrics = evaluation.all_metrics(np.round(scores), y, k=k, yhat_raw=scores, calc_auc=False)
+        rec = OrderedDict(settings)
+        rec['f1_micro'] = metrics['f1_micro']
+        rec['f1_macro'] = metrics['f1_macro']
+        for name in metrics:
+            if name.startswith('prec_at'):
+                rec[name] = metrics[name]
+        rec['tp_recall_vs_full'] = float((full_tp & mask).sum() / max(full_tp.sum(), 1))
+        #share of gold codes among those evaluated, i.e. recall@K for a shortlist
+        rec['gold_codes_evaluated'] = float((mask & (y == 1)).sum() / max((y == 1).sum(), 1))
+        rec['codes_evaluated_per_doc'] = float(mask.sum(axis=1).mean())
+        rec['share_of_codes_evaluated'] = float(mask.mean())
+        rec['seconds'] = times['encode'] + times[i]
+        report['pruned'].append(rec)
+    return report
+
+def hierarchy_scorers(args, model, dicts, margs):
+    """
+        Load or fit the category heads, and make a pruned scorer for each threshold
+    """
+    categories, members, code2cat = build_hierarchy(dicts['ind2c'])
+    print("%d codes in %d categories" % (len(code2cat), len(categories)))
+    heads_file = os.path.join(os.path.dirname(os.path.abspath(args.model_path)), 'category_heads.pth')
+    heads = CategoryHeads(model, members)
+    if os.path.exists(heads_file) and not args.refit:
+        saved = torch.load(heads_file, map_location='cpu')
+        if saved['categories'] != categories:
+            raise ValueError("%s was fit for a different label set, rerun with --refit" % heads_file)
+        heads.load_state_dict(saved['state_dict'])
+        print("loaded category heads from %s" % heads_file)
+    if args.gpu:
+        heads.cuda()
+    if not os.path.exists(heads_file) or args.refit:
+        fit_heads(model, heads, code2cat, margs.data_path, dicts, args.n_epochs, args.batch_size, args.lr, args.gpu, margs.version)
+        torch.save({'categories': categories, 'state_dict': heads.cpu().state_dict()}, heads_file)
+        if args.gpu:
+            heads.cuda()
+        print("saved category heads to %s" % heads_file)
+
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+    return [({'threshold': t}, lambda x, mask, t=t: score_pruned(model, heads, code2cat, x, t, mask)) for t in thresholds]
+
+def shortlist_scorers(args, model):
+    ks = [int(k) for k in args.shortlist_k.split(',')]
+    return [({'k': k}, lambda x, mask, k=k: score_shortlist(model, x, k, mask)) for k in ks]
+
+def main(args):
+    csv.field_size_limit(sys.maxsize)
+    model, dicts, params = export.load_model(args.model_path, args.params)
+    if not isinstance(model, models.ConvAttnPool):
+        raise ValueError("pruned inference needs a conv_attn model")
+    margs = tools.args_from_params(params)
+    if args.gpu:
+        model.cuda()
+    for p in model.parameters():
+        p.requires_grad = False
+
+    if args.mode == 'hierarchy':
+        scorers = hierarchy_scorers(args, model, dicts, margs)
+    else:
+        scorers = shortlist_scorers(args, model)
+    fold = 'test' if margs.version == 'mimic2' else args.fold
+    report = compare(model, scorers, margs.data_path, fold, dicts, args.gpu, margs.version)
+    report['mode'] = args.mode
+    report['num_codes'] = model.Y
+    print("full scoring: f1_micro %.4f, %.1fs" % (report['full']['f1_micro'], report['full']['seconds']))
+    for rec in report['pruned']:
+        setting = 'threshold %g' % rec['threshold'] if args.mode == 'hierarchy' else 'top %d' % rec['k']
+        print("%s: f1_micro %.4f, recall of full-scoring true positives %.4f, recall of gold codes %.4f, %.1f codes (%.1f%%) evaluated per doc, %.1fs" %
+              (setting, rec['f1_micro'], rec['tp_recall_vs_full'], rec['gold_codes_evaluated'], rec['codes_evaluated_per_doc'],
+               100 * rec['share_of_codes_evaluated'], rec['seconds']))
+    report_file = os.path.join(os.path.dirname(os.path.abspath(args.model_path)), 'pruned_inference_%s_%s.json' % (args.mode, fold))
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("wrote report to %s" % report_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pruned label attention inference for a trained conv_attn model")
+    parser.add_argument("model_path", type=str, help="path to a saved conv_attn model_best_*.pth")
+    parser.add_argument("--mode", type=str, choices=["hierarchy", "shortlist"], default="hierarchy", dest="mode",
+                        help="prune by ICD-9 category scores, or by a top-K shortlist from a cheap max-pooled pass (default: hierarchy)")
+    parser.add_argument("--params", type=str, required=False, dest="params",
+                        help="path to the params.json the model was trained with (default: the one next to the model)")
+    parser.add_argument("--thresholds", type=str, required=False, dest="thresholds", default="0.01,0.05,0.1",
+                        help="hierarchy mode: comma separated category score thresholds to compare (default: 0.01,0.05,0.1)")
+    parser.add_argument("--shortlist-k", type=str, required=False, dest="shortlist_k", default="50,100,200",
+                        help="shortlist mode: comma separated candidate list sizes to compare (default: 50,100,200)")
+    parser.add_argument("--fold", type=str, choices=["dev", "test"], default="dev", dest="fold",
+                        help="which split to compare pruned and full scoring on (default: dev)")
+    parser.add_argument("--n-epochs", type=int, required=False, dest="n_epochs", default=1,
+                        help="hierarchy mode: epochs to fit the category heads for (default: 1)")
+    parser.add_argument("--batch-size", type=int, required=False, dest="batch_size", default=16,
+                        help="batch size for fitting the category heads (default: 16)")
+    parser.add_argument("--lr", type=float, required=False, dest="lr", default=1e-3,
+                        help="learning rate for fitting the category heads (default: 1e-3)")
+    parser.add_argument("--refit", dest="refit", action="store_const", required=False, const=True,
+                        help="optional flag to refit the category heads even if saved ones exist")
+    parser.add_argument("--gpu", dest="gpu", action="store_const", required=False, const=True,
+                        help="optional flag to use GPU if available")
+    args = parser.parse_args()
+    main(args)
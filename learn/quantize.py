@@ -0,0 +1,202 @@
+"""
+    Post-training int8 quantization of trained models for cpu inference, with an accuracy report against the float model
+"""
+import argparse
+import copy
+from collections import OrderedDict
+import io
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import default_dynamic_qconfig, per_channel_dynamic_qconfig
+from torch.ao.quantization.quantization_mappings import get_default_dynamic_quant_module_mappings
+import torch.nn as nn
+import torch.nn.functional as F
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from constants import *
+import learn.export as export
+import learn.models as models
+import learn.tools as tools
+import learn.training as training
+
+#metrics the report compares (prec_at_5 is only computed for the top-50 label set, prec_at_8 for the full set)
+REPORT_METRICS = ['f1_micro', 'f1_macro', 'prec_at_8', 'prec_at_5', 'auc_micro', 'auc_macro']
+
+class QuantEmbedding(nn.Module):
+    """
+        Embedding table stored as float16, or int8 with one scale per word. Rows are dequantized after lookup.
+        Also stands in for the EmbeddingBag of BOWPool, pooling the dequantized rows.
+    """
+    def __init__(self, embed, dtype='int8'):
+        super(QuantEmbedding, self).__init__()
+        w = embed.weight.data.float()
+        self.dtype = dtype
+        self.mode = embed.mode if isinstance(embed, nn.EmbeddingBag) else None
+        self.num_embeddings, self.embedding_dim = w.size()
+        if dtype == 'float16':
+            self.register_buffer('qweight', w.half())
+            self.register_buffer('scale', None)
+        else:
+            scale = w.abs().max(dim=1)[0].clamp(min=1e-8) / 127.
+            self.register_buffer('qweight', torch.round(w / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+            self.register_buffer('scale', scale)
+
+    @property
+    def weight(self):
+        w = self.qweight.float()
+        return w if self.scale is None else w * self.scale.unsqueeze(1)
+
+    def lookup(self, x):
+        rows = F.embedding(x, self.qweight).float()
+        if self.scale is not None:
+            rows = rows * F.embedding(x, self.scale.unsqueeze(1))
+        return rows
+
+    def forward(self, x, offsets=None):
+        rows = self.lookup(x)
+        if self.mode is None:
+            return rows
+        #pool the looked-up rows of each bag
+        return F.embedding_bag(torch.arange(rows.size()[0], device=x.device), rows, offsets, mode=self.mode)
+
+def quantize(model, embed_dtype=None):
+    """
+        Return an int8 copy of a float model for cpu inference. Dynamic quantization: int8 weights, and int8 kernels
+        with the activations quantized on the fly.
+            - convolutions and linear layers (including the label attention U, which the attention models call as
+              U(x)) get one weight scale per output channel
+            - recurrent layers
+            - optionally the embedding table is stored as int8 or float16
+        The final layer of the attention models, and U of multi_conv_attn without stack_filters, stay float32: they
+        are applied label by label to each label's own attended representation, which isn't one matrix product.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model.gpu = False
+    if getattr(model, 'conv_mask', None) is not None:
+        #fold the filter width mask into the fused conv, so it can be quantized as a plain conv
+        model.conv.weight.data.mul_(model.conv_mask)
+        model.conv_mask = None
+    if embed_dtype is not None:
+        model.embed = QuantEmbedding(model.embed, embed_dtype)
+    spec = {nn.Linear: per_channel_dynamic_qconfig, nn.Conv1d: per_channel_dynamic_qconfig,
+            nn.GRU: default_dynamic_qconfig, nn.LSTM: default_dynamic_qconfig}
+    if isinstance(model, (models.ConvAttnPool, models.MultiConvAttnPool)):
+        spec['final'] = None
+    if isinstance(model, models.MultiConvAttnPool) and not model.stack_filters:
+        spec['U'] = None
+    #convolutions aren't in torch's default dynamic mapping
+    mapping = dict(get_default_dynamic_quant_module_mappings())
+    mapping[nn.Conv1d] = nnqd.Conv1d
+    return torch.ao.quantization.quantize_dynamic(model, spec, mapping=mapping)
+
+def float_layers(model):
+    #layers of a quantized model that still run in float32
+    return [name for name, module in model.named_modules() if type(module) in (nn.Linear, nn.Conv1d, nn.GRU, nn.LSTM)]
+
+def state_dict_mb(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / (1024. * 1024.)
+
+def evaluate(model, args, dicts, out_dir, fold):
+    """
+        Score a fold and return the metrics and the time taken. Predictions go to out_dir
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    start = time.time()
+    metrics = training.test(model, args.Y, 0, args.data_path, fold, False, args.version, set(), dicts, False, out_dir, True)
+    return metrics, time.time() - start
+
+def compare(float_model, quant_model, args, dicts, out_dir, fold):
+    """
+        Score a fold with both models and collect the metric deltas, sizes and timings
+    """
+    metrics_float, time_float = evaluate(float_model, args, dicts, os.path.join(out_dir, 'float'), fold)
+    metrics_quant, time_quant = evaluate(quant_model, args, dicts, os.path.join(out_dir, 'int8'), fold)
+    report = OrderedDict()
+    report['fold'] = fold
+    report['metrics'] = OrderedDict()
+    for name in REPORT_METRICS:
+        if name in metrics_float and name in metrics_quant:
+            report['metrics'][name] = {'float': float(metrics_float[name]), 'int8': float(metrics_quant[name]),
+                                       'delta': float(metrics_quant[name] - metrics_float[name])}
+    report['checkpoint_mb'] = {'float': state_dict_mb(float_model), 'int8': state_dict_mb(quant_model)}
+    report['float32_layers'] = float_layers(quant_model)
+    report['eval_seconds'] = {'float': time_float, 'int8': time_quant}
+    return report
+
+def save_quantized(model, settings, out_file):
+    torch.save({'settings': settings, 'state_dict': model.state_dict()}, out_file)
+
+def load_quantized(model_path, quant_file, params_file=None):
+    """
+        Rebuild a quantized model: the float model from model_path and params.json, quantized with the saved settings,
+        then the saved int8 state dict loaded on top
+    """
+    #dynamic quantized layers save packed weight objects, which the default weights-only unpickler refuses
+    saved = torch.load(quant_file, map_location='cpu', weights_only=False)
+    model, dicts, params = export.load_model(model_path, params_file, saved['settings'].get('model'))
+    qmodel = quantize(model, saved['settings'].get('embed_dtype'))
+    qmodel.load_state_dict(saved['state_dict'])
+    return qmodel, dicts, params
+
+def main(args):
+    model, dicts, params = export.load_model(args.model_path, args.params, args.model)
+    #the data paths and label set the model was trained with
+    eval_args = tools.args_from_params(params, **({'model': args.model} if args.model is not None else {}))
+    fold = 'test' if eval_args.version == 'mimic2' else args.fold
+
+    qmodel = quantize(model, args.embed_dtype)
+    settings = {'model': eval_args.model, 'embed_dtype': args.embed_dtype}
+    out_file = args.out
+    if out_file is None:
+        out_file = os.path.splitext(args.model_path)[0] + '_int8.pth'
+    save_quantized(qmodel, settings, out_file)
+    print("saved quantized model to %s" % out_file)
+    if args.torchscript:
+        scripted_file = os.path.splitext(out_file)[0] + '.pt'
+        export.export_torchscript(export.ScoringModule(qmodel).eval(), dicts, params, scripted_file)
+        print("saved quantized TorchScript model to %s" % scripted_file)
+
+    if not args.no_report:
+        out_dir = os.path.join(os.path.dirname(os.path.abspath(out_file)), 'quantization_check')
+        report = compare(model, qmodel, eval_args, dicts, out_dir, fold)
+        report['settings'] = settings
+        for name, vals in report['metrics'].items():
+            print("[INT8 - FLOAT] %s: %.4f (%.4f vs %.4f)" % (name, vals['delta'], vals['int8'], vals['float']))
+        print("checkpoint size: %.1f MB -> %.1f MB, eval time: %.1fs -> %.1fs" % (report['checkpoint_mb']['float'], report['checkpoint_mb']['int8'],
+              report['eval_seconds']['float'], report['eval_seconds']['int8']))
+        print("layers left in float32: %s" % (', '.join(report['float32_layers']) or 'none'))
+        report_file = os.path.splitext(out_file)[0] + '_report.json'
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("wrote quantization report to %s" % report_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="quantize a trained model to int8 for cpu inference and report the accuracy change")
+    parser.add_argument("model_path", type=str, help="path to a saved model_best_*.pth")
+    parser.add_argument("--params", type=str, required=False, dest="params",
+                        help="path to the params.json the model was trained with (default: the one next to the model)")
+    parser.add_argument("--model", type=str, choices=["cnn_vanilla", "rnn", "conv_attn", "multi_conv_attn", "logreg"], required=False,
+                        dest="model", help="model type, for params files that don't record it")
+    parser.add_argument("--embed-dtype", type=str, choices=["int8", "float16"], required=False, dest="embed_dtype",
+                        help="optionally also store the embedding table in this type (default: keep float32)")
+    parser.add_argument("--fold", type=str, choices=["dev", "test"], default="dev", dest="fold",
+                        help="which split to compare the float and quantized models on (default: dev)")
+    parser.add_argument("--out", type=str, required=False, dest="out",
+                        help="output file (default: the model path with an _int8 suffix)")
+    parser.add_argument("--torchscript", dest="torchscript", action="store_const", required=False, const=True,
+                        help="optional flag to also write the quantized model as a TorchScript scoring graph")
+    parser.add_argument("--no-report", dest="no_report", action="store_const", required=False, const=True,
+                        help="optional flag to skip scoring the float and quantized models")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,275 @@
+"""
+    Long-lived local HTTP scoring service: loads a trained model and its vocab once, coalesces concurrent requests
+    into micro-batches, and returns the top-k codes with scores and descriptions for each note
+
+    POST /predict   {"text": "..."} or {"notes": [{"id": ..., "text": "..."}, ...]}, optionally with "top_k"
+    GET  /stats     request latency percentiles and the histogram of batch sizes scored
+    GET  /health
+"""
+import argparse
+from collections import Counter, deque
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from constants import *
+import datasets
+import learn.predict as predict
+
+class Pending:
+    """
+        Encoded notes from one request, waiting for the batcher to fill in their scores
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+class Stats:
+    """
+        Request latencies (over the most recent requests) and counts of the batch sizes scored
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self.num_notes = 0
+        self.start = time.time()
+
+    def add_request(self, seconds, num_notes):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.num_requests += 1
+            self.num_notes += num_notes
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = dict(self.batch_sizes)
+            num_requests, num_notes = self.num_requests, self.num_notes
+        uptime = time.time() - self.start
+        summary = {'requests': num_requests, 'notes': num_notes, 'uptime_seconds': round(uptime, 1),
+                   'notes_per_sec': round(num_notes / uptime, 2) if uptime > 0 else 0.,
+                   'batch_size_histogram': {str(size): batch_sizes[size] for size in sorted(batch_sizes)}}
+        if len(latencies) > 0:
+            summary['latency_ms'] = {'p%d' % p: round(float(np.percentile(latencies, p)), 2) for p in [50, 90, 95, 99]}
+            summary['latency_ms']['mean'] = round(float(latencies.mean()), 2)
+            summary['latency_ms']['max'] = round(float(latencies.max()), 2)
+        num_batches = sum(batch_sizes.values())
+        if num_batches > 0:
+            summary['mean_batch_size'] = round(sum(size * n for size, n in batch_sizes.items()) / float(num_batches), 2)
+        return summary
+
+class Batcher(threading.Thread):
+    """
+        Takes pending requests off a queue and scores them together. A batch is scored as soon as it holds max_batch_size
+        notes, or max_latency seconds after its first request arrived, whichever comes first.
+    """
+    def __init__(self, scorer, stats, max_batch_size=32, max_latency=0.01):
+        super(Batcher, self).__init__(daemon=True)
+        self.scorer = scorer
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+
+    def submit(self, docs):
+        pending = Pending(docs)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.scores
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            num_docs = len(batch[0].docs)
+            deadline = time.time() + self.max_latency
+            while num_docs < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                num_docs += len(pending.docs)
+            self.score(batch)
+
+    def score(self, batch):
+        docs = [doc for pending in batch for doc in pending.docs]
+        try:
+            #length-sorted chunks of at most max_batch_size notes, so one large request doesn't make one huge batch
+            order = sorted(range(len(docs)), key=lambda i: len(docs[i]))
+            scores = [None] * len(docs)
+            for start in range(0, len(order), self.max_batch_size):
+                inds = order[start:start+self.max_batch_size]
+                for i, s in zip(inds, self.scorer.score([docs[i] for i in inds])):
+                    scores[i] = s
+                self.stats.add_batch(len(inds))
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+                pending.done.set()
+            return
+        start = 0
+        for pending in batch:
+            pending.scores = scores[start:start+len(pending.docs)]
+            start += len(pending.docs)
+            pending.done.set()
+
+def parse_request(request, default_k):
+    """
+        Check a decoded request body and return its (note id, text) pairs and k.
+        Raises ValueError for a malformed request, so one bad request can't fail the batch it would be scored with.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("request body must be a JSON object")
+    if 'notes' in request:
+        if not isinstance(request['notes'], list) or len(request['notes']) == 0:
+            raise ValueError("notes must be a non-empty list")
+        if not all(isinstance(note, dict) for note in request['notes']):
+            raise ValueError("each note must be a JSON object")
+        notes = [(note.get('id', i), note.get('text')) for i, note in enumerate(request['notes'])]
+    else:
+        notes = [(request.get('id'), request.get('text'))]
+    if not all(isinstance(text, str) for _, text in notes):
+        raise ValueError("each note needs a text string")
+    k = request.get('top_k', default_k)
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        raise ValueError("top_k must be a positive integer")
+    return notes, k
+
+class Service:
+    """
+        The model, vocab, code descriptions and batcher shared by all request threads
+    """
+    def __init__(self, args):
+        start = time.time()
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        self.scorer = predict.Scorer(args.model_path, args.params, args.gpu)
+        self.descriptions = datasets.load_code_descriptions(args.version)
+        self.tokenized = args.tokenized
+        self.top_k = args.top_k
+        self.stats = Stats()
+        self.batcher = Batcher(self.scorer, self.stats, args.max_batch_size, args.max_latency / 1000.)
+        self.batcher.start()
+        print("loaded model in %.1fs" % (time.time() - start))
+
+    def predict(self, request):
+        """
+            Top-k codes for the notes in a decoded request body
+        """
+        notes, k = parse_request(request, self.top_k)
+        docs = [predict.encode(text, self.scorer.w2ind, self.tokenized) for _, text in notes]
+        results = []
+        for (note_id, _), scores in zip(notes, self.batcher.submit(docs)):
+            codes = predict.top_k(scores, self.scorer.codes, k)
+            for code in codes:
+                code['description'] = self.descriptions[code['code']]
+            results.append({'id': note_id, 'codes': codes})
+        return {'notes': results} if 'notes' in request else results[0]
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    #socketserver's default backlog of 5 drops connections (and clients retry a second later) under concurrent load
+    request_queue_size = 128
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, service.stats.summary())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': 'not found: %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'not found: %s' % self.path})
+                return
+            start = time.time()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                response = service.predict(request)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': 'bad request: %s' % repr(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': repr(e)})
+                return
+            self.send_json(200, response)
+            service.stats.add_request(time.time() - start, len(response['notes']) if 'notes' in response else 1)
+
+        def log_message(self, format, *args):
+            #per-request access logs would dominate the output under load
+            pass
+    return Handler
+
+def main(args):
+    service = Service(args)
+    server = Server((args.host, args.port), make_handler(service))
+    print("serving %s on http://%s:%d (max batch size %d, max latency %.1fms)" % (args.model_path, args.host, args.port,
+          args.max_batch_size, args.max_latency))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(service.stats.summary(), indent=1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a trained model over HTTP on localhost, micro-batching concurrent requests")
+    parser.add_argument("model_path", type=str, help="path to a saved model_best_*.pth, or a TorchScript .pt from learn/export.py")
+    parser.add_argument("--params", type=str, required=False, dest="params",
+                        help="path to the params.json the model was trained with (default: the one next to the model)")
+    parser.add_argument("--version", type=str, choices=['mimic2', 'mimic3'], required=False, dest="version", default='mimic3',
+                        help="which dataset's code descriptions to return (default: mimic3)")
+    parser.add_argument("--host", type=str, required=False, dest="host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, required=False, dest="port", default=8000,
+                        help="port to listen on (default: 8000)")
+    parser.add_argument("--max-batch-size", type=int, required=False, dest="max_batch_size", default=32,
+                        help="most notes scored in one forward pass (default: 32)")
+    parser.add_argument("--max-latency", type=float, required=False, dest="max_latency", default=10.,
+                        help="longest time in ms a request waits for others to batch with (default: 10)")
+    parser.add_argument("--top-k", type=int, required=False, dest="top_k", default=10,
+                        help="number of codes to return per note unless the request sets top_k (default: 10)")
+    parser.add_argument("--tokenized", dest="tokenized", action="store_const", required=False, const=True,
+                        help="optional flag for notes already tokenized as by get_discharge_summaries (just split on whitespace)")
+    parser.add_argument("--threads", type=int, required=False, dest="threads",
+                        help="torch threads for scoring (default: torch's own default)")
+    parser.add_argument("--gpu", dest="gpu", action="store_const", required=False, const=True,
+                        help="optional flag to use GPU if available")
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,8 @@
 """
     Various utility methods
 """
+import argparse
+import contextlib
 import csv
 import json
 import math
@@ -20,38 +22,140 @@ import numpy as np
 def pick_model(args, dicts):
     """
         Use args to initialize the appropriate model
+        With args.test_model, the saved weights overwrite any initialization, so the pretrained word and code embeddings
+        aren't read: the model is built with random embeddings sized to the checkpoint and the weights are loaded on top
     """
     Y = len(dicts['ind2c']) # get the number of codes (labels) - HD
+    embed_file, code_emb, embed_size = args.embed_file, args.code_emb, args.embed_size
+    if args.test_model:
+        sd = torch.load(args.test_model, map_location='cpu')
+        embed_file, code_emb, embed_size = None, None, sd['embed.weight'].size()[1]
     if args.model == "rnn":
-        model = models.VanillaRNN(Y, args.embed_file, dicts, args.rnn_dim, args.cell_type, args.rnn_layers, args.gpu, args.embed_size,
+        model = models.VanillaRNN(Y, embed_file, dicts, args.rnn_dim, args.cell_type, args.rnn_layers, args.gpu, embed_size,
                                   args.bidirectional)
     elif args.model == "cnn_vanilla":
         filter_size = int(args.filter_size)
-        model = models.VanillaConv(Y, args.embed_file, filter_size, args.num_filter_maps, args.gpu, dicts, args.embed_size, args.dropout, args.code_emb)
+        model = models.VanillaConv(Y, embed_file, filter_size, args.num_filter_maps, args.gpu, dicts, embed_size, args.dropout, code_emb)
     elif args.model == "conv_attn":
         filter_size = int(args.filter_size)
-        model = models.ConvAttnPool(Y, args.embed_file, filter_size, args.num_filter_maps, args.lmbda, args.gpu, dicts,
-                                    embed_size=args.embed_size, dropout=args.dropout, code_emb=args.code_emb)
+        model = models.ConvAttnPool(Y, embed_file, filter_size, args.num_filter_maps, args.lmbda, args.gpu, dicts,
+                                    embed_size=embed_size, dropout=args.dropout, code_emb=code_emb,
+                                    downsample=args.downsample, downsample_mode=args.downsample_mode)
+    elif args.model == "multi_conv_attn":
+        filter_sizes = [int(size) for size in str(args.filter_size).split(',')]
+        model = models.MultiConvAttnPool(Y, embed_file, filter_sizes, args.num_filter_maps, args.lmbda, args.gpu, dicts,
+                                         embed_size=embed_size, dropout=args.dropout, stack_filters=args.stack_filters)
     elif args.model == "logreg":
-        model = models.BOWPool(Y, args.embed_file, args.lmbda, args.gpu, dicts, args.pool, args.embed_size, args.dropout, args.code_emb)
+        model = models.BOWPool(Y, embed_file, args.lmbda, args.gpu, dicts, args.pool, embed_size, args.dropout, code_emb)
     if args.test_model: # directly testing the saved models -HD
-        sd = torch.load(args.test_model)
+        resize_embeddings(model, sd)
         model.load_state_dict(sd)
     if args.gpu:
         model.cuda()
     return model
 
+def resize_embeddings(model, sd):
+    """
+        Resize the embedding tables of a freshly built model to the saved ones (a pretrained embedding file can hold a
+        different number of words than the vocab), so the state dict loads
+    """
+    for name, module in model.named_modules():
+        key = name + '.weight'
+        if isinstance(module, (torch.nn.Embedding, torch.nn.EmbeddingBag)) and key in sd and module.weight.size() != sd[key].size():
+            module.weight = torch.nn.Parameter(torch.zeros(sd[key].size()))
+            module.num_embeddings = sd[key].size()[0]
+
+def activation_bytes_per_doc(model, seq_len, bytes_per_elem=4):
+    """
+        Rough estimate of the activation memory one document of length seq_len needs in a forward/backward pass,
+        from the model config (Y, embedding size, number of filter maps).
+        Counts the tensors kept for backward and doubles them for their gradients.
+    """
+    Y, E = model.Y, model.embed_size
+    if isinstance(model, models.BOWPool):
+        #the embedding bag only keeps the pooled vector per document
+        return 2 * (E + Y) * bytes_per_elem
+    #embedding lookup and dropout
+    elems = 2 * seq_len * E
+    if isinstance(model, models.ConvAttnPool):
+        F = model.conv.out_channels
+        #conv output and tanh, then label attention scores and softmax (Y x L/downsample), attended features and output product (Y x F)
+        attn_len = int(math.ceil(seq_len / float(model.downsample)))
+        elems += 2 * seq_len * F + 2 * attn_len * F * (model.downsample > 1) + 2 * Y * attn_len + 2 * Y * F
+    elif isinstance(model, models.MultiConvAttnPool):
+        F = model.conv.out_channels
+        #the pooled variant attends separately for each filter width
+        num_attn = 1 if model.stack_filters else len(model.filter_sizes)
+        elems += 2 * seq_len * F + 2 * num_attn * Y * seq_len + 2 * Y * F
+    elif isinstance(model, models.VanillaConv):
+        F = model.conv.out_channels
+        elems += 2 * seq_len * F + F + Y
+    elif isinstance(model, models.VanillaRNN):
+        #gates and outputs for each layer and direction
+        elems += 4 * seq_len * model.rnn_dim * model.num_layers + Y
+    return 2 * elems * bytes_per_elem
+
+def micro_batch_size(model, batch_size, seq_len, memory_budget, bytes_per_elem=4):
+    """
+        Largest number of documents of length seq_len that fit in memory_budget bytes (at least 1).
+        Returns batch_size unchanged if there is no budget or the whole batch fits.
+    """
+    if not memory_budget:
+        return batch_size
+    per_doc = activation_bytes_per_doc(model, seq_len, bytes_per_elem)
+    return int(max(1, min(batch_size, memory_budget // per_doc)))
+
+def autocast(gpu, enabled):
+    """
+        bfloat16 autocast context for forward passes. Convolutions and matmuls run in bfloat16, while the parameters,
+        optimizer state, loss and attention softmax stay in float32.
+        When not enabled this is an empty context, so float32 runs don't need autocast support in torch.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type='cuda' if gpu else 'cpu', dtype=torch.bfloat16)
+
 def make_param_dict(args):
     """
         Make a list of parameters to save for future reference
     """
     param_vals = [args.Y, args.filter_size, args.dropout, args.num_filter_maps, args.rnn_dim, args.cell_type, args.rnn_layers, 
-                  args.lmbda, args.command, args.weight_decay, args.version, args.data_path, args.vocab, args.embed_file, args.lr]
+                  args.lmbda, args.command, args.weight_decay, args.version, args.data_path, args.vocab, args.embed_file, args.lr,
+                  args.model, args.embed_size, args.pool, args.bidirectional, args.stack_filters, args.public_model,
+                  args.teacher_model, args.distill_alpha if args.teacher_model else None, args.distill_temp if args.teacher_model else None,
+                  args.downsample, args.downsample_mode]
     param_names = ["Y", "filter_size", "dropout", "num_filter_maps", "rnn_dim", "cell_type", "rnn_layers", "lmbda", "command",
-                   "weight_decay", "version", "data_path", "vocab", "embed_file", "lr"]
+                   "weight_decay", "version", "data_path", "vocab", "embed_file", "lr",
+                   "model", "embed_size", "pool", "bidirectional", "stack_filters", "public_model",
+                   "teacher_model", "distill_alpha", "distill_temp", "downsample", "downsample_mode"]
     params = {name:val for name, val in zip(param_names, param_vals) if val is not None}
     return params
 
+#training defaults for the model options, for params files that don't record them
+PARAM_DEFAULTS = {"embed_file": None, "cell_type": "gru", "rnn_dim": 128, "bidirectional": None, "rnn_layers": 1, "embed_size": 100,
+                  "filter_size": 4, "num_filter_maps": 50, "pool": None, "code_emb": None, "dropout": 0.5, "lmbda": 0,
+                  "version": "mimic3", "test_model": None, "gpu": None, "public_model": None, "stack_filters": None,
+                  "downsample": 1, "downsample_mode": "max"}
+
+def load_params(params_file):
+    """
+        Read a params.json saved alongside a trained model
+    """
+    with open(params_file, 'r') as f:
+        return json.load(f)
+
+def args_from_params(params, **kwargs):
+    """
+        Rebuild the argument namespace that load_lookups and pick_model expect from a saved params dict.
+        Options missing from the params fall back to the training defaults, and kwargs override both.
+    """
+    vals = dict(PARAM_DEFAULTS)
+    vals.update(params)
+    vals.update(kwargs)
+    #code embeddings only initialize weights, which the saved state dict replaces anyway
+    vals['code_emb'] = None
+    return argparse.Namespace(**vals)
+
 def build_code_vecs(code_inds, dicts):
     """
         Get vocab-indexed arrays representing words in descriptions of each *unseen* label
@@ -8,9 +8,11 @@ import torch.nn.functional as F
 
 import csv
 import argparse
+import json
 import os 
 import numpy as np
 import operator
+import queue
 import random
 import sys
 import time
@@ -26,7 +28,9 @@ import datasets
 import evaluation
 import interpret
 import persistence
+import learn.distill as distill
 import learn.models as models
+import learn.profiling as profiling
 import learn.tools as tools
 
 #all input arguments are at the bottom of this code (HD)
@@ -93,6 +97,13 @@ def train_epochs(args, model, optimizer, params, dicts):
 
     test_only = args.test_model is not None
     evaluate = args.test_model is not None
+    evaluator = None
+    if args.async_eval and not test_only:
+        evaluator = AsyncEvaluator(args, dicts)
+    teacher = None
+    if args.teacher_model and not test_only:
+        #score the training set with the teacher once, up front
+        teacher = distill.TeacherScores(args.teacher_model, args.data_path, dicts, args.gpu, args.batch_size, args.version)
     #train for n_epochs unless criterion metric does not improve for [patience] epochs
     for epoch in range(args.n_epochs):
         #only test on train/test set on very last epoch
@@ -101,9 +112,46 @@ def train_epochs(args, model, optimizer, params, dicts):
             os.mkdir(model_dir)
         elif args.test_model:
             model_dir = os.path.dirname(os.path.abspath(args.test_model))
+        if epoch == 0:
+            profiler = make_profiler(args, model_dir)
+        memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+
+        if evaluator is not None and epoch < args.n_epochs - 1:
+            #train only, and hand a snapshot of the weights to the side process to score on dev
+            losses, unseen_code_inds = train(model, optimizer, args.Y, epoch, args.batch_size, args.data_path, args.gpu,
+                                             args.version, dicts, args.quiet, profiler=profiler,
+                                             memory_budget=memory_budget, bf16=args.bf16, teacher=teacher,
+                                             distill_alpha=args.distill_alpha, distill_temp=args.distill_temp)
+            print("epoch loss: " + str(np.mean(losses)))
+            metrics_hist_tr['loss'].append(np.mean(losses))
+            evaluator.submit(epoch, model, model_dir, unseen_code_inds)
+            #dev results arrive one (or more) epochs late; only consume what is ready
+            metrics_hist_all = (metrics_hist, metrics_hist_te, metrics_hist_tr)
+            record_dev_results(args, evaluator.results(block=False), metrics_hist_all, model, model_dir, params)
+            if args.criterion in metrics_hist.keys() and early_stop(metrics_hist, args.criterion, args.patience):
+                #the epochs still being scored may have improved the criterion, so wait for them and check again
+                record_dev_results(args, evaluator.results(block=True), metrics_hist_all, model, model_dir, params)
+                if not early_stop(metrics_hist, args.criterion, args.patience):
+                    continue
+                evaluator.close()
+                evaluator = None
+                print("%s hasn't improved in %d epochs, early stopping..." % (args.criterion, args.patience))
+                test_only = True
+                args.test_model = '%s/model_best_%s.pth' % (model_dir, args.criterion)
+                model = tools.pick_model(args, dicts)
+            continue
+        elif evaluator is not None:
+            #the last epoch is scored in this process, so catch up on the outstanding dev results first
+            metrics_hist_all = (metrics_hist, metrics_hist_te, metrics_hist_tr)
+            record_dev_results(args, evaluator.results(block=True), metrics_hist_all, model, model_dir, params)
+            evaluator.close()
+            evaluator = None
+
         metrics_all = one_epoch(model, optimizer, args.Y, epoch, args.n_epochs, args.batch_size, args.data_path,
                                                   args.version, test_only, dicts, model_dir, 
-                                                  args.samples, args.gpu, args.quiet)
+                                                  args.samples, args.gpu, args.quiet, profiler=profiler,
+                                                  memory_budget=memory_budget, bf16=args.bf16, teacher=teacher,
+                                                  distill_alpha=args.distill_alpha, distill_temp=args.distill_temp)
         for name in metrics_all[0].keys():
             metrics_hist[name].append(metrics_all[0][name])
         for name in metrics_all[1].keys():
@@ -113,9 +161,14 @@ def train_epochs(args, model, optimizer, params, dicts):
         metrics_hist_all = (metrics_hist, metrics_hist_te, metrics_hist_tr)
 
         #save metrics, model, params
-        persistence.save_everything(args, metrics_hist_all, model, model_dir, params, args.criterion, evaluate)
+        profiler.start(epoch, 'save')
+        with profiler.phase('persistence'):
+            persistence.save_everything(args, metrics_hist_all, model, model_dir, params, args.criterion, evaluate)
+        profiler.finish()
 
         if test_only:
+            if evaluate and args.bf16:
+                compare_bf16(model, args, dicts, model_dir, metrics_all[0])
             #we're done
             break
 
@@ -128,6 +181,109 @@ def train_epochs(args, model, optimizer, params, dicts):
                 model = tools.pick_model(args, dicts)
     return epoch+1
 
+def record_dev_results(args, results, metrics_hist_all, model, model_dir, params):
+    """
+        Add dev metrics computed by the side process to the history, save them, and keep the snapshot if it's the best
+    """
+    for epoch, metrics, snapshot in results:
+        print("received dev metrics for epoch %d" % epoch)
+        for name in metrics.keys():
+            metrics_hist_all[0][name].append(metrics[name])
+        persistence.save_everything(args, metrics_hist_all, model, model_dir, params, args.criterion, snapshot=snapshot)
+        os.remove(snapshot)
+
+class AsyncEvaluator:
+    """
+        Scores weight snapshots on dev in a separate process while training continues
+    """
+    def __init__(self, args, dicts):
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.done = ctx.Queue()
+        self.pending = 0
+        self.proc = ctx.Process(target=eval_worker, args=(args, dicts, self.jobs, self.done))
+        self.proc.start()
+
+    def submit(self, epoch, model, model_dir, unseen_code_inds):
+        snapshot = '%s/snapshot_%d.pth' % (model_dir, epoch)
+        torch.save({name: val.cpu() for name, val in model.state_dict().items()}, snapshot)
+        self.jobs.put((epoch, snapshot, model_dir, unseen_code_inds))
+        self.pending += 1
+
+    def results(self, block=False):
+        """
+            Return (epoch, metrics, snapshot) for finished evaluations, in epoch order.
+            If block, wait for all outstanding ones.
+        """
+        done = []
+        while self.pending > 0:
+            try:
+                done.append(self.done.get(block=block, timeout=10 if block else None))
+            except queue.Empty:
+                if block and self.proc.is_alive():
+                    continue
+                if block:
+                    raise RuntimeError("dev evaluation process exited with %d evaluations outstanding" % self.pending)
+                break
+            self.pending -= 1
+        return done
+
+    def close(self):
+        self.jobs.put(None)
+        self.proc.join()
+
+def eval_worker(args, dicts, jobs, done):
+    """
+        Side process: build a copy of the model once, then load and score each snapshot on dev
+    """
+    model = tools.pick_model(args, dicts)
+    fold = 'test' if args.version == 'mimic2' else 'dev'
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, snapshot, model_dir, unseen_code_inds = job
+        model.load_state_dict(torch.load(snapshot))
+        metrics = test(model, args.Y, epoch, args.data_path, fold, args.gpu, args.version, unseen_code_inds, dicts,
+                       args.samples, model_dir, False, bf16=args.bf16)
+        done.put((epoch, metrics, snapshot))
+
+def compare_bf16(model, args, dicts, model_dir, metrics_bf16):
+    """
+        Re-score the dev set in float32 and write the difference from the bfloat16 metrics to bf16_check.json
+    """
+    fold = 'test' if args.version == 'mimic2' else 'dev'
+    print("validating bfloat16 metrics against float32")
+    #keep the float32 predictions separate from the bfloat16 ones
+    ref_dir = os.path.join(model_dir, 'fp32_reference')
+    if not os.path.exists(ref_dir):
+        os.mkdir(ref_dir)
+    #descriptions for unseen codes were already swapped into the model during the bfloat16 pass
+    metrics_fp32 = test(model, args.Y, 0, args.data_path, fold, args.gpu, args.version, set(), dicts, False, ref_dir,
+                        True, bf16=False)
+    check = {}
+    for name in sorted(metrics_bf16.keys()):
+        if name in metrics_fp32:
+            check[name] = {'bf16': float(metrics_bf16[name]), 'fp32': float(metrics_fp32[name]),
+                           'delta': float(metrics_bf16[name] - metrics_fp32[name])}
+    print("[BF16 - FP32] f1_micro: %.4f, f1_macro: %.4f" % (check['f1_micro']['delta'], check['f1_macro']['delta']))
+    with open(os.path.join(model_dir, 'bf16_check.json'), 'w') as f:
+        json.dump(check, f, indent=1)
+    return check
+
+def make_profiler(args, model_dir):
+    """
+        Build the step profiler requested on the command line, writing telemetry to model_dir/telemetry.jsonl
+    """
+    if not args.profile:
+        return profiling.NullProfiler()
+    trace_steps = None
+    if args.profile_steps:
+        trace_steps = tuple(int(s) for s in args.profile_steps.split(','))
+    out_file = os.path.join(model_dir, 'telemetry.jsonl')
+    print("writing per-phase telemetry to %s" % out_file)
+    return profiling.StepProfiler(out_file, trace_steps=trace_steps, trace_dir=model_dir, gpu=args.gpu)
+
 def early_stop(metrics_hist, criterion, patience):
     if not np.all(np.isnan(metrics_hist[criterion])):
         if len(metrics_hist[criterion]) >= patience:
@@ -140,12 +296,15 @@ def early_stop(metrics_hist, criterion, patience):
         return False
         
 def one_epoch(model, optimizer, Y, epoch, n_epochs, batch_size, data_path, version, testing, dicts, model_dir, 
-              samples, gpu, quiet):
+              samples, gpu, quiet, profiler=None, memory_budget=None, bf16=False, teacher=None, distill_alpha=0.5,
+              distill_temp=1.):
     """
         Wrapper to do a training epoch and test on dev
     """
     if not testing:
-        losses, unseen_code_inds = train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts, quiet)
+        losses, unseen_code_inds = train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts, quiet,
+                                         profiler=profiler, memory_budget=memory_budget, bf16=bf16, teacher=teacher,
+                                         distill_alpha=distill_alpha, distill_temp=distill_temp)
         loss = np.mean(losses)
         print("epoch loss: " + str(loss))
     else:
@@ -174,11 +333,11 @@ def one_epoch(model, optimizer, Y, epoch, n_epochs, batch_size, data_path, versi
 
     #test on dev
     metrics = test(model, Y, epoch, data_path, fold, gpu, version, unseen_code_inds, dicts, samples, model_dir,
-                   testing)
+                   testing, profiler=profiler, bf16=bf16)
     if testing or epoch == n_epochs - 1:
         print("\nevaluating on test")
         metrics_te = test(model, Y, epoch, data_path, "test", gpu, version, unseen_code_inds, dicts, samples, 
-                          model_dir, True)
+                          model_dir, True, profiler=profiler, bf16=bf16)
     else:
         metrics_te = defaultdict(float)
         fpr_te = defaultdict(lambda: [])
@@ -188,15 +347,25 @@ def one_epoch(model, optimizer, Y, epoch, n_epochs, batch_size, data_path, versi
     return metrics_all
 
 
-def train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts, quiet):
+def train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts, quiet, profiler=None, memory_budget=None,
+          bf16=False, teacher=None, distill_alpha=0.5, distill_temp=1.):
     """
         Training loop.
+        If memory_budget (bytes) is given, batches whose estimated activation memory exceeds it are split into
+        micro-batches with gradient accumulation, so each optimizer step still sees the full batch.
+        If bf16, forward passes run under bfloat16 autocast.
+        If teacher (distill.TeacherScores) is given, the loss is (1 - distill_alpha) * gold loss + distill_alpha * loss
+        against the teacher's label scores at temperature distill_temp.
         output: losses for each example for this iteration
     """
     print("EPOCH %d" % epoch)
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+    profiler.start(epoch, 'train')
     num_labels = len(dicts['ind2c'])
 
     losses = []
+    num_split = 0
     #how often to print some info to stdout
     print_every = 25
 
@@ -206,13 +375,18 @@ def train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts
 
     model.train()
     gen = datasets.data_generator(data_path, dicts, batch_size, num_labels, version=version, desc_embed=desc_embed)
-    for batch_idx, tup in tqdm(enumerate(gen)):
-        data, target, _, code_set, descs = tup
-        data, target = Variable(torch.LongTensor(data)), Variable(torch.FloatTensor(target))
+    for batch_idx, tup in tqdm(enumerate(profiler.timed_iter(gen))):
+        profiler.step(batch_idx)
+        data, target, hadm_ids, code_set, descs, lengths = tup
+        profiler.count_batch(data, lengths)
+        with profiler.phase('to_tensor'):
+            data, target = Variable(torch.LongTensor(data)), Variable(torch.FloatTensor(target))
+            if gpu:
+                data = data.cuda()
+                target = target.cuda()
+            if teacher is not None:
+                soft = teacher.soft_targets(hadm_ids, distill_temp, gpu)
         unseen_code_inds = unseen_code_inds.difference(code_set)
-        if gpu:
-            data = data.cuda()
-            target = target.cuda()
         optimizer.zero_grad()
 
         if desc_embed:
@@ -220,12 +394,28 @@ def train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts
         else:
             desc_data = None
 
-        output, loss, _ = model(data, target, desc_data=desc_data) # here it calls the nn.Module.foward() function -HD
-
-        loss.backward()
-        optimizer.step()
-
-        losses.append(loss.data[0])
+        #the loss is a mean over the batch, so weighting each micro-batch by its share of the batch
+        #accumulates exactly the gradient of the full batch
+        micro_size = tools.micro_batch_size(model, data.size()[0], data.size()[1], memory_budget, 2 if bf16 else 4)
+        if micro_size < data.size()[0]:
+            num_split += 1
+        batch_loss = 0.
+        for start in range(0, data.size()[0], micro_size):
+            end = min(start + micro_size, data.size()[0])
+            frac = (end - start) / float(data.size()[0])
+            desc_micro = desc_data[start:end] if desc_data is not None else None
+            with profiler.phase('forward'), tools.autocast(gpu, bf16):
+                output, loss, _ = model(data[start:end], target[start:end], desc_data=desc_micro, lengths=lengths[start:end]) # here it calls the nn.Module.foward() function -HD
+                if teacher is not None:
+                    loss = (1 - distill_alpha) * loss + distill_alpha * distill.distill_loss(output, soft[start:end], distill_temp)
+
+            with profiler.phase('backward'):
+                (loss * frac).backward()
+            batch_loss += loss.item() * frac
+        with profiler.phase('optimizer'):
+            optimizer.step()
+
+        losses.append(batch_loss)
 
         if not quiet and batch_idx % print_every == 0:
             #print the average loss of the last 10 batches
@@ -233,6 +423,9 @@ def train(model, optimizer, Y, epoch, batch_size, data_path, gpu, version, dicts
             ave_loss=1
             print("Train epoch: {} [batch #{}, batch_size {}, seq length {}]\tLoss: {:.6f}".format(
                 epoch, batch_idx, data.size()[0], data.size()[1], np.mean(losses[-ave_loss:])))
+    if memory_budget:
+        print("split %d of %d batches into micro-batches to stay under the memory budget" % (num_split, batch_idx + 1))
+    profiler.finish()
     return losses, unseen_code_inds
 
 def unseen_code_vecs(model, code_inds, dicts, gpu):
@@ -247,13 +440,17 @@ def unseen_code_vecs(model, code_inds, dicts, gpu):
     model.final.weight.data[code_inds, :] = desc_embeddings.data
     model.final.bias.data[code_inds] = 0
 
-def test(model, Y, epoch, data_path, fold, gpu, version, code_inds, dicts, samples, model_dir, testing):
+def test(model, Y, epoch, data_path, fold, gpu, version, code_inds, dicts, samples, model_dir, testing, profiler=None,
+         bf16=False):
     """
         Testing loop.
         Returns metrics
     """
     filename = data_path.replace('train', fold)
     print('file for evaluation: %s' % filename)
+    if profiler is None:
+        profiler = profiling.NullProfiler()
+    profiler.start(epoch, fold)
     num_labels = len(dicts['ind2c'])
 
     #initialize stuff for saving attention samples
@@ -271,36 +468,46 @@ def test(model, Y, epoch, data_path, fold, gpu, version, code_inds, dicts, sampl
 
     model.eval()
     gen = datasets.data_generator(filename, dicts, 1, num_labels, version=version, desc_embed=desc_embed)
-    for batch_idx, tup in tqdm(enumerate(gen)):
-        data, target, hadm_ids, _, descs = tup
-        data, target = Variable(torch.LongTensor(data), volatile=True), Variable(torch.FloatTensor(target))
-        if gpu:
-            data = data.cuda()
-            target = target.cuda()
-        model.zero_grad()
-
-        if desc_embed:
-            desc_data = descs
-        else:
-            desc_data = None
-
-        #get an attention sample for 2% of batches
-        get_attn = samples and (np.random.rand() < 0.02 or (fold == 'test' and testing))
-        output, loss, alpha = model(data, target, desc_data=desc_data, get_attention=get_attn)
-
-        output = F.sigmoid(output)
-        output = output.data.cpu().numpy()
-        losses.append(loss.data[0])
-        target_data = target.data.cpu().numpy()
-        if get_attn and samples:
-            interpret.save_samples(data, output, target_data, alpha, window_size, epoch, tp_file, fp_file, dicts=dicts)
-
-        #save predictions, target, hadm ids
-        yhat_raw.append(output)
-        output = np.round(output)
-        y.append(target_data)
-        yhat.append(output)
-        hids.extend(hadm_ids)
+    #no autograd graph is needed for evaluation
+    with torch.no_grad():
+        for batch_idx, tup in tqdm(enumerate(profiler.timed_iter(gen))):
+            data, target, hadm_ids, _, descs, lengths = tup
+            profiler.count_batch(data, lengths)
+            with profiler.phase('to_tensor'):
+                data, target = Variable(torch.LongTensor(data)), Variable(torch.FloatTensor(target))
+                if gpu:
+                    data = data.cuda()
+                    target = target.cuda()
+            model.zero_grad()
+
+            if desc_embed:
+                desc_data = descs
+            else:
+                desc_data = None
+
+            #get an attention sample for 2% of batches
+            get_attn = samples and (np.random.rand() < 0.02 or (fold == 'test' and testing))
+            with profiler.phase('forward'), tools.autocast(gpu, bf16):
+                output, loss, alpha = model(data, target, desc_data=desc_data, get_attention=get_attn, lengths=lengths)
+
+            with profiler.phase('to_numpy'):
+                output = torch.sigmoid(output.float())
+                output = output.data.cpu().numpy()
+                losses.append(loss.item())
+                target_data = target.data.cpu().numpy()
+            if get_attn and samples:
+                if alpha is not None:
+                    #attention computed under bf16 autocast comes out in bfloat16, which numpy can't read
+                    alpha = alpha.float()
+                interpret.save_samples(data, output, target_data, alpha, window_size, tp_file, fp_file, dicts=dicts,
+                                       stride=getattr(model, 'downsample', 1))
+
+            #save predictions, target, hadm ids
+            yhat_raw.append(output)
+            output = np.round(output)
+            y.append(target_data)
+            yhat.append(output)
+            hids.extend(hadm_ids)
 
     #close files if needed
     if samples:
@@ -312,10 +519,13 @@ def test(model, Y, epoch, data_path, fold, gpu, version, code_inds, dicts, sampl
     yhat_raw = np.concatenate(yhat_raw, axis=0)
 
     #write the predictions
-    preds_file = persistence.write_preds(yhat, model_dir, hids, fold, ind2c, yhat_raw)
+    with profiler.phase('persistence'):
+        preds_file = persistence.write_preds(yhat, model_dir, hids, fold, ind2c, yhat_raw)
     #get metrics
     k = 5 if num_labels == 50 else [8,15]
-    metrics = evaluation.all_metrics(yhat, y, k=k, yhat_raw=yhat_raw)
+    with profiler.phase('metrics'):
+        metrics = evaluation.all_metrics(yhat, y, k=k, yhat_raw=yhat_raw)
+    profiler.finish()
     evaluation.print_metrics(metrics)
     metrics['loss_%s' % fold] = np.mean(losses)
     return metrics
@@ -341,10 +551,14 @@ if __name__ == "__main__":
     parser.add_argument("--embed-size", type=int, required=False, dest="embed_size", default=100,
                         help="size of embedding dimension. (default: 100)")
     parser.add_argument("--filter-size", type=str, required=False, dest="filter_size", default=4,
-                        help="size of convolution filter to use. (default: 3) For multi_conv_attn, give comma separated integers, e.g. 3,4,5")
+                        help="size of convolution filter to use. (default: 4) For multi_conv_attn, give comma separated integers, e.g. 3,4,5")
     parser.add_argument("--num-filter-maps", type=int, required=False, dest="num_filter_maps", default=50,
                         help="size of conv output (default: 50)")
-    parser.add_argument("--pool", choices=['max', 'avg'], required=False, dest="pool", help="which type of pooling to do (logreg model only)")
+    parser.add_argument("--downsample", type=int, required=False, dest="downsample", default=1,
+                        help="stride to downsample conv features by before label attention, so attention runs over seq_len/downsample positions (conv_attn only, default: 1, no downsampling)")
+    parser.add_argument("--downsample-mode", type=str, choices=["max", "conv"], required=False, dest="downsample_mode", default="max",
+                        help="with --downsample, local max-pooling or a learned strided conv (default: max)")
+    parser.add_argument("--pool", choices=['max', 'avg', 'sum'], required=False, dest="pool", help="which type of pooling to do (logreg model only, default: avg)")
     parser.add_argument("--code-emb", type=str, required=False, dest="code_emb", 
                         help="point to code embeddings to use for parameter initialization, if applicable") # this allows to insert code embedding that may contain knowledge (relations or network embedding) of the labels. -HD
     parser.add_argument("--weight-decay", type=float, required=False, dest="weight_decay", default=0,
@@ -353,6 +567,18 @@ if __name__ == "__main__":
                         help="learning rate for Adam optimizer (default=1e-3)")
     parser.add_argument("--batch-size", type=int, required=False, dest="batch_size", default=16,
                         help="size of training batches")
+    parser.add_argument("--memory-budget", type=float, required=False, dest="memory_budget",
+                        help="optional activation memory budget in MB. Batches estimated to need more are split into micro-batches with gradient accumulation, keeping the effective batch size")
+    parser.add_argument("--bf16", dest="bf16", action="store_const", required=False, const=True,
+                        help="optional flag to run forward passes under bfloat16 autocast (loss, softmax and optimizer state stay float32). With --test-model, also re-scores dev in float32 and writes the metric differences to bf16_check.json")
+    parser.add_argument("--async-eval", dest="async_eval", action="store_const", required=False, const=True,
+                        help="optional flag to score dev in a side process on a snapshot of each epoch's weights while training continues. Early stopping then acts on dev results one epoch late")
+    parser.add_argument("--teacher-model", type=str, required=False, dest="teacher_model",
+                        help="path to a trained model (e.g. conv_attn model_best_*.pth, with its params.json alongside) to distill into this model. Its scores on the training set are cached next to it")
+    parser.add_argument("--distill-alpha", type=float, required=False, dest="distill_alpha", default=0.5,
+                        help="with --teacher-model, weight of the teacher-matching loss against the gold label loss (default: 0.5)")
+    parser.add_argument("--distill-temp", type=float, required=False, dest="distill_temp", default=1.,
+                        help="with --teacher-model, temperature applied to teacher and student logits in the teacher-matching loss (default: 1)")
     parser.add_argument("--dropout", dest="dropout", type=float, required=False, default=0.5,
                         help="optional specification of dropout (default: 0.5)")
     parser.add_argument("--lmbda", type=float, required=False, dest="lmbda", default=0,
@@ -374,6 +600,10 @@ if __name__ == "__main__":
                         help="optional flag to save samples of good / bad predictions")
     parser.add_argument("--quiet", dest="quiet", action="store_const", required=False, const=True,
                         help="optional flag not to print so much during training")
+    parser.add_argument("--profile", dest="profile", action="store_const", required=False, const=True,
+                        help="optional flag to record per-phase wall time, docs/sec, tokens/sec, padding ratio and memory peaks to telemetry.jsonl in the model directory")
+    parser.add_argument("--profile-steps", type=str, required=False, dest="profile_steps",
+                        help="with --profile, also write a torch profiler trace for training steps in this window, e.g. 10,20")
     args = parser.parse_args()
     command = ' '.join(['python'] + sys.argv)
     args.command = command
@@ -12,6 +12,7 @@ from dataproc import extract_wvs
 from dataproc import get_discharge_summaries
 from dataproc import concat_and_split
 from dataproc import build_vocab
+from dataproc import length_sort
 from dataproc import vocab_index_descriptions
 from dataproc import word_embeddings
 from constants import MIMIC_3_DIR, DATA_DIR
@@ -54,8 +55,8 @@ dfdiag = pd.read_csv('%s/DIAGNOSES_ICD.csv' % MIMIC_3_DIR)
 # In[4]:
 
 
-dfdiag['absolute_code'] = dfdiag.apply(lambda row: str(datasets.reformat(str(row[4]), True)), axis=1)
-dfproc['absolute_code'] = dfproc.apply(lambda row: str(datasets.reformat(str(row[4]), False)), axis=1)
+dfdiag['absolute_code'] = datasets.reformat_codes(dfdiag['ICD9_CODE'].astype(str), True)
+dfproc['absolute_code'] = datasets.reformat_codes(dfproc['ICD9_CODE'].astype(str), False)
 
 
 # In[5]:
@@ -275,10 +276,7 @@ build_vocab.build_vocab(vocab_min, tr, vname)
 
 for splt in ['train', 'dev', 'test']:
     filename = '%s/disch_%s_split.csv' % (MIMIC_3_DIR, splt)
-    df = pd.read_csv(filename)
-    df['length'] = df.apply(lambda row: len(str(row['TEXT']).split()), axis=1)
-    df = df.sort_values(['length'])
-    df.to_csv('%s/%s_full.csv' % (MIMIC_3_DIR, splt), index=False)
+    length_sort.sort_by_length(filename, '%s/%s_full.csv' % (MIMIC_3_DIR, splt))
 
 
 # ## Pre-train word embeddings
@@ -387,8 +385,5 @@ for splt in ['train', 'dev', 'test']:
 
 for splt in ['train', 'dev', 'test']:
     filename = '%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y))
-    df = pd.read_csv(filename)
-    df['length'] = df.apply(lambda row: len(str(row['TEXT']).split()), axis=1)
-    df = df.sort_values(['length'])
-    df.to_csv('%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y)), index=False)
+    length_sort.sort_by_length(filename, '%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y)))
 
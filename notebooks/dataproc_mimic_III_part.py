@@ -12,6 +12,7 @@ from dataproc import extract_wvs
 from dataproc import get_discharge_summaries
 from dataproc import concat_and_split
 from dataproc import build_vocab
+from dataproc import length_sort
 from dataproc import vocab_index_descriptions
 from dataproc import word_embeddings
 from constants import MIMIC_3_DIR, DATA_DIR
@@ -113,8 +114,5 @@ for splt in ['train', 'dev', 'test']:
 
 for splt in ['train', 'dev', 'test']:
     filename = '%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y))
-    df = pd.read_csv(filename)
-    df['length'] = df.apply(lambda row: len(str(row['TEXT']).split()), axis=1)
-    df = df.sort_values(['length'])
-    df.to_csv('%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y)), index=False)
+    length_sort.sort_by_length(filename, '%s/%s_%s.csv' % (MIMIC_3_DIR, splt, str(Y)))
 
@@ -3,6 +3,7 @@
 """
 import csv
 import json
+import shutil
 
 import numpy as np
 import torch
@@ -16,7 +17,8 @@ def save_metrics(metrics_hist_all, model_dir):
         data = metrics_hist_all[0].copy()
         data.update({"%s_te" % (name):val for (name,val) in metrics_hist_all[1].items()})
         data.update({"%s_tr" % (name):val for (name,val) in metrics_hist_all[2].items()})
-        json.dump(data, metrics_file, indent=1)
+        #metrics computed on float32 scores are numpy float32s, which json can't serialize
+        json.dump(data, metrics_file, indent=1, default=float)
 
 def save_params_dict(params):
     with open(params["model_dir"] + "/params.json", 'w') as params_file:
@@ -53,9 +55,11 @@ def write_preds(yhat, model_dir, hids, fold, ind2c, yhat_raw=None):
             json.dump(scores, f, indent=1)
     return preds_file
 
-def save_everything(args, metrics_hist_all, model, model_dir, params, criterion, evaluate=False):
+def save_everything(args, metrics_hist_all, model, model_dir, params, criterion, evaluate=False, snapshot=None):
     """
         Save metrics, model, params all in model_dir
+        If snapshot is given, it is the saved state dict the latest dev metrics were computed from (asynchronous
+        evaluation), and is used as the best model instead of the current weights
     """
     save_metrics(metrics_hist_all, model_dir)
     params['model_dir'] = model_dir
@@ -72,8 +76,12 @@ def save_everything(args, metrics_hist_all, model, model_dir, params, criterion,
             if eval_val == len(metrics_hist_all[0][criterion]) - 1: # if the best result index is the most recent index -HD               
 
 		#save state dict
-                sd = model.cpu().state_dict()
-                torch.save(sd, model_dir + "/model_best_%s.pth" % criterion)
-                if args.gpu:
-                    model.cuda()
+                if snapshot is not None:
+                    #training has moved on since this snapshot was taken
+                    shutil.copyfile(snapshot, model_dir + "/model_best_%s.pth" % criterion)
+                else:
+                    sd = model.cpu().state_dict()
+                    torch.save(sd, model_dir + "/model_best_%s.pth" % criterion)
+                    if args.gpu:
+                        model.cuda()
     print("saved metrics, params, model to directory %s\n" % (model_dir))
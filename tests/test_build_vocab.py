@@ -0,0 +1,94 @@
+"""
+    Tests for the streaming vocab counts in dataproc/build_vocab.py
+"""
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from dataproc import build_vocab
+from dataproc import csv_chunks
+
+def reference_counts(docs):
+    #document and token frequency of every term, terms in order of first occurrence
+    doc_freq, term_freq = {}, {}
+    for doc in docs:
+        for token in doc.split():
+            term_freq[token] = term_freq.get(token, 0) + 1
+        for token in set(doc.split()):
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    order = list(dict.fromkeys(token for doc in docs for token in doc.split()))
+    return order, doc_freq, term_freq
+
+class BuildVocabTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        rnd = random.Random(3)
+        words = ['tok%d' % i for i in range(40)]
+        #skewed word frequencies, so the cutoffs keep some words and drop others
+        weights = [1. / (i + 1) for i in range(len(words))]
+        cls.docs = [' '.join(rnd.choices(words, weights, k=rnd.randint(1, 30))) for _ in range(200)]
+        cls.infile = os.path.join(cls.dir, 'train.csv')
+        with open(cls.infile, 'w') as f:
+            w = csv.writer(f)
+            w.writerow(['SUBJECT_ID', 'HADM_ID', 'CHARTTIME', 'TEXT', 'LABELS'])
+            for i, doc in enumerate(cls.docs):
+                w.writerow([i, 1000 + i, '', doc, '401.9'])
+        cls.order, cls.doc_freq, cls.term_freq = reference_counts(cls.docs)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def build(self, vocab_min, max_vocab=None, workers=1):
+        vocab_file = os.path.join(self.dir, 'vocab_%d_%s_%d.csv' % (vocab_min, max_vocab, workers))
+        build_vocab.build_vocab(vocab_min, self.infile, vocab_file, max_vocab, workers)
+        with open(vocab_file) as f:
+            vocab = [line.rstrip('\n') for line in f]
+        with open(os.path.splitext(vocab_file)[0] + '_stats.csv') as f:
+            stats = {row['WORD']: (int(row['DOC_FREQ']), int(row['TERM_FREQ'])) for row in csv.DictReader(f)}
+        return vocab, stats
+
+    def test_counts_merged_across_chunks(self):
+        #counted in several byte ranges, in this process and in a worker pool
+        self.assertGreater(len(csv_chunks.record_ranges(self.infile, csv_chunks.num_chunks(self.infile, 1))), 1)
+        for workers in [1, 2]:
+            vocab, stats = self.build(1, workers=workers)
+            self.assertEqual(vocab, self.order)
+            self.assertEqual(stats, {term: (self.doc_freq[term], self.term_freq[term]) for term in self.order})
+
+    def test_vocab_min(self):
+        #a cutoff some terms sit exactly at
+        vocab_min = sorted(self.doc_freq.values())[len(self.doc_freq) // 2]
+        vocab, stats = self.build(vocab_min)
+        expected = [term for term in self.order if self.doc_freq[term] >= vocab_min]
+        self.assertTrue(0 < len(expected) < len(self.order))
+        self.assertEqual(vocab, expected)
+        self.assertEqual(set(stats), set(expected))
+
+    def test_max_vocab(self):
+        #a cap that cuts through terms tied on document frequency
+        counts = {}
+        for df in self.doc_freq.values():
+            counts[df] = counts.get(df, 0) + 1
+        tied = max(df for df, n in counts.items() if n > 1)
+        vocab_min = 2
+        max_vocab = sum(1 for df in self.doc_freq.values() if df > tied) + 1
+        vocab, _ = self.build(vocab_min, max_vocab)
+        qualifying = [term for term in self.order if self.doc_freq[term] >= vocab_min]
+        #most documents first, ties to the earlier term, then back in order of first occurrence
+        keep = set(sorted(qualifying, key=lambda term: (-self.doc_freq[term], self.order.index(term)))[:max_vocab])
+        self.assertEqual(vocab, [term for term in qualifying if term in keep])
+        self.assertEqual(len(vocab), max_vocab)
+
+if __name__ == '__main__':
+    unittest.main()
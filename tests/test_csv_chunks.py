@@ -0,0 +1,136 @@
+"""
+    Tests for the record-aligned byte ranges in dataproc/csv_chunks.py and the parallel tokenizer built on them
+"""
+import csv
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from dataproc import csv_chunks
+from dataproc import get_discharge_summaries
+
+HEADER = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CHARTTIME', 'STORETIME', 'CATEGORY', 'DESCRIPTION', 'CGID',
+          'ISERROR', 'TEXT']
+
+def note_text(rnd, i):
+    #multi-line text with quotes, commas, numbers and lines that look like the start of a record
+    lines = []
+    for j in range(rnd.randint(1, 12)):
+        kind = rnd.randint(0, 4)
+        if kind == 0:
+            lines.append('%d,%d,%d,2150-01-01,,,Discharge summary,Report,,,"' % (i, j, 100 + j))
+        elif kind == 1:
+            lines.append('He said "take 2 tablets, twice daily" and left.')
+        elif kind == 2:
+            lines.append('Naïve café patient, BP 120/80')
+        else:
+            lines.append(' '.join(rnd.choice(['fever', 'cough', 'Admitted', 'MRI', 'x2', '3mg']) for _ in range(rnd.randint(0, 15))))
+    return '\n'.join(lines)
+
+def write_notes(path, num_notes, seed):
+    """
+        Write a NOTEEVENTS-like file and return the byte span (start, end) of each record
+    """
+    rnd = random.Random(seed)
+    spans = []
+    with open(path, 'wb') as f:
+        f.write((','.join(HEADER) + '\n').encode('utf-8'))
+        for i in range(num_notes):
+            category = 'Discharge summary' if rnd.random() < 0.6 else 'Nursing'
+            buf = io.StringIO()
+            csv.writer(buf, lineterminator='\n').writerow([i, 10 + i % 7, 100 + i, '2150-01-01', '', '', category, 'Report',
+                                                          '', '', note_text(rnd, i)])
+            record = buf.getvalue().encode('utf-8')
+            start = f.tell()
+            f.write(record)
+            spans.append((start, start + len(record)))
+    return spans
+
+class RecordRangesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.dir, 'NOTEEVENTS.csv')
+        cls.spans = write_notes(cls.path, 300, 7)
+        with open(cls.path, newline='') as f:
+            r = csv.reader(f)
+            next(r)
+            cls.records = list(r)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_ranges_cover_every_record_once(self):
+        size = os.path.getsize(self.path)
+        record_starts = set(start for start, _ in self.spans)
+        with open(self.path, 'rb') as f:
+            contents = f.read()
+        multiline = [(start, end) for start, end in self.spans if b'\n' in contents[start:end-1]]
+        for num_chunks in [1, 2, 3, 7, 16, 50, 299, 1000]:
+            ranges = csv_chunks.record_ranges(self.path, num_chunks)
+            self.assertEqual(ranges[0][0], self.spans[0][0])
+            self.assertEqual(ranges[-1][1], size)
+            for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertIn(start, record_starts)
+            records = [row for start, end in ranges for row in csv_chunks.read_records(self.path, start, end)]
+            self.assertEqual(records, self.records)
+        #the even split points do land inside quoted multi-line fields, so the boundaries had to be moved
+        step = (size - self.spans[0][0]) // 50
+        targets = range(self.spans[0][0] + step, size, step)
+        self.assertTrue(any(start < target < end for target in targets for start, end in multiline))
+
+    def test_quoted_newline_at_split_point(self):
+        #a split point right after a newline inside a quoted field, followed by a line that parses as a record
+        path = os.path.join(self.dir, 'tricky.csv')
+        rows = [['1', 'a'], ['2', 'line one\n3,not a record\nline "three"'], ['4', 'd']]
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f, lineterminator='\n')
+            w.writerow(['ID', 'TEXT'])
+            w.writerows(rows)
+        for num_chunks in range(1, 40):
+            ranges = csv_chunks.record_ranges(path, num_chunks)
+            self.assertEqual([row for start, end in ranges for row in csv_chunks.read_records(path, start, end)], rows)
+
+class ParallelTokenizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_notes(os.path.join(self.dir, 'NOTEEVENTS.csv'), 400, 11)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_matches_serial(self):
+        #serial reference: the whole file through one csv reader
+        with open(os.path.join(self.dir, 'NOTEEVENTS.csv'), newline='') as f:
+            r = csv.reader(f)
+            next(r)
+            expected = [[row[0], row[1], row[2], row[4], ' '.join(get_discharge_summaries.tokenize(row[10]))]
+                        for row in r if row[6] == 'Discharge summary']
+        outputs = {}
+        with mock.patch.object(get_discharge_summaries, 'MIMIC_3_DIR', self.dir), \
+             mock.patch.object(csv_chunks, 'CHUNK_BYTES', 4096):
+            for workers in [1, 3]:
+                out_file = os.path.join(self.dir, 'disch_%d.csv' % workers)
+                get_discharge_summaries.write_discharge_summaries(out_file, workers)
+                with open(out_file, 'rb') as f:
+                    outputs[workers] = f.read()
+        self.assertEqual(outputs[1], outputs[3])
+        rows = list(csv.reader(io.StringIO(outputs[3].decode('utf-8'))))
+        self.assertEqual(rows[0], ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTTIME', 'TEXT'])
+        self.assertEqual(rows[1:], expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+    Tests for the ICD-9 code formatting in datasets.py
+"""
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import datasets
+
+#MIMIC-III style codes: plain and E/V diagnoses, procedures, short and dotted codes, empty and missing ('nan') values
+CODES = ['4019', '40191', '25000', 'V3000', 'V053', 'V10', 'E8798', 'E849', 'E0000', 'E87', '042', '99', '9', '',
+         '3995', '3961', '0040', '401.9', 'E879.8', 'nan', 'NaN', '9955', '00']
+
+def random_codes(n, seed):
+    rnd = random.Random(seed)
+    alphabet = '0123456789EV.'
+    return [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 7))) for _ in range(n)]
+
+class ReformatCodesTest(unittest.TestCase):
+
+    def check(self, codes, is_diag):
+        flags = np.broadcast_to(np.asarray(is_diag, dtype=bool), (len(codes),))
+        expected = [datasets.reformat(str(code), bool(flag)) for code, flag in zip(codes, flags)]
+        self.assertEqual(datasets.reformat_codes(codes, is_diag).tolist(), expected)
+
+    def test_diagnoses(self):
+        self.check(CODES, True)
+
+    def test_procedures(self):
+        self.check(CODES, False)
+
+    def test_flag_per_code(self):
+        self.check(CODES, [i % 3 == 0 for i in range(len(CODES))])
+
+    def test_series_with_missing_codes(self):
+        #codes read by pandas: numeric procedure codes, and NaN where a code is missing
+        codes = pd.Series([3995, 40, float('nan'), 9]).astype(str)
+        self.check(codes, False)
+        self.check(codes, True)
+
+    def test_random_codes(self):
+        codes = random_codes(5000, 0)
+        self.check(codes, True)
+        self.check(codes, False)
+        self.check(codes, np.random.RandomState(0).rand(len(codes)) < 0.5)
+
+    def test_empty(self):
+        self.assertEqual(len(datasets.reformat_codes([], True)), 0)
+
+if __name__ == '__main__':
+    unittest.main()
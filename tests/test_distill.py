@@ -0,0 +1,107 @@
+"""
+    Tests for the teacher score cache in learn/distill.py
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import learn.distill as distill
+
+HADM_IDS = [105, 101, 133, 120]
+#teacher label space, in a different order from the student's and with an extra code
+TEACHER_CODES = ['428.0', '401.9', 'V58.61', '427.31']
+
+class TeacherCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.teacher_path = os.path.join(self.dir, 'model_best_f1_micro.pth')
+        with open(self.teacher_path, 'wb') as f:
+            f.write(b'teacher weights v1')
+        with open(os.path.join(self.dir, 'params.json'), 'w') as f:
+            f.write('{"model": "conv_attn"}')
+        self.data_path = os.path.join(self.dir, 'train_50.csv')
+        self.write_data(HADM_IDS)
+        codes = ['401.9', '427.31', '428.0']
+        self.dicts = {'ind2c': dict(enumerate(codes)), 'c2ind': {c: i for i, c in enumerate(codes)}}
+        #one logit per teacher code and document: 10 * document number + teacher column
+        self.logits = np.array([[10. * i + j for j in range(len(TEACHER_CODES))] for i in range(len(HADM_IDS))])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_data(self, hadm_ids):
+        with open(self.data_path, 'w') as f:
+            w = csv.writer(f)
+            w.writerow(['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS', 'length'])
+            for hadm_id in hadm_ids:
+                w.writerow([hadm_id - 100, hadm_id, 'some words', '401.9', 2])
+
+    def load(self, hadm_ids=HADM_IDS, codes=TEACHER_CODES):
+        #the teacher run is replaced by fixed scores, so the test only sees whether it would have run
+        scores = (self.logits[:len(hadm_ids), :len(codes)].astype(np.float16), np.array(hadm_ids), np.array(codes))
+        with mock.patch.object(distill.TeacherScores, 'score', return_value=scores) as score:
+            teacher = distill.TeacherScores(self.teacher_path, self.data_path, self.dicts)
+        return teacher, score.call_count
+
+    def test_cache_key(self):
+        key = distill.cache_key(self.teacher_path, self.data_path)
+        self.assertEqual(distill.cache_key(self.teacher_path, self.data_path), key)
+        #same content written again: same key
+        with open(self.teacher_path, 'wb') as f:
+            f.write(b'teacher weights v1')
+        self.assertEqual(distill.cache_key(self.teacher_path, self.data_path), key)
+        with open(self.teacher_path, 'wb') as f:
+            f.write(b'teacher weights v2')
+        key2 = distill.cache_key(self.teacher_path, self.data_path)
+        self.assertNotEqual(key2['teacher'], key['teacher'])
+        self.assertEqual(key2['data'], key['data'])
+        with open(os.path.join(self.dir, 'params.json'), 'w') as f:
+            f.write('{"model": "conv_attn", "filter_size": 10}')
+        self.assertNotEqual(distill.cache_key(self.teacher_path, self.data_path)['params'], key2['params'])
+        self.write_data(HADM_IDS[::-1])
+        self.assertNotEqual(distill.cache_key(self.teacher_path, self.data_path)['data'], key['data'])
+
+    def test_cache_reused_until_content_changes(self):
+        self.assertEqual(self.load()[1], 1)
+        self.assertEqual(self.load()[1], 0)
+        #rewriting the teacher re-scores, even with an older modification time
+        mtime = os.path.getmtime(self.teacher_path)
+        with open(self.teacher_path, 'wb') as f:
+            f.write(b'teacher weights v2')
+        os.utime(self.teacher_path, (mtime - 100, mtime - 100))
+        self.assertEqual(self.load()[1], 1)
+        self.assertEqual(self.load()[1], 0)
+        self.write_data(HADM_IDS + [150])
+        self.assertEqual(self.load(HADM_IDS + [150])[1], 1)
+        #an interrupted run leaves no key, so its scores aren't trusted
+        os.remove(os.path.splitext(self.teacher_path)[0] + '_teacher_train_50_key.json')
+        self.assertEqual(self.load(HADM_IDS + [150])[1], 1)
+
+    def test_soft_targets_in_student_order(self):
+        teacher, _ = self.load()
+        soft = teacher.soft_targets([133, 105], 1.).numpy()
+        #student codes 401.9, 427.31, 428.0 are teacher columns 1, 3, 0
+        expected = 1. / (1. + np.exp(-self.logits[[2, 0]][:, [1, 3, 0]]))
+        self.assertTrue(np.allclose(soft, expected, atol=1e-3))
+
+    def test_missing_documents(self):
+        with self.assertRaisesRegex(ValueError, 'missing 1 documents .* hadm id 120'):
+            self.load(HADM_IDS[:3])
+
+    def test_missing_codes(self):
+        with self.assertRaisesRegex(ValueError, "no output for 1 of the student's codes, e.g. 427.31"):
+            self.load(codes=TEACHER_CODES[:3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+    Tests for the external merge sort in dataproc/length_sort.py
+"""
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from dataproc import length_sort
+
+class SortByLengthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.dir, 'train.csv')
+        rnd = random.Random(5)
+        #few distinct lengths, so most rows are tied with rows in other runs
+        self.rows = []
+        for i in range(500):
+            text = ' '.join('t%d' % rnd.randint(0, 50) for _ in range(rnd.randint(0, 6)))
+            self.rows.append([str(i), str(900 + i), text, '401.9;428.0' if i % 2 else '38.93'])
+        with open(self.infile, 'w') as f:
+            w = csv.writer(f)
+            w.writerow(['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS'])
+            w.writerows(self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sort(self, **kwargs):
+        outfile = os.path.join(self.dir, 'sorted.csv')
+        with mock.patch.object(length_sort, 'write_run', wraps=length_sort.write_run) as write_run:
+            length_sort.sort_by_length(self.infile, outfile, **kwargs)
+        with open(outfile) as f:
+            r = csv.reader(f)
+            return next(r), list(r), write_run.call_count
+
+    def expected(self):
+        #python's sort is stable, so tied rows stay in input order
+        return [row + [str(len(row[2].split()))] for row in sorted(self.rows, key=lambda row: len(row[2].split()))]
+
+    def test_several_runs(self):
+        header, rows, num_runs = self.sort(max_bytes=400)
+        self.assertGreater(num_runs, 10)
+        self.assertEqual(header, ['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS', 'length'])
+        self.assertEqual(rows, self.expected())
+
+    def test_in_memory(self):
+        header, rows, num_runs = self.sort()
+        self.assertEqual(num_runs, 0)
+        self.assertEqual(rows, self.expected())
+
+    def test_columns_and_in_place(self):
+        length_sort.sort_by_length(self.infile, columns=['HADM_ID', 'TEXT'], max_bytes=1000)
+        with open(self.infile) as f:
+            r = csv.reader(f)
+            self.assertEqual(next(r), ['HADM_ID', 'TEXT', 'length'])
+            self.assertEqual(list(r), [row[1:3] + row[4:] for row in self.expected()])
+        #the spilled runs are cleaned up
+        self.assertEqual(os.listdir(self.dir), ['train.csv'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+    Tests for the models in learn/models.py
+"""
+import os
+import sys
+import unittest
+
+import torch
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import learn.models as models
+
+def reference_attention(fc_weight, argmax, num_windows):
+    #score of window i for a label: the sum of that label's weights over the filters whose max was at window i
+    attn = torch.zeros(argmax.size()[0], fc_weight.size()[0], num_windows)
+    for b in range(argmax.size()[0]):
+        for f in range(argmax.size()[1]):
+            attn[b, :, argmax[b, f, 0]] += fc_weight[:, f]
+    return attn
+
+class ConstructAttentionTest(unittest.TestCase):
+
+    def setUp(self):
+        dicts = {'ind2w': {i: str(i) for i in range(1, 21)}}
+        self.model = models.VanillaConv(5, None, 3, 4, gpu=False, dicts=dicts)
+
+    def test_tied_argmax(self):
+        #filters 0-2 all peak at window 2. the old loop's weights.view(-1, Y) mixed up labels whenever several filters
+        #shared a window
+        argmax = torch.tensor([[[2], [2], [2], [0]]])
+        with torch.no_grad():
+            attn = self.model.construct_attention(argmax, 4)
+        weight = self.model.fc.weight.data
+        self.assertEqual(tuple(attn.size()), (1, 5, 4))
+        self.assertTrue(torch.allclose(attn[0, :, 2], weight[:, :3].sum(dim=1)))
+        self.assertTrue(torch.allclose(attn[0, :, 0], weight[:, 3]))
+        self.assertTrue(torch.equal(attn[0, :, 1], torch.zeros(5)))
+        self.assertTrue(torch.equal(attn[0, :, 3], torch.zeros(5)))
+
+    def test_matches_reference(self):
+        torch.manual_seed(0)
+        argmax = torch.randint(0, 3, (6, 4, 1))
+        with torch.no_grad():
+            attn = self.model.construct_attention(argmax, 3)
+        self.assertTrue(torch.allclose(attn, reference_attention(self.model.fc.weight.data, argmax, 3), atol=1e-6))
+
+def padded_batch(docs, extra=0):
+    #right-padded token ids, optionally with more padding than the longest document needs
+    data = torch.zeros(len(docs), max(len(doc) for doc in docs) + extra, dtype=torch.long)
+    for i, doc in enumerate(docs):
+        data[i, :len(doc)] = torch.tensor(doc)
+    return data, [len(doc) for doc in docs]
+
+class PackedRNNTest(unittest.TestCase):
+
+    DOCS = [[4, 8, 15], [16, 23, 42, 4, 8, 15, 16, 23, 42], [7], [1, 2, 3, 4, 5, 6]]
+
+    def build(self, cell_type, num_layers, bidirectional):
+        dicts = {'ind2w': {i: str(i) for i in range(1, 50)}}
+        model = models.VanillaRNN(3, None, dicts, 8, cell_type, num_layers, False, embed_size=6, bidirectional=bidirectional)
+        model.eval()
+        return model
+
+    def reference(self, model, doc):
+        #the recurrent unit run over the document alone, without packing
+        with torch.no_grad():
+            embeds = model.embed(torch.tensor([doc])).transpose(0, 1)
+            _, hidden = model.rnn(embeds)
+            hidden = hidden[0] if model.cell_type == 'lstm' else hidden
+            last = hidden[-1] if model.num_directions == 1 else torch.cat([hidden[-2], hidden[-1]], dim=1)
+            return model.final(last)[0]
+
+    def test_batch_matches_single(self):
+        for cell_type in ['gru', 'lstm']:
+            for num_layers, bidirectional in [(1, False), (2, False), (1, True), (2, True)]:
+                with self.subTest(cell_type=cell_type, num_layers=num_layers, bidirectional=bidirectional):
+                    model = self.build(cell_type, num_layers, bidirectional)
+                    data, lengths = padded_batch(self.DOCS, extra=5)
+                    with torch.no_grad():
+                        yhat, _, _ = model(data, None, lengths=lengths)
+                        #lengths counted from the padding when the loader doesn't give them
+                        yhat_counted, _, _ = model(data, None)
+                    self.assertTrue(torch.equal(yhat, yhat_counted))
+                    for i, doc in enumerate(self.DOCS):
+                        with torch.no_grad():
+                            single, _, _ = model(torch.tensor([doc]), None, lengths=[len(doc)])
+                        self.assertTrue(torch.allclose(yhat[i], single[0], atol=1e-6))
+                        self.assertTrue(torch.allclose(yhat[i], self.reference(model, doc), atol=1e-6))
+
+    def test_batch_larger_than_initial_state(self):
+        model = self.build('gru', 1, False)
+        docs = [self.DOCS[i % len(self.DOCS)] for i in range(40)]
+        data, lengths = padded_batch(docs)
+        with torch.no_grad():
+            yhat, _, _ = model(data, None, lengths=lengths)
+            small, _, _ = model(data[:4], None, lengths=lengths[:4])
+        self.assertEqual(tuple(yhat.size()), (40, 3))
+        self.assertTrue(torch.allclose(yhat[:4], small, atol=1e-6))
+        self.assertTrue(torch.allclose(yhat[4:8], small, atol=1e-6))
+
+class MultiWidthAndDownsampleTest(unittest.TestCase):
+    """
+        The fused multi-width conv against one conv per width, and batch vs single document scores of the
+        multi-width and downsampled attention models
+    """
+
+    def setUp(self):
+        torch.manual_seed(2)
+        self.dicts = {'ind2w': {i: str(i) for i in range(1, 30)}}
+        self.docs = [[torch.randint(1, 30, (1,)).item() for _ in range(n)] for n in [2, 11, 5, 17, 8]]
+
+    def per_width(self, model, doc):
+        #each width as its own conv padded by floor(size/2), its own attention, then max-pooled across widths
+        x = model.embed(torch.tensor([doc])).transpose(1, 2)
+        max_size, num_maps = max(model.filter_sizes), model.num_filter_maps
+        ms = []
+        for i, size in enumerate(model.filter_sizes):
+            offset = max_size // 2 - size // 2
+            conv = torch.nn.Conv1d(model.embed_size, num_maps, size, padding=size // 2)
+            conv.weight.data = model.conv.weight.data[i*num_maps:(i+1)*num_maps, :, offset:offset+size].clone()
+            conv.bias.data = model.conv.bias.data[i*num_maps:(i+1)*num_maps].clone()
+            h = torch.tanh(conv(x)).transpose(1, 2)
+            alpha = torch.softmax(model.U.weight[i*model.Y:(i+1)*model.Y].matmul(h.transpose(1, 2)), dim=2)
+            ms.append(alpha.matmul(h))
+        m = torch.stack(ms).max(dim=0)[0]
+        return model.final.weight.mul(m).sum(dim=2).add(model.final.bias)[0]
+
+    def check_batch_matches_single(self, model):
+        data, lengths = padded_batch(self.docs, extra=3)
+        with torch.no_grad():
+            yhat, _, alpha = model(data, None, lengths=lengths)
+            for i, doc in enumerate(self.docs):
+                single, _, alpha_single = model(torch.tensor([doc]), None, lengths=[len(doc)])
+                self.assertTrue(torch.allclose(yhat[i], single[0], atol=1e-5))
+                #attention on the document's own positions only
+                n = alpha_single.size()[-1]
+                self.assertTrue(torch.allclose(alpha[i, :, :n], alpha_single[0], atol=1e-5))
+                self.assertTrue(bool((alpha[i, :, n:] == 0).all()))
+        return yhat
+
+    def test_fused_matches_per_width(self):
+        for filter_sizes in [[3, 5], [1, 3, 5, 9]]:
+            with self.subTest(filter_sizes=filter_sizes):
+                model = models.MultiConvAttnPool(4, None, filter_sizes, 6, 0, False, self.dicts, embed_size=10)
+                model.eval()
+                yhat = self.check_batch_matches_single(model)
+                with torch.no_grad():
+                    for i, doc in enumerate(self.docs):
+                        self.assertTrue(torch.allclose(yhat[i], self.per_width(model, doc), atol=1e-5))
+
+    def test_stacked_widths(self):
+        model = models.MultiConvAttnPool(4, None, [2, 3, 4], 6, 0, False, self.dicts, embed_size=10, stack_filters=True)
+        model.eval()
+        self.check_batch_matches_single(model)
+
+    def test_downsampled(self):
+        for mode in ['max', 'conv']:
+            for downsample in [2, 3]:
+                with self.subTest(mode=mode, downsample=downsample):
+                    model = models.ConvAttnPool(4, None, 3, 6, 0, False, self.dicts, embed_size=10,
+                                                downsample=downsample, downsample_mode=mode)
+                    model.eval()
+                    self.check_batch_matches_single(model)
+                    #one attention position per downsample conv windows, keeping the last partial one
+                    with torch.no_grad():
+                        _, _, alpha = model(torch.tensor([self.docs[3]]), None, lengths=[17])
+                    self.assertEqual(alpha.size()[-1], (17 + downsample - 1) // downsample)
+
+class BOWPoolTest(unittest.TestCase):
+
+    def test_pooling_skips_padding(self):
+        dicts = {'ind2w': {i: str(i) for i in range(1, 12)}}
+        docs = [[3, 3, 7], [1, 2, 3, 4, 5, 6, 7, 8], [11]]
+        data, lengths = padded_batch(docs, extra=4)
+        reduce = {'sum': lambda v: v.sum(dim=0), 'mean': lambda v: v.mean(dim=0), 'max': lambda v: v.max(dim=0)[0]}
+        for pool, name in [('sum', 'sum'), ('avg', 'mean'), (None, 'mean'), ('max', 'max')]:
+            with self.subTest(pool=pool):
+                model = models.BOWPool(5, None, 0, False, dicts, pool=pool, embed_size=7)
+                model.eval()
+                with torch.no_grad():
+                    logits, _, _ = model(data, None, lengths=lengths)
+                    logits_counted, _, _ = model(data, None)
+                    #pooled straight from each document's word vectors
+                    W = model.embed.weight
+                    expected = torch.stack([model.final(reduce[name](W[torch.tensor(doc)])) for doc in docs])
+                self.assertTrue(torch.allclose(logits, expected, atol=1e-6))
+                self.assertTrue(torch.equal(logits, logits_counted))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+    Tests for the stage hashing in dataproc/pipeline.py
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import dataproc.pipeline as pipeline
+
+def pipeline_args(**kwargs):
+    args = {'Y': 50, 'workers': None, 'vocab_min': 3, 'max_vocab': None, 'embedding_size': 100, 'w2v_min_count': 0,
+            'w2v_iter': 5, 'oov_init': 'random'}
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+class StageKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.inputs = {}
+        for name in ['codes', 'summaries']:
+            self.inputs[name] = os.path.join(self.dir, name + '.csv')
+            with open(self.inputs[name], 'w') as f:
+                f.write("HADM_ID\n1\n")
+        self.outputs = {'train_full': os.path.join(self.dir, 'disch_train_split.csv')}
+        with open(self.outputs['train_full'], 'w') as f:
+            f.write("SUBJECT_ID,HADM_ID,TEXT,LABELS\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def split_stage(self, base_name):
+        return pipeline.Stage('split', pipeline.label_and_split, self.inputs, self.outputs, {'Y': 50, 'base_name': base_name})
+
+    def test_split_base_name_is_a_param(self):
+        split = [stage for stage in pipeline.make_stages(pipeline_args()) if stage.name == 'split'][0]
+        self.assertIn('base_name', split.params)
+        self.assertNotIn('base_name', split.options)
+        self.assertTrue(all(path.startswith(split.params['base_name']) for name, path in split.outputs.items()
+                            if name not in ['labeled', 'top_codes']))
+
+    def test_base_name_invalidates_stage(self):
+        cache = {}
+        stage = self.split_stage(os.path.join(self.dir, 'disch'))
+        key = pipeline.stage_key(stage, cache)
+        manifest = {'files': cache, 'stages': {'split': {'key': key,
+                    'output_bytes': {name: os.path.getsize(path) for name, path in stage.outputs.items()}}}}
+        self.assertTrue(pipeline.up_to_date(stage, key, manifest))
+
+        renamed = self.split_stage(os.path.join(self.dir, 'notes'))
+        new_key = pipeline.stage_key(renamed, cache)
+        self.assertNotEqual(key, new_key)
+        self.assertFalse(pipeline.up_to_date(renamed, new_key, manifest))
+
+if __name__ == '__main__':
+    unittest.main()
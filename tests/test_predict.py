@@ -0,0 +1,84 @@
+"""
+    Tests for the streaming note encoding and windowed scoring in learn/predict.py
+"""
+import os
+import sys
+import unittest
+from multiprocessing import Pool
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import learn.predict as predict
+
+W2IND = {w: i + 1 for i, w in enumerate(['chest', 'pain', 'fever', 'history', 'of', 'cough'])}
+
+class CountingNotes:
+    """
+        Iterator over (note id, text) that counts how many notes have been read
+    """
+    def __init__(self, num_notes):
+        words = sorted(W2IND) + ['unseen']
+        self.notes = [('n%d' % i, ' '.join(words[(i * j) % len(words)] for j in range(i % 9 + 1))) for i in range(num_notes)]
+        self.num_read = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_read == len(self.notes):
+            raise StopIteration
+        self.num_read += 1
+        return self.notes[self.num_read - 1]
+
+class EncodeWindowsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = Pool(2, initializer=predict.init_worker, initargs=(W2IND, False))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+
+    def test_reads_one_window_ahead(self):
+        for num_notes, window_size in [(23, 5), (20, 5), (3, 8), (0, 4)]:
+            with self.subTest(num_notes=num_notes, window_size=window_size):
+                notes = CountingNotes(num_notes)
+                windows = []
+                for k, window in enumerate(predict.encode_windows(self.pool, notes, window_size, 2)):
+                    #the current window and at most the next one have been read
+                    self.assertEqual(notes.num_read, min(num_notes, (k + 2) * window_size))
+                    windows.append(window)
+                self.assertEqual([len(window) for window in windows],
+                                 [min(window_size, num_notes - i) for i in range(0, num_notes, window_size)])
+                expected = [(note_id, predict.encode(text, W2IND)) for note_id, text in notes.notes]
+                self.assertEqual([note for window in windows for note in window], expected)
+
+    def test_encode(self):
+        #out of vocab words get len(vocab)+1, as in datasets.data_generator
+        self.assertEqual(predict.encode('Chest pain, unseen cough', W2IND), [1, 2, 7, 6])
+        self.assertEqual(predict.encode('chest Pain', W2IND, tokenized=True), [1, 7])
+
+class ScoreWindowTest(unittest.TestCase):
+
+    def test_results_in_window_order(self):
+        batches = []
+        class LengthScorer:
+            codes = ['a', 'b', 'c']
+            def score(self, docs):
+                batches.append([len(doc) for doc in docs])
+                return np.array([[len(doc), 10 - len(doc), 5] for doc in docs], dtype=float)
+        window = [('x', [1] * 7), ('y', [1]), ('z', [1] * 4), ('w', [1] * 2), ('v', [1] * 9)]
+        results = predict.score_window(LengthScorer(), window, 2, 2)
+        #batched shortest first, returned in input order
+        self.assertEqual(batches, [[1, 2], [4, 7], [9]])
+        self.assertEqual([r['id'] for r in results], ['x', 'y', 'z', 'w', 'v'])
+        self.assertEqual(results[0]['codes'], [{'code': 'a', 'score': 7.}, {'code': 'c', 'score': 5.}])
+        self.assertEqual(results[1]['codes'], [{'code': 'b', 'score': 9.}, {'code': 'c', 'score': 5.}])
+
+if __name__ == '__main__':
+    unittest.main()
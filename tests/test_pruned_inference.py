@@ -0,0 +1,91 @@
+"""
+    Tests for pruned label attention in learn/pruned_inference.py
+"""
+import os
+import sys
+import unittest
+
+import torch
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import learn.models as models
+import learn.pruned_inference as pruned_inference
+
+#two diagnosis categories (d401, d428) and one procedure category (p39)
+CODES = ['401.9', '401.1', '428.0', '428.22', '39.95', '39.61']
+
+def pad(docs):
+    data = torch.zeros(len(docs), max(len(doc) for doc in docs), dtype=torch.long)
+    for i, doc in enumerate(docs):
+        data[i, :len(doc)] = torch.tensor(doc)
+    return data, [len(doc) for doc in docs]
+
+class PrunedScoringTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1)
+        dicts = {'ind2w': {i: 'w%d' % i for i in range(1, 41)}}
+        self.model = models.ConvAttnPool(len(CODES), None, 3, 8, 0, False, dicts)
+        self.model.eval()
+        ind2c = {i: c for i, c in enumerate(CODES)}
+        _, members, self.code2cat = pruned_inference.build_hierarchy(ind2c)
+        self.heads = pruned_inference.CategoryHeads(self.model, members)
+        self.heads.eval()
+        self.docs = [[3, 9, 27, 4, 1], [12, 5, 5, 30, 2, 8, 17, 40, 6, 11, 3, 22], [7, 7, 19, 33, 2, 14, 9, 1]]
+
+    def encode(self, docs):
+        data, lengths = pad(docs)
+        x = self.model.encode(data, lengths)
+        return x, self.model.attention_mask(lengths, x.size()[1], x.device)
+
+    def test_hierarchy(self):
+        self.assertEqual(len(self.heads.final_bias), 3)
+        self.assertEqual(self.code2cat.tolist(), [0, 0, 1, 1, 2, 2])
+
+    def test_batch_matches_single(self):
+        with torch.no_grad():
+            x, mask = self.encode(self.docs)
+            for threshold in [0., 0.5]:
+                scores, evaluated = pruned_inference.score_pruned(self.model, self.heads, self.code2cat, x, threshold, mask)
+                for i, doc in enumerate(self.docs):
+                    x_i, mask_i = self.encode([doc])
+                    scores_i, evaluated_i = pruned_inference.score_pruned(self.model, self.heads, self.code2cat, x_i,
+                                                                          threshold, mask_i)
+                    self.assertTrue(torch.equal(evaluated[i], evaluated_i[0]))
+                    self.assertTrue(torch.allclose(scores[i], scores_i[0], atol=1e-6))
+
+    def test_all_codes_match_full_attention(self):
+        with torch.no_grad():
+            x, mask = self.encode(self.docs)
+            scores, evaluated = pruned_inference.score_pruned(self.model, self.heads, self.code2cat, x, -1., mask)
+            full = torch.sigmoid(self.model.attend(x, mask=mask)[0])
+        self.assertTrue(bool(evaluated.all()))
+        self.assertTrue(torch.allclose(scores, full, atol=1e-6))
+
+    def test_unevaluated_codes_score_zero(self):
+        #only the procedure category of the second document passes
+        x = torch.randn(2, 4, 8)
+        cat_logits = torch.tensor([[-5., -5., -5.], [-5., -5., 5.]])
+        self.heads.forward = lambda x, mask=None: cat_logits
+        with torch.no_grad():
+            scores, evaluated = pruned_inference.score_pruned(self.model, self.heads, self.code2cat, x, 0.5)
+        self.assertEqual(evaluated.tolist(), [[False] * 6, [False] * 4 + [True] * 2])
+        self.assertTrue(bool((scores[0] == 0).all()))
+        self.assertTrue(bool((scores[1, :4] == 0).all()))
+        self.assertTrue(bool((scores[1, 4:] > 0).all()))
+
+    def test_shortlist_batch_matches_single(self):
+        with torch.no_grad():
+            x, mask = self.encode(self.docs)
+            scores, evaluated = pruned_inference.score_shortlist(self.model, x, 2, mask)
+            for i, doc in enumerate(self.docs):
+                x_i, mask_i = self.encode([doc])
+                scores_i, evaluated_i = pruned_inference.score_shortlist(self.model, x_i, 2, mask_i)
+                self.assertTrue(torch.equal(evaluated[i], evaluated_i[0]))
+                self.assertTrue(torch.allclose(scores[i], scores_i[0], atol=1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+    Tests for request validation and micro-batching in learn/serve.py
+"""
+import os
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import learn.serve as serve
+
+#decoded request bodies that must be rejected before they reach a batch, and the message each gets
+BAD_REQUESTS = [
+    (['text'], 'JSON object'),
+    ('text', 'JSON object'),
+    (None, 'JSON object'),
+    ({}, 'text string'),
+    ({'id': 3}, 'text string'),
+    ({'text': None}, 'text string'),
+    ({'text': 12}, 'text string'),
+    ({'text': ['a', 'b']}, 'text string'),
+    ({'notes': []}, 'non-empty list'),
+    ({'notes': {'text': 'a'}}, 'non-empty list'),
+    ({'notes': 'a'}, 'non-empty list'),
+    ({'notes': ['a', 'b']}, 'JSON object'),
+    ({'notes': [{'text': 'a'}, None]}, 'JSON object'),
+    ({'notes': [{'text': 'a'}, {'id': 2}]}, 'text string'),
+    ({'notes': [{'text': 'a'}, {'text': 5}]}, 'text string'),
+    ({'text': 'a', 'top_k': 0}, 'top_k'),
+    ({'text': 'a', 'top_k': -2}, 'top_k'),
+    ({'text': 'a', 'top_k': 2.5}, 'top_k'),
+    ({'text': 'a', 'top_k': '5'}, 'top_k'),
+    ({'text': 'a', 'top_k': True}, 'top_k'),
+    ({'text': 'a', 'top_k': None}, 'top_k'),
+]
+
+class ParseRequestTest(unittest.TestCase):
+
+    def test_single_note(self):
+        self.assertEqual(serve.parse_request({'text': 'chest pain'}, 8), ([(None, 'chest pain')], 8))
+        self.assertEqual(serve.parse_request({'id': 'a1', 'text': '', 'top_k': 3}, 8), ([('a1', '')], 3))
+
+    def test_several_notes(self):
+        request = {'notes': [{'id': 'x', 'text': 'fever'}, {'text': 'cough'}], 'top_k': 1}
+        #notes without an id are numbered by position
+        self.assertEqual(serve.parse_request(request, 8), ([('x', 'fever'), (1, 'cough')], 1))
+
+    def test_bad_requests(self):
+        for request, message in BAD_REQUESTS:
+            with self.subTest(request=request):
+                with self.assertRaisesRegex(ValueError, message):
+                    serve.parse_request(request, 8)
+
+class BatcherTest(unittest.TestCase):
+
+    def test_concurrent_requests(self):
+        batch_sizes = []
+        class SumScorer:
+            def score(self, docs):
+                batch_sizes.append(len(docs))
+                return np.array([[sum(doc), len(doc)] for doc in docs], dtype=float)
+        batcher = serve.Batcher(SumScorer(), serve.Stats(), max_batch_size=4, max_latency=0.05)
+        batcher.start()
+        requests = [[[i, j] for j in range(i % 3 + 1)] for i in range(12)]
+        results = [None] * len(requests)
+        def submit(i):
+            results[i] = batcher.submit(requests[i])
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        #every request gets its own notes' scores back, in order
+        for docs, scores in zip(requests, results):
+            self.assertEqual([s.tolist() for s in scores], [[float(sum(doc)), 2.] for doc in docs])
+        self.assertEqual(sum(batch_sizes), sum(len(docs) for docs in requests))
+        self.assertLessEqual(max(batch_sizes), 4)
+        self.assertEqual(batcher.stats.summary()['batch_size_histogram'],
+                         {str(size): batch_sizes.count(size) for size in sorted(set(batch_sizes))})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+    Tests for the evaluation loop in learn/training.py
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import torch
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+#training imports its neighbours in learn/ as top level modules, as when it's run as a script
+sys.path.append(os.path.join(parentdir, 'learn'))
+
+import learn.models as models
+import learn.training as training
+
+CODES = ['401.9', '428.0', '427.31']
+
+class BF16SamplesTest(unittest.TestCase):
+    """
+        The test fold always saves attention samples, so under --bf16 the attention has to reach interpret as float32
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        words = ['w%d' % i for i in range(30)]
+        ind2w = {i+1: w for i, w in enumerate(words)}
+        self.dicts = {'ind2w': ind2w, 'w2ind': {w: i for i, w in ind2w.items()},
+                      'ind2c': {i: c for i, c in enumerate(CODES)}, 'c2ind': {c: i for i, c in enumerate(CODES)},
+                      'dv': {}, 'desc': {c: 'description of %s' % c for c in CODES}}
+        self.data_path = os.path.join(self.dir, 'train_full.csv')
+        with open(os.path.join(self.dir, 'test_full.csv'), 'w') as f:
+            w = csv.writer(f)
+            w.writerow(['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LABELS', 'length'])
+            for i, length in enumerate([6, 9, 14]):
+                w.writerow([i, 100 + i, ' '.join(words[(i + j) % len(words)] for j in range(length)), CODES[i % 2], length])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_test_fold(self, model):
+        #predict every code, so both the true and the false positive files get spans
+        out_layer = model.final if hasattr(model, 'final') else model.fc
+        out_layer.bias.data.fill_(5.)
+        metrics = training.test(model, 'full', 0, self.data_path, 'test', False, 'mimic3', set(), self.dicts, True,
+                                self.dir, True, bf16=True)
+        self.assertIn('loss_test', metrics)
+        with open(os.path.join(self.dir, 'tp_test_examples_0.txt')) as f:
+            self.assertIn('true positive', f.read())
+        with open(os.path.join(self.dir, 'fp_test_examples_0.txt')) as f:
+            self.assertIn('false positive', f.read())
+
+    def test_vanilla_conv(self):
+        torch.manual_seed(0)
+        self.run_test_fold(models.VanillaConv(len(CODES), None, 3, 4, gpu=False, dicts=self.dicts))
+
+    def test_conv_attn(self):
+        torch.manual_seed(0)
+        self.run_test_fold(models.ConvAttnPool(len(CODES), None, 3, 4, 0, False, self.dicts))
+
+if __name__ == '__main__':
+    unittest.main()